@@ -0,0 +1,135 @@
+#! /usr/bin/env python
+
+from argparse import ArgumentParser
+from printing_utils import *
+
+from friend_trees import friend_filename, friend_folder, friend_treename, is_valid_friend, read_columns_with_friends
+from ntuple_index import summarize_tree, write_file_index
+from ntuple_io import file_signature
+from kinematics import to_cartesian, to_ptetaphim
+from multiprocessing import Pool
+from array import array
+import numpy as np
+import os
+
+
+
+description = """Adding columns derived from existing branches to converted ntuples, as friend trees, without reconverting."""
+parser = ArgumentParser(prog="augmenter", description=description, epilog="Finished successfully!")
+parser.add_argument('-i', "--infilenames", dest="infilenames", nargs='+', default=None, action='store', required=True,
+                                           help="Name of the ntuple(s) to augment" )
+parser.add_argument('-a', "--augmentations", dest="augmentations", nargs='+', default=None, action='store',
+                                           help="Names of the augmentations to run (default: all of those defined in 'augmentations' below).")
+parser.add_argument('-f', "--force",       dest="force", default=False, action='store_true',
+                                           help="Recompute friends that are still valid.")
+parser.add_argument('-j', "--ncores",      dest="ncores", default=1, type=int,
+                                           help="Number of files augmented in parallel.")
+
+
+
+# An augmentation takes a dict of input columns of one ntuple and returns a dict with the new
+# columns, as float32 or int32 arrays with one entry per event. To add a variable, add a function
+# here and register it in 'augmentations' with the columns it needs.
+
+def augment_ditau(columns):
+    # missing taus are stored with negative visible pt, their four-momenta are left out of the sums
+    p4s = []
+    for tau in ['tau1', 'tau2']:
+        valid = columns['%s_vis_pt' % (tau)] >= 0.
+        p4 = to_cartesian(np.where(valid, columns['%s_vis_pt' % (tau)], 0.), columns['%s_vis_eta' % (tau)], columns['%s_vis_phi' % (tau)], np.where(valid, columns['%s_vis_m' % (tau)], 0.))
+        p4s.append([np.where(valid, c, 0.) for c in p4])
+    pt, eta, phi, m = to_ptetaphim(*[a + b for a, b in zip(p4s[0], p4s[1])])
+    has_tau1 = columns['tau1_pt'] > 0.
+    return {
+        'pt_tautau_vis':     pt.astype(np.float32),
+        'tau1_vis_fraction': np.where(has_tau1, columns['tau1_vis_pt'] / np.where(has_tau1, columns['tau1_pt'], 1.), -1.).astype(np.float32),
+    }
+
+augmentations = {
+    'ditau': (['tau1_pt', 'tau1_vis_pt', 'tau1_vis_eta', 'tau1_vis_phi', 'tau1_vis_m', 'tau2_vis_pt', 'tau2_vis_eta', 'tau2_vis_phi', 'tau2_vis_m'], augment_ditau),
+}
+
+leaf_types = {np.dtype(np.float32): ('f', 'F'), np.dtype(np.int32): ('i', 'I')}
+
+
+
+def main():
+    names = args.augmentations if args.augmentations is not None else sorted(augmentations.keys())
+    for name in names:
+        if name not in augmentations:
+            raise ValueError('Unknown augmentation %s, available: %s' % (name, ', '.join(sorted(augmentations.keys()))))
+    print(green('--> Augmenting %i ntuples with: %s' % (len(args.infilenames), ', '.join(names))))
+
+    tasks = []
+    for infilename in args.infilenames:
+        for name in names:
+            if args.force or not is_valid_friend(infilename, name):
+                tasks.append((infilename, name))
+    print(green('  --> %i friend trees to (re)compute, %i still valid' % (len(tasks), len(args.infilenames) * len(names) - len(tasks))))
+
+    if args.ncores > 1 and len(tasks) > 1:
+        pool = Pool(processes=args.ncores)
+        nentries = pool.map(augment_file_singlearg, tasks)
+        pool.close()
+        pool.join()
+    else:
+        nentries = [augment_file_singlearg(t) for t in tasks]
+    print(green('--> Done augmenting, wrote %i friend trees with %i entries in total.' % (len(tasks), sum(nentries))))
+
+
+
+def augment_file_singlearg(task):
+    return augment_file(infilename=task[0], name=task[1])
+
+
+def augment_file(infilename, name):
+    """Compute one augmentation for one ntuple and write it as friend tree, returns the number of entries."""
+    import ROOT as rt
+
+    inputs, function = augmentations[name]
+    signature = file_signature(infilename)
+    columns = read_columns_with_friends(infilename, inputs)
+    new_columns = function(columns)
+    nentries = len(columns[inputs[0]])
+    for c, values in new_columns.items():
+        if len(values) != nentries:
+            raise ValueError('Augmentation %s returned %i values for column %s, expected %i' % (name, len(values), c, nentries))
+        if values.dtype not in leaf_types:
+            raise ValueError('Augmentation %s returned column %s with unsupported type %s' % (name, c, values.dtype))
+
+    outfilename = friend_filename(infilename, name)
+    if not os.path.exists(friend_folder(infilename)):
+        try:
+            os.makedirs(friend_folder(infilename))
+        except OSError:
+            pass
+
+    # Written to a temporary file first, the sidecar written after the rename marks the friend as valid;
+    # the name does not end in .root, so a left-over of a killed job is never found as a friend
+    tmpname = os.path.splitext(outfilename)[0] + '.friend.tmp'
+    f = rt.TFile(tmpname, 'RECREATE')
+    tree = rt.TTree(friend_treename, 'Columns added to %s by augmentation %s' % (os.path.basename(infilename), name))
+    buffers = {}
+    for c in sorted(new_columns.keys()):
+        typecode, leaftype = leaf_types[new_columns[c].dtype]
+        buffers[c] = array(typecode, [0])
+        tree.Branch(c, buffers[c], '%s/%s' % (c, leaftype))
+    values = dict((c, new_columns[c].tolist()) for c in new_columns)
+    for ientry in range(nentries):
+        for c in buffers:
+            buffers[c][0] = values[c][ientry]
+        tree.Fill()
+    f.cd()
+    tree.Write()
+    summary = summarize_tree(tree)
+    f.Close()
+    os.rename(tmpname, outfilename)
+    write_file_index(outfilename, summary, extra={'augmentation': name, 'source': os.path.basename(infilename), 'source_signature': signature})
+    print(blue('    --> Wrote friend %s with %i entries' % (outfilename, nentries)))
+    return nentries
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,61 @@
+#! /usr/bin/env python
+
+from argparse import ArgumentParser
+from printing_utils import *
+import subprocess
+import time
+import sys
+import os
+
+
+
+description = """Measuring the startup time of the steering commands, with and without loading ROOT up front."""
+parser = ArgumentParser(prog="benchmark_startup", description=description, epilog="Finished successfully!")
+parser.add_argument('-n', "--nrepeat",     dest="nrepeat", default=5, type=int,
+                                           help="Number of times each command is run, the median time is reported.")
+parser.add_argument('--commands',          dest="commands", nargs='+', default=['steer.py -c', 'steer.py -p', 'steer.py -c -r'],
+                                           help="Commands to time, as script name followed by its arguments.")
+
+# Each command is run as it is (ROOT loaded only where a step needs it), and once more with ROOT,
+# the tdrstyle and utils imported before the script, which is what every command paid when they
+# were imported eagerly at the top of the steering script.
+eager_template = 'import sys, runpy; sys.path.insert(0, %r); import ROOT, tdrstyle_all, utils; sys.argv = %r; runpy.run_path(%r, run_name=\'__main__\')'
+
+
+
+def time_command(command, nrepeat):
+    DEVNULL = open(os.devnull, 'wb')
+    times = []
+    for i in range(nrepeat):
+        start = time.time()
+        p = subprocess.Popen(command, stdout=DEVNULL, stderr=DEVNULL)
+        p.wait()
+        times.append(time.time() - start)
+        if p.returncode != 0:
+            DEVNULL.close()
+            raise RuntimeError('Command \'%s\' failed with exit code %i.' % (' '.join(command), p.returncode))
+    DEVNULL.close()
+    times.sort()
+    return times[len(times) // 2]
+
+
+def main():
+    print(green('--> Benchmarking the startup time of %i commands, %i runs each' % (len(args.commands), args.nrepeat)))
+    scriptfolder = os.path.dirname(os.path.abspath(__file__))
+    os.chdir(scriptfolder)
+
+    t_root = time_command([sys.executable, '-c', 'import ROOT'], args.nrepeat)
+    print(blue('  --> Importing ROOT alone: %.2f s' % (t_root)))
+    for c in args.commands:
+        argv = c.split()
+        t_lazy = time_command([sys.executable] + argv, args.nrepeat)
+        t_eager = time_command([sys.executable, '-c', eager_template % (scriptfolder, argv, argv[0])], args.nrepeat)
+        print(green('  --> %-20s  lazy: %.2f s, with the eager imports: %.2f s, saved: %.2f s' % (c, t_lazy, t_eager, t_eager - t_lazy)))
+
+    print(green('--> Done benchmarking.'))
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,133 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+from printing_utils import *
+from friend_trees import read_columns_with_friends, signature_with_friends
+
+
+class ColumnCache():
+    """
+    Uncompressed, memory-mapped copy of some branches of the 'Events' tree of a set of ntuples.
+
+    Each column is stored as one .npy file covering all input files back to back, the index
+    stores which rows belong to which input file. Columns are materialized on first request,
+    later requests read them zero-copy through np.load(mmap_mode='r'). The cache is rebuilt
+    as soon as the list of input files or the size or modification time of one of them (or of
+    one of their friend trees, see friend_trees.py) changes. Columns of friend trees are read
+    like those of the ntuples themselves.
+    """
+
+    def __init__(self, cachefolder, infilenames, treename='Events'):
+        self.infilenames = [os.path.abspath(f) for f in infilenames]
+        self.treename = treename
+        key = hashlib.md5(('\n'.join([treename] + self.infilenames)).encode('utf-8')).hexdigest()
+        self.folder = os.path.join(cachefolder, key)
+        self.indexfilename = os.path.join(self.folder, 'index.json')
+        self.index = None
+
+        if not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+        self.load_index()
+
+    def load_index(self):
+        self.index = None
+        if not os.path.isfile(self.indexfilename):
+            return
+        with open(self.indexfilename, 'r') as f:
+            index = json.load(f)
+        if self.index_matches_inputs(index):
+            self.index = index
+        else:
+            print(yellow('  --> Input files of the column cache in %s changed, invalidating it.' % (self.folder)))
+            self.clear()
+
+    def index_matches_inputs(self, index):
+        if index.get('treename') != self.treename:
+            return False
+        if [entry['filename'] for entry in index['files']] != self.infilenames:
+            return False
+        for entry in index['files']:
+            if not os.path.isfile(entry['filename']):
+                return False
+            if signature_with_friends(entry['filename']) != entry['signature']:
+                return False
+        return True
+
+    def clear(self):
+        for f in os.listdir(self.folder):
+            if f.endswith('.npy') or f == 'index.json':
+                os.remove(os.path.join(self.folder, f))
+        self.index = None
+
+    @property
+    def nrows(self):
+        return self.index['nrows'] if self.index is not None else None
+
+    def file_ranges(self):
+        """List of (filename, first row, last row + 1) for each input file."""
+        if self.index is None:
+            return []
+        return [(entry['filename'], entry['start'], entry['stop']) for entry in self.index['files']]
+
+    def get_columns(self, columns):
+        """Dict of read-only memory-mapped arrays for the requested columns, materializing missing ones first."""
+        missing = [c for c in columns if self.index is None or c not in self.index['columns']]
+        if len(missing) > 0:
+            self.materialize(missing)
+        return dict((c, np.load(self.columnfilename(c), mmap_mode='r')) for c in columns)
+
+    def columnfilename(self, column):
+        return os.path.join(self.folder, '%s.npy' % (column))
+
+    def materialize(self, columns):
+        print(blue('  --> Materializing %i column(s) of %i files in cache %s' % (len(columns), len(self.infilenames), self.folder)))
+        signatures = [signature_with_friends(f) for f in self.infilenames]
+
+        # Read each file once for all missing columns, then write the columns back to back
+        percolumn = dict((c, []) for c in columns)
+        nrows_per_file = []
+        for infilename in self.infilenames:
+            arrays = read_columns_with_friends(infilename, columns, treename=self.treename)
+            nrows_per_file.append(len(arrays[columns[0]]))
+            for c in columns:
+                percolumn[c].append(arrays[c])
+
+        if self.index is not None:
+            expected = [entry['stop'] - entry['start'] for entry in self.index['files']]
+            if expected != nrows_per_file:
+                raise ValueError('Number of rows per file in %s does not match the existing cache index' % (self.folder))
+
+        for c in columns:
+            data = np.concatenate(percolumn[c])
+            tmpname = self.columnfilename(c) + '.tmp.npy'
+            out = np.lib.format.open_memmap(tmpname, mode='w+', dtype=data.dtype, shape=data.shape)
+            out[:] = data
+            out.flush()
+            del out
+            os.rename(tmpname, self.columnfilename(c))
+
+        if self.index is None:
+            files = []
+            start = 0
+            for infilename, signature, n in zip(self.infilenames, signatures, nrows_per_file):
+                files.append({'filename': infilename, 'signature': signature, 'start': start, 'stop': start + n})
+                start += n
+            self.index = {'treename': self.treename, 'nrows': start, 'files': files, 'columns': []}
+        self.index['columns'] = sorted(set(self.index['columns']) | set(columns))
+
+        # Write the index last, it is what marks the columns as valid
+        tmpname = self.indexfilename + '.tmp'
+        with open(tmpname, 'w') as f:
+            json.dump(self.index, f, indent=2)
+        os.rename(tmpname, self.indexfilename)
+
+
+def load_columns(infilenames, columns, cachefolder=None, treename='Events'):
+    """Columns of all files back to back, through the cache if a cache folder is given."""
+    if cachefolder is not None:
+        cache = ColumnCache(cachefolder=cachefolder, infilenames=infilenames, treename=treename)
+        return cache.get_columns(columns)
+    arrays = [read_columns_with_friends(infilename, columns, treename=treename) for infilename in infilenames]
+    return dict((c, np.concatenate([a[c] for a in arrays])) for c in columns)
@@ -5,8 +5,24 @@ from argparse import ArgumentParser
 import ROOT as rt
 from DataFormats.FWLite import Events, Handle
 from array import array
+import numpy as np
+import os
+import sys
+import subprocess
+import shutil
+import json
+import time
 
 from printing_utils import *
+from ntuple_index import summarize_tree, write_file_index, load_file_index, write_json_atomic
+from utils import hadd_large
+from work_queue import FileQueue
+from heartbeat import Heartbeat
+from output_staging import OutputStager
+from storage import existing_files as existing_files_on_storage
+from genparticle_graph import GenParticleGraph
+from tau_decays import visible_taus
+from kinematics import to_ptetaphim, mass2, counts_to_offsets, leading_pair_mass
 rt.gROOT.SetBatch(1)
 
 
@@ -17,81 +33,422 @@ parser.add_argument('-i', "--infilenames", dest="infilenames", default=None, act
                                            help="Name of the GENSIM file(s)" )
 parser.add_argument('-o', "--outfilename", dest="outfilename", default=None, action='store',
                                            help="Name of the output ROOT file" )
-args = parser.parse_args()
+parser.add_argument('--first-event',       dest="first_event", default=0, type=int,
+                                           help="Index of the first event to convert, counting through all input files." )
+parser.add_argument('-n', "--nevents",     dest="nevents", default=-1, type=int,
+                                           help="Number of events to convert from the first one on, -1 for all." )
+parser.add_argument('-j', "--ncores",      dest="ncores", default=1, type=int,
+                                           help="Number of processes converting parts of the events of one output in parallel, merged at the end." )
+parser.add_argument('--checkpoint-interval', dest="checkpoint_interval", default=60., type=float,
+                                           help="Seconds between checkpoints, from which a killed job resumes when it is run again; 0 to disable." )
+parser.add_argument('-q', "--queue",       dest="queue", default=None, action='store',
+                                           help="Run as a persistent worker: convert the items of this queue folder (see work_queue.py) one after another, instead of -i and -o." )
+parser.add_argument('--idle-timeout',      dest="idle_timeout", default=60., type=float,
+                                           help="In worker mode, stop after waiting this many seconds for new items." )
+parser.add_argument('--stale-after',       dest="stale_after", default=600., type=float,
+                                           help="In worker mode, when nothing is pending, take back items whose workers have not renewed them for this many seconds (killed ones; live workers renew every minute); 0 to never do that." )
+parser.add_argument('--heartbeatfolder',   dest="heartbeatfolder", default=None, action='store',
+                                           help="Folder to write a progress file per output file to, read by 'steer.py --monitor' (see heartbeat.py)." )
+parser.add_argument('--stage',             dest="stage", default=False, action='store_true',
+                                           help="Write outputs to node-local scratch and upload them to their destination in the background, with checksum verification (see output_staging.py)." )
+parser.add_argument('--scratchfolder',     dest="scratchfolder", default=None, action='store',
+                                           help="Scratch folder for '--stage' (default: $TMPDIR, /scratch/$USER or the system temp folder)." )
 
 
 
+# Energy per proton beam (Run 2) in GeV, to compute the momentum fractions of the incoming partons
+beam_energy = 6500.
+
+
 def main():
-    
-    print(green('--> Starting GENSIM -> ROOT conversion.'))
-    
-    # Load input files
-    existing_files = get_existing_files_from_list(infilenames=args.infilenames)
-    events = Events(existing_files)
-    print(green('  --> Loaded %i files.' % (len(existing_files))))
-
-    # Prepare output file
-    file_root = rt.TFile(args.outfilename, 'RECREATE')
-    outtree = rt.TTree('Events', 'Some variables converted from GENSIM to flat ROOT format')
-    
-    # Define variables to fill into the output tree
-    tau1_pt     = array('f', [ 0. ])
-    tau1_eta    = array('f', [ 0. ])
-    tau1_phi    = array('f', [ 0. ])
-    tau1_e      = array('f', [ 0. ])
-    tau1_charge = array('f', [ 0. ])
-    n_tau       = array('f', [ 0. ])
-
-    # Define variables of the output tree
-    outtree.Branch('tau1_pt',     tau1_pt,     'tau1_pt/F')
-    outtree.Branch('tau1_eta',    tau1_eta,    'tau1_eta/F')
-    outtree.Branch('tau1_phi',    tau1_phi,    'tau1_phi/F')
-    outtree.Branch('tau1_e',      tau1_e,      'tau1_e/F')
-    outtree.Branch('tau1_charge', tau1_charge, 'tau1_charge/F')
-    outtree.Branch('n_tau',       n_tau,       'n_tau/F')
-    handle_gps, label_gps = Handle('std::vector<reco::GenParticle>'), 'genParticles'
-
-    # Start the event loop!
-    ie = 0
-    for e in events:
-        if ie%1000 == 0: print(blue('  --> New event no. %i' % (ie)))
-        ie += 1
-
-        e.getByLabel(label_gps,handle_gps)
-        gps = handle_gps.product()
-
-        # Access the gen-particles 
-        gps_hard       = [p for p in gps if p.isHardProcess()]
-        tau_hard       = [p for p in gps_hard if abs(p.pdgId()) == 15]
-        tau_hard.sort(key=lambda p: p.pt(), reverse=True)
-        # mu_final = [p for p in gps if isFinal(p) and abs(p.pdgId()) == 13 and p.status() == 1]
-        # mu_final.sort(key=lambda p: p.pt(), reverse=True)
-    
-        # Define a 4-momentum vector (for later use)
-        tau1 = rt.TLorentzVector()
+    if args.queue is None and (args.infilenames is None or args.outfilename is None):
+        raise ValueError('Need either input and output files (-i, -o) or a queue to work on (-q).')
 
-        # Fill the 4-momentum vector and the individual branches of the tree
-        if len(tau_hard) > 0: 
-            tau1.SetPxPyPzE(tau_hard[0].p4().Px(), tau_hard[0].p4().Py(), tau_hard[0].p4().Pz(), tau_hard[0].p4().E())
-            tau1_pt[0]   = tau1.Pt()
-            tau1_eta[0]  = tau1.Eta()
-            tau1_phi[0]  = tau1.Phi()
-            tau1_e[0]    = tau1.E()
-            tau1_charge[0]= -1. if tau_hard[0].pdgId() > 0 else +1.
+    stager = OutputStager(scratchfolder=args.scratchfolder) if args.stage else None
+    converter = Converter(heartbeatfolder=args.heartbeatfolder, stager=stager, ncores=args.ncores, checkpoint_interval=args.checkpoint_interval)
+    if args.queue is None:
+        upload = converter.convert(infilenames=args.infilenames, outfilename=args.outfilename, first_event=args.first_event, nevents=args.nevents)
+        if stager is not None:
+            upload.get()
+            stager.close()
+        return
+
+    # Worker mode: ROOT, FWLite, the dictionaries and the handles are loaded once for all items
+    queue = FileQueue(args.queue)
+    print(green('--> Starting converter worker on queue %s (%s)' % (args.queue, ', '.join(['%i %s' % (n, state) for state, n in sorted(queue.counts().items())]))))
+    nconverted, nfailed = 0, 0
+    uploads = []
+    for name, item in queue.items(idle_timeout=args.idle_timeout, stale_after=args.stale_after if args.stale_after > 0 else None):
+        try:
+            upload = converter.convert(infilenames=item['infilenames'], outfilename=item['outfilename'], first_event=item.get('first_event', 0), nevents=item.get('nevents', -1))
+        except Exception as e:
+            print(yellow('--> Conversion of %s failed: %s' % (name, str(e))))
+            queue.finish(name, item, success=False, message=str(e))
+            nfailed += 1
+            continue
+        # with staging, an item is only done once its output is published
+        uploads.append((name, item, upload))
+        nsucceeded, nfailed_upload = finish_uploads(queue, uploads, wait=False)
+        nconverted += nsucceeded
+        nfailed += nfailed_upload
+    nsucceeded, nfailed_upload = finish_uploads(queue, uploads, wait=True)
+    nconverted += nsucceeded
+    nfailed += nfailed_upload
+    if stager is not None:
+        stager.close()
+    print(green('--> Converter worker done: %i items converted, %i failed.' % (nconverted, nfailed)))
+
+
+
+def finish_uploads(queue, uploads, wait):
+    """Mark the queue items whose uploads are over (all of them if wait) as done or failed and remove them from uploads."""
+    nsucceeded, nfailed = 0, 0
+    for name, item, upload in list(uploads):
+        if upload is not None and not wait and not upload.ready():
+            continue
+        uploads.remove((name, item, upload))
+        try:
+            if upload is not None:
+                upload.get()
+        except Exception as e:
+            print(yellow('--> Upload of %s failed: %s' % (item['outfilename'], str(e))))
+            queue.finish(name, item, success=False, message=str(e))
+            nfailed += 1
+            continue
+        queue.finish(name, item, success=True)
+        nsucceeded += 1
+    return nsucceeded, nfailed
 
-        n_tau[0] = len(tau_hard)
 
-        # Finally, store all variables in the tree for this event, on to the next one.
-        outtree.Fill()
-    
 
-    # Write the complete output tree into the output file and close it
-    file_root.cd()
-    outtree.Write()
-    file_root.Close()
+class Converter():
+    """GENSIM -> flat ROOT conversion. The FWLite handles and the output buffers are set up once and reused for every output file."""
 
-    print(green('--> Output written to: %s' % (args.outfilename)))
-    print(green('--> Done with GENSIM -> ROOT conversion.'))
+    def __init__(self, heartbeatfolder=None, stager=None, ncores=1, checkpoint_interval=60.):
+        self.heartbeatfolder = heartbeatfolder
+        self.stager = stager
+        self.ncores = ncores
+        self.checkpoint_interval = checkpoint_interval
+        self.handle_gps, self.label_gps           = Handle('std::vector<reco::GenParticle>'), 'genParticles'
+        self.handle_geninfo, self.label_geninfo   = Handle('GenEventInfoProduct'), 'generator'
+        self.handle_lhe, self.label_lhe           = Handle('LHEEventProduct'), 'externalLHEProducer'
+
+        # Variables to fill into the output tree
+        self.tau1_pt     = array('f', [ 0. ])
+        self.tau1_eta    = array('f', [ 0. ])
+        self.tau1_phi    = array('f', [ 0. ])
+        self.tau1_e      = array('f', [ 0. ])
+        self.tau1_charge = array('f', [ 0. ])
+        self.n_tau       = array('f', [ 0. ])
+
+        # Per-event weight variations (scale, PDF, ...) from the LHE record, stored relative to the original LHE weight
+        self.nmax_weights = 2000
+        self.genweight   = array('f', [ 0. ])
+        self.n_weights   = array('i', [ 0 ])
+        self.weights     = array('f', [ 0. ]*self.nmax_weights)
+
+        # Hard-process kinematics, needed to reweight to other LQ masses and couplings (see reweighting.py)
+        self.hard_id1    = array('i', [ 0 ])
+        self.hard_id2    = array('i', [ 0 ])
+        self.hard_x1     = array('f', [ 0. ])
+        self.hard_x2     = array('f', [ 0. ])
+        self.hard_shat   = array('f', [ 0. ])
+        self.hard_that   = array('f', [ 0. ])
+        self.hard_uhat   = array('f', [ 0. ])
+
+        # Visible kinematics and decay modes of the two hard-process taus (see tau_decays.py), -1 if there is no such tau
+        for name in ['tau1', 'tau2']:
+            for var in ['vis_pt', 'vis_eta', 'vis_phi', 'vis_m']:
+                setattr(self, '%s_%s' % (name, var), array('f', [ 0. ]))
+            setattr(self, '%s_decaymode' % (name), array('i', [ -1 ]))
+        self.m_tautau_vis  = array('f', [ -1. ])
+        self.dr_tautau_vis = array('f', [ -1. ])
+
+        # Branches of the output tree: name, buffer and leaf list
+        self.schema = [
+            ('tau1_pt',     self.tau1_pt,     'tau1_pt/F'),
+            ('tau1_eta',    self.tau1_eta,    'tau1_eta/F'),
+            ('tau1_phi',    self.tau1_phi,    'tau1_phi/F'),
+            ('tau1_e',      self.tau1_e,      'tau1_e/F'),
+            ('tau1_charge', self.tau1_charge, 'tau1_charge/F'),
+            ('n_tau',       self.n_tau,       'n_tau/F'),
+            ('genweight',   self.genweight,   'genweight/F'),
+            ('n_weights',   self.n_weights,   'n_weights/I'),
+            ('weights',     self.weights,     'weights[n_weights]/F'),
+            ('hard_id1',    self.hard_id1,    'hard_id1/I'),
+            ('hard_id2',    self.hard_id2,    'hard_id2/I'),
+            ('hard_x1',     self.hard_x1,     'hard_x1/F'),
+            ('hard_x2',     self.hard_x2,     'hard_x2/F'),
+            ('hard_shat',   self.hard_shat,   'hard_shat/F'),
+            ('hard_that',   self.hard_that,   'hard_that/F'),
+            ('hard_uhat',   self.hard_uhat,   'hard_uhat/F'),
+        ]
+        for name in ['tau1', 'tau2']:
+            for var in ['vis_pt', 'vis_eta', 'vis_phi', 'vis_m']:
+                self.schema.append(('%s_%s' % (name, var), getattr(self, '%s_%s' % (name, var)), '%s_%s/F' % (name, var)))
+            self.schema.append(('%s_decaymode' % (name), getattr(self, '%s_decaymode' % (name)), '%s_decaymode/I' % (name)))
+        self.schema.append(('m_tautau_vis',  self.m_tautau_vis,  'm_tautau_vis/F'))
+        self.schema.append(('dr_tautau_vis', self.dr_tautau_vis, 'dr_tautau_vis/F'))
+
+        # Events are filled in blocks, the tau decays of a whole block are reconstructed at once
+        self.blocksize = 500
+
+    def book_tree(self):
+        outtree = rt.TTree('Events', 'Some variables converted from GENSIM to flat ROOT format')
+        for name, buffer, leaflist in self.schema:
+            outtree.Branch(name, buffer, leaflist)
+        return outtree
+
+    def convert(self, infilenames, outfilename, first_event=0, nevents=-1):
+        """Convert the input files (or nevents of their events from first_event on) into outfilename; with a stager, returns the handle of the background upload."""
+        print(green('--> Starting GENSIM -> ROOT conversion.'))
+
+        # Load input files
+        existing_files = get_existing_files_from_list(infilenames=infilenames)
+        events = Events(existing_files)
+        print(green('  --> Loaded %i files.' % (len(existing_files))))
+        input_events = events.size()
+        last_event = input_events if nevents < 0 else min(first_event + nevents, input_events)
+        if first_event > 0 or last_event < input_events:
+            print(green('  --> Converting events %i to %i of %i.' % (first_event, last_event, input_events)))
+
+        # Prepare output file, on local scratch when staging
+        destination = outfilename
+        if self.stager is not None:
+            outfilename = self.stager.local_filename(destination)
+        self.weight_ids = None
+        if self.ncores > 1 and last_event - first_event >= self.ncores * self.blocksize:
+            summary = self.convert_parts(existing_files, outfilename, first_event, last_event)
+        else:
+            summary = self.convert_range(events, existing_files, outfilename, first_event, last_event)
+
+        # The sidecar index is written last, its presence marks the output as complete
+        extra = {'infilenames': existing_files, 'weight_ids': self.weight_ids if self.weight_ids is not None else []}
+        if first_event > 0 or last_event < input_events:
+            extra['event_range'] = [first_event, max(last_event, first_event)]
+            extra['input_events'] = input_events
+        write_file_index(outfilename, summary, extra=extra)
+
+        print(green('--> Output written to: %s' % (outfilename)))
+        print(green('--> Done with GENSIM -> ROOT conversion.'))
+        if self.stager is not None:
+            return self.stager.publish(outfilename, destination)
+        return None
+
+    def convert_range(self, events, infilenames, outfilename, first_event, last_event):
+        """
+        Run the event loop over the events first_event <= i < last_event and write them to outfilename; returns the tree summary.
+
+        Every 'checkpoint_interval' seconds, the tree is saved to the file and the number of events in
+        it recorded in a checkpoint next to it. A job killed before it finished resumes from there.
+        """
+        checkpoint = load_checkpoint(outfilename, infilenames, first_event, last_event) if self.checkpoint_interval > 0 else None
+        resumed = self.resume_tree(outfilename, checkpoint) if checkpoint is not None else None
+        if resumed is not None:
+            file_root, outtree = resumed
+            self.weight_ids = checkpoint['weight_ids']
+            ie = checkpoint['entries']
+            print(green('  --> Resuming from the checkpoint after %i events.' % (ie)))
+        else:
+            file_root = rt.TFile(outfilename, 'RECREATE')
+            outtree = self.book_tree()
+            ie = 0
+
+        # Start the event loop!
+        heartbeat = None
+        if self.heartbeatfolder is not None:
+            jobname = os.path.splitext(os.path.basename(outfilename))[0]
+            heartbeat = Heartbeat(os.path.join(self.heartbeatfolder, jobname + '.json'), jobname=jobname, ntotal=max(last_event - first_event, 0), nresumed=ie)
+        block = []
+        last_checkpoint = time.time()
+        try:
+            for e in event_range(events, first_event + ie, last_event):
+                if ie%1000 == 0: print(blue('  --> New event no. %i' % (ie)))
+                ie += 1
+                graph, tau_hard = self.fill_event(e)
+                block.append((self.snapshot(), graph, tau_hard[:2]))
+                if len(block) >= self.blocksize:
+                    self.fill_block(block, outtree)
+                    block = []
+                    if self.checkpoint_interval > 0 and time.time() - last_checkpoint >= self.checkpoint_interval:
+                        self.write_checkpoint(outtree, infilenames, outfilename, first_event, last_event)
+                        last_checkpoint = time.time()
+                if heartbeat is not None:
+                    heartbeat.update(ie)
+            self.fill_block(block, outtree)
+        except Exception as e:
+            if heartbeat is not None:
+                heartbeat.finish(ie, status='failed', message=str(e))
+            raise
+
+        # Write the complete output tree into the output file and close it
+        file_root.cd()
+        outtree.Write()
+        summary = summarize_tree(outtree)
+        file_root.Close()
+        if os.path.isfile(checkpoint_filename(outfilename)):
+            os.remove(checkpoint_filename(outfilename))
+        if heartbeat is not None:
+            heartbeat.finish(ie)
+        return summary
+
+    def write_checkpoint(self, outtree, infilenames, outfilename, first_event, last_event):
+        # 'FlushBaskets' writes the baskets still in memory, 'SaveSelf' the tree header and the file keys, so the file is readable up to here after a crash
+        outtree.AutoSave('SaveSelf;FlushBaskets')
+        write_json_atomic(checkpoint_filename(outfilename), {
+            'infilenames': infilenames,
+            'event_range': [first_event, last_event],
+            'entries':     int(outtree.GetEntries()),
+            'weight_ids':  self.weight_ids,
+        })
+
+    def resume_tree(self, outfilename, checkpoint):
+        """Output file and tree holding the first events of a killed job up to its checkpoint, ready to fill the rest; None if that is not possible."""
+        oldfile = rt.TFile.Open(outfilename, 'READ')
+        oldtree = oldfile.Get('Events') if oldfile and not oldfile.IsZombie() else None
+        if not oldtree or oldtree.GetEntries() < checkpoint['entries']:
+            print(yellow('  --> Checkpoint of %s is not usable, starting from scratch.' % (outfilename)))
+            if oldfile:
+                oldfile.Close()
+            return None
+
+        # events after the checkpoint may or may not have made it into the file, only those up to it are taken over;
+        # they are copied into a new file that replaces the old one only once it is complete, so that a job killed
+        # in between still finds the old file and its checkpoint. The name does not end in .root, so a left-over is
+        # never taken for an output, and the next attempt overwrites it.
+        tmpname = os.path.splitext(outfilename)[0] + '.resume.tmp'
+        file_root = rt.TFile(tmpname, 'RECREATE')
+        file_root.cd()
+        outtree = oldtree.CopyTree('', '', checkpoint['entries'])
+        oldfile.Close()
+        if not outtree or outtree.GetEntries() != checkpoint['entries']:
+            print(yellow('  --> Could not copy the events up to the checkpoint of %s, starting from scratch.' % (outfilename)))
+            file_root.Close()
+            os.remove(tmpname)
+            return None
+        outtree.AutoSave('SaveSelf;FlushBaskets')
+        os.rename(tmpname, outfilename)
+        for name, buffer, leaflist in self.schema:
+            outtree.SetBranchAddress(name, buffer)
+        return file_root, outtree
+
+    def convert_parts(self, infilenames, outfilename, first_event, last_event):
+        """Convert equal shares of the events in 'ncores' processes into part files and merge them, in order, into outfilename; returns the tree summary."""
+        bounds = [first_event + i * (last_event - first_event) // self.ncores for i in range(self.ncores + 1)]
+        # the parts go to a subfolder, so that left-overs of a killed job are never taken for outputs; a rerun
+        # takes over the parts that are complete and resumes the others from their checkpoints
+        partfolder = os.path.splitext(outfilename)[0] + '_parts'
+        if not os.path.isdir(partfolder):
+            os.makedirs(partfolder)
+        partnames = [os.path.join(partfolder, os.path.splitext(os.path.basename(outfilename))[0] + '_part%i.root' % (i)) for i in range(self.ncores)]
+
+        # Each part is converted by a fresh instance of this script: this process has already opened the
+        # input files (possibly through xrootd) and loaded FWLite, neither of which survives a fork
+        processes = []
+        for i in range(self.ncores):
+            index = load_file_index(partnames[i])
+            if index is not None and index.get('event_range') == [bounds[i], bounds[i+1]]:
+                continue
+            command = [sys.executable, os.path.abspath(__file__), '-i'] + list(infilenames) + ['-o', partnames[i], '--first-event', str(bounds[i]), '-n', str(bounds[i+1] - bounds[i]), '--checkpoint-interval', str(self.checkpoint_interval)]
+            if self.heartbeatfolder is not None:
+                command += ['--heartbeatfolder', self.heartbeatfolder]
+            processes.append((partnames[i], subprocess.Popen(command, close_fds=True)))
+        print(green('  --> Converting %i of %i parts in parallel processes.' % (len(processes), self.ncores)))
+        failed = [partname for partname, p in processes if p.wait() != 0]
+        if len(failed) > 0:
+            raise RuntimeError('Conversion of %i of %i parts failed: %s' % (len(failed), self.ncores, ', '.join(failed)))
+
+        self.weight_ids = load_file_index(partnames[0])['weight_ids']
+        hadd_large(outfilename=outfilename, infilelist=partnames, force=True, notree=False)
+        file_root = rt.TFile.Open(outfilename, 'READ')
+        summary = summarize_tree(file_root.Get('Events'))
+        file_root.Close()
+        shutil.rmtree(partfolder, ignore_errors=True)
+        return summary
+
+    def snapshot(self):
+        # copy of all buffers of the current event, the weights only as far as they are filled
+        return [array(buffer.typecode, buffer[:self.n_weights[0]] if buffer is self.weights else buffer) for name, buffer, leaflist in self.schema]
+
+    def fill_block(self, block, outtree):
+        """Reconstruct the visible taus of a block of events at once, then fill the events into the tree."""
+        if len(block) == 0:
+            return
+        graph, event_offsets = GenParticleGraph.concatenate([b[1] for b in block])
+        taus = np.concatenate([[-1]] + [b[2] + event_offsets[i] for i, b in enumerate(block)]).astype(np.int64)[1:]
+        decays = visible_taus(graph, taus)
+        offsets = counts_to_offsets([len(b[2]) for b in block])
+        m_vis, dr_vis = leading_pair_mass(decays['pt'], decays['eta'], decays['phi'], decays['mass'], offsets)
+        itau = 0
+        for ievent, (snapshot, event_graph, event_taus) in enumerate(block):
+            for (name, buffer, leaflist), values in zip(self.schema, snapshot):
+                buffer[:len(values)] = values
+            for i, name in enumerate(['tau1', 'tau2']):
+                found = i < len(event_taus)
+                for var, key in [('vis_pt', 'pt'), ('vis_eta', 'eta'), ('vis_phi', 'phi'), ('vis_m', 'mass')]:
+                    getattr(self, '%s_%s' % (name, var))[0] = float(decays[key][itau + i]) if found else -1.
+                getattr(self, '%s_decaymode' % (name))[0] = int(decays['decaymode'][itau + i]) if found else -1
+            self.m_tautau_vis[0]  = m_vis[ievent]
+            self.dr_tautau_vis[0] = dr_vis[ievent]
+            itau += len(event_taus)
+
+            # Finally, store all variables in the tree for this event, on to the next one.
+            outtree.Fill()
+
+    def fill_event(self, e):
+        e.getByLabel(self.label_gps,self.handle_gps)
+        gps = self.handle_gps.product()
+
+        # Access the event weights
+        e.getByLabel(self.label_geninfo,self.handle_geninfo)
+        self.genweight[0] = self.handle_geninfo.product().weight() if self.handle_geninfo.isValid() else 1.
+        e.getByLabel(self.label_lhe,self.handle_lhe)
+        if self.handle_lhe.isValid():
+            lhe = self.handle_lhe.product()
+            lhe_weights = lhe.weights()
+            self.n_weights[0] = min(lhe_weights.size(), self.nmax_weights)
+            for iw in range(self.n_weights[0]):
+                self.weights[iw] = lhe_weights[iw].wgt / lhe.originalXWGTUP()
+            if self.weight_ids is None:
+                if lhe_weights.size() > self.nmax_weights: print(yellow('  --> Event has %i LHE weights, only storing the first %i.' % (lhe_weights.size(), self.nmax_weights)))
+                self.weight_ids = [str(lhe_weights[iw].id) for iw in range(self.n_weights[0])]
+        else:
+            self.n_weights[0] = 0
+
+        # Access the gen-particles, converted once into index arrays for all further queries
+        graph = GenParticleGraph.from_genparticles(gps)
+        tau_hard       = graph.select(pdgids=15, hard=True)
+        tau_hard       = tau_hard[np.argsort(-graph.pt[tau_hard], kind='stable')]
+        p4s            = np.stack([graph.energy, graph.px, graph.py, graph.pz], axis=1)
+
+        # Hard-process kinematics: t (u) is the momentum transfer from the incoming quark to the outgoing tau- (tau+)
+        incoming = graph.select(status=21, hard=True)
+        quarks   = incoming[(graph.pdgid[incoming] > 0) & (graph.pdgid[incoming] <= 6)]
+        taum     = tau_hard[graph.pdgid[tau_hard] == 15]
+        taup     = tau_hard[graph.pdgid[tau_hard] == -15]
+        self.hard_id1[0], self.hard_id2[0], self.hard_x1[0], self.hard_x2[0] = 0, 0, 0., 0.
+        self.hard_shat[0], self.hard_that[0], self.hard_uhat[0] = 0., 0., 0.
+        if len(incoming) == 2:
+            incoming = incoming[np.argsort(-graph.pz[incoming], kind='stable')]
+            self.hard_id1[0], self.hard_id2[0] = graph.pdgid[incoming[0]], graph.pdgid[incoming[1]]
+            self.hard_x1[0] = (graph.energy[incoming[0]] + graph.pz[incoming[0]]) / (2. * beam_energy)
+            self.hard_x2[0] = (graph.energy[incoming[1]] - graph.pz[incoming[1]]) / (2. * beam_energy)
+            self.hard_shat[0] = mass2(*(p4s[incoming[0]] + p4s[incoming[1]]))
+            if len(quarks) == 1 and len(taum) == 1 and len(taup) == 1:
+                self.hard_that[0] = mass2(*(p4s[quarks[0]] - p4s[taum[0]]))
+                self.hard_uhat[0] = mass2(*(p4s[quarks[0]] - p4s[taup[0]]))
+    
+        # Fill the individual branches of the tree
+        if len(tau_hard) > 0: 
+            pt, eta, phi, m = to_ptetaphim(*p4s[tau_hard[0]])
+            self.tau1_pt[0]   = pt
+            self.tau1_eta[0]  = eta
+            self.tau1_phi[0]  = phi
+            self.tau1_e[0]    = graph.energy[tau_hard[0]]
+            self.tau1_charge[0]= -1. if graph.pdgid[tau_hard[0]] > 0 else +1.
+
+        self.n_tau[0] = len(tau_hard)
+        return graph, tau_hard
 
 
 
@@ -99,74 +456,42 @@ def main():
 ### HELPER FUNCTIONS
 ### ================
 
+def checkpoint_filename(outfilename):
+    return os.path.splitext(outfilename)[0] + '.checkpoint.json'
+
+
+def load_checkpoint(outfilename, infilenames, first_event, last_event):
+    """Checkpoint of an earlier, killed conversion of the same events into outfilename, or None."""
+    filename = checkpoint_filename(outfilename)
+    if not os.path.isfile(filename) or not os.path.isfile(outfilename):
+        return None
+    with open(filename, 'r') as f:
+        checkpoint = json.load(f)
+    if checkpoint['infilenames'] != infilenames or checkpoint['event_range'] != [first_event, last_event]:
+        return None
+    return checkpoint
+
+
+def event_range(events, first, last):
+    """The events with index first <= i < last, read in sequence if that is all of them."""
+    if first == 0 and last >= events.size():
+        for e in events:
+            yield e
+        return
+    for i in range(first, last):
+        events.to(i)
+        yield events
+
+
 def get_existing_files_from_list(infilenames):
-    existing_files = []
-    for idx in range(len(infilenames)):
-        try:
-            f = rt.TFile.Open(infilenames[idx], 'READ')
-            f.Close()
-            existing_files.append(infilenames[idx])
-        except:
-            print(yellow('  --> In the given list of input files, this one does not exist: %s' % (infilenames[idx])))
+    # one batched stat on the storage instead of opening every file with ROOT
+    existing_files = existing_files_on_storage(infilenames)
+    for f in infilenames:
+        if f not in existing_files:
+            print(yellow('  --> In the given list of input files, this one does not exist: %s' % (f)))
     return existing_files
 
-def isFinal(p):
-    # check if one daughter is final and has same PID, then it's not final
-    return not (p.numberOfDaughters()==1 and p.daughter(0).pdgId()==p.pdgId())
-
-def printParticle(p):
-    string = "Particle with pdgId %9d: status=%2d, pt=%7.2f, eta=%5.2f, phi=%5.2f, final=%5s"%(p.pdgId(),p.status(),p.pt(),p.eta(),p.phi(),isFinal(p))
-    if p.numberOfMothers()>=2:
-        string += ", mothers %s, %s"%(p.mother(0).pdgId(),p.mother(1).pdgId())
-    elif p.numberOfMothers()==1:
-        string += ", mother %s"%(p.mother(0).pdgId())
-    if p.numberOfDaughters()>=2:
-        string += ", daughters %s, %s"%(p.daughter(0).pdgId(),p.daughter(1).pdgId())
-    elif p.numberOfDaughters()==1:
-        string += ", daughter %s"%(p.daughter(0).pdgId())
-    print string
-
-def printDecayChain(mothers):
-    for m in mothers:
-        daus   = []
-        gdaus  = []
-        ggdaus = []
-        gggdaus = []
-        print '='*10 + ' New mother:'
-        printParticle(m)
-        for d_idx in range(m.numberOfDaughters()):
-            d = m.daughter(d_idx)
-            daus.append(d)
-            # printParticle(d)
-        print '-'*10 + ' Daughters:'
-        for d in daus:
-            printParticle(d)
-            for g_idx in range(d.numberOfDaughters()):
-                g = d.daughter(g_idx)
-                gdaus.append(g)
-        print '-'*10 + ' Grand daughters:'
-        for g in gdaus:
-            printParticle(g)
-            for gg_idx in range(g.numberOfDaughters()):
-                gg = g.daughter(gg_idx)
-                ggdaus.append(gg)
-        print '-'*10 + ' Great grand daughters:'
-        for gg in ggdaus:
-            printParticle(gg)
-  
-    for g_idx in range(d.numberOfDaughters()):
-        g = d.daughter(g_idx)
-        printParticle(g)
-        for gg_idx in range(d.numberOfDaughters()):
-            gg = d.daughter(gg_idx)
-            printParticle(gg)
-
-def getFinalDaughter(p):
-    thisp = p
-    while not isFinal(thisp):
-        thisp = thisp.daughter(0)
-    return thisp
-
 
 if __name__ == '__main__':
+    args = parser.parse_args()
     main()
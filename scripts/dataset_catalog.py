@@ -0,0 +1,125 @@
+import os
+import re
+import time
+import json
+from multiprocessing.pool import ThreadPool
+
+from printing_utils import *
+from ntuple_index import write_json_atomic
+from storage import get_storage
+
+
+# The input files of each sample as found on the storage, instead of an assumed number of files:
+# one json file per sample in the catalog folder with the size, modification time and number of
+# events of every file. The sample folders are listed concurrently; on a refresh, event counts
+# are only determined again for files that are new or whose size or modification time changed.
+
+def catalog_filename(catalogfolder, sample):
+    return os.path.join(catalogfolder, '%s.json' % (sample))
+
+
+def load_catalog(catalogfolder, sample):
+    filename = catalog_filename(catalogfolder, sample)
+    if not os.path.isfile(filename):
+        return None
+    with open(filename, 'r') as f:
+        return json.load(f)
+
+
+def file_number(filename):
+    """The trailing number in a file name like 'GENSIM_12.root', used to sort files and name the outputs; None if there is none."""
+    match = re.search(r'_(\d+)\.root$', filename)
+    return int(match.group(1)) if match else None
+
+
+def sorted_files(catalog):
+    """(name, entry) for all files in a catalog, in the order of their numbers."""
+    return sorted(catalog['files'].items(), key=lambda item: (file_number(item[0]) is None, file_number(item[0]), item[0]))
+
+
+def event_ranges(nevents, events_per_job):
+    """
+    Split the events of one file into [first, last) ranges of at most events_per_job events and equal size to within one event.
+
+    Files with an unknown number of events or events_per_job <= 0 give one range (0, None) for the whole file.
+    """
+    if nevents is None or events_per_job <= 0 or nevents <= events_per_job:
+        return [(0, None)]
+    nparts = (nevents + events_per_job - 1) // events_per_job
+    return [(i * nevents // nparts, (i + 1) * nevents // nparts) for i in range(nparts)]
+
+
+def list_folder(folder):
+    """{name: {'size', 'mtime'}} for all ROOT files in a folder on any storage, with one batched stat."""
+    storage = get_storage(folder)
+    names = [f for f in storage.listdir(folder) if f.endswith('.root')]
+    stats = storage.stat([folder.rstrip('/') + '/' + f for f in names])
+    files = {}
+    for f in names:
+        st = stats[folder.rstrip('/') + '/' + f]
+        if st is not None and not st['isdir']:
+            files[f] = {'size': st['size'], 'mtime': st['mtime']}
+    return files
+
+
+def count_events(filename, treename='Events'):
+    import ROOT as rt
+    f = rt.TFile.Open(filename, 'READ')
+    if not f or f.IsZombie():
+        return None
+    tree = f.Get(treename)
+    nevents = int(tree.GetEntries()) if tree else None
+    f.Close()
+    return nevents
+
+
+def build_catalogs(folders, catalogfolder, with_events=True, ncores=8):
+    """
+    List the input folders {sample: folder} and write the catalog of each sample; returns {sample: catalog}.
+
+    Event counts of files unchanged since the last catalog are taken over from it.
+    """
+    if not os.path.isdir(catalogfolder):
+        try:
+            os.makedirs(catalogfolder)
+        except OSError:
+            pass
+    samples = sorted(folders.keys())
+    pool = ThreadPool(max(1, min(ncores, len(samples))))
+    listings = dict(zip(samples, pool.map(list_folder, [folders[s] for s in samples])))
+    pool.close()
+
+    catalogs = {}
+    tocount = []
+    for sample in samples:
+        previous = load_catalog(catalogfolder, sample)
+        previous_files = previous['files'] if previous is not None and previous['folder'] == folders[sample] else {}
+        files = listings[sample]
+        for f, entry in files.items():
+            old = previous_files.get(f)
+            if old is not None and old['size'] == entry['size'] and old['mtime'] == entry['mtime'] and old.get('events') is not None:
+                entry['events'] = old['events']
+            elif with_events:
+                tocount.append((sample, f))
+        catalogs[sample] = {'folder': folders[sample], 'updated': time.time(), 'files': files}
+
+    # opening the files for the event counts is the slow part; ROOT I/O runs in separate processes
+    if len(tocount) > 0:
+        print(blue('  --> Counting the events in %i new or changed files' % (len(tocount))))
+        from multiprocessing import Pool
+        pool = Pool(processes=max(1, min(ncores, len(tocount))))
+        nevents = pool.map(count_events, [folders[s].rstrip('/') + '/' + f for s, f in tocount])
+        pool.close()
+        pool.join()
+        for (sample, f), n in zip(tocount, nevents):
+            catalogs[sample]['files'][f]['events'] = n
+            if n is None:
+                print(yellow('  --> Could not read the number of events of %s' % (folders[sample].rstrip('/') + '/' + f)))
+
+    for sample in samples:
+        files = catalogs[sample]['files']
+        catalogs[sample]['nfiles'] = len(files)
+        catalogs[sample]['size'] = sum(e['size'] for e in files.values())
+        catalogs[sample]['events'] = sum(e.get('events') or 0 for e in files.values())
+        write_json_atomic(catalog_filename(catalogfolder, sample), catalogs[sample])
+    return catalogs
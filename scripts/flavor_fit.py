@@ -0,0 +1,221 @@
+import numpy as np
+from multiprocessing import Pool
+
+from histograms import HistHolder
+
+
+# Binned Poisson likelihood for the LQ flavor fit, built from HistHolder templates.
+#
+# The expected yield in bin i is
+#     nu_i(poi, theta) = sum_p  T_pi(poi) * prod_j kappa_pj^theta_j * (1 + sum_j r_pji(theta_j))
+# with T_p the template of process p (the signal one depending on the LQ coupling, the parameter
+# of interest), kappa_pj the log-normal normalization uncertainties and r_pji the relative
+# shape variations, interpolated linearly between down (theta = -1), nominal and up (theta = +1).
+# All nuisance parameters theta_j have unit Gaussian constraints.
+#
+# Everything is evaluated for a whole batch of parameter points at once: parameter arrays have
+# shape (npoints, 1 + nnuisances), the first column being the parameter of interest. The observed
+# counts can be given per point as well, shape (npoints, nbins), to fit many pseudo-datasets at once.
+
+class CouplingScaledSignal():
+    """Signal yields s(lambda) = s_ref * (lambda / lambda_ref)^power; power = 4 for pure t-channel LQ exchange."""
+
+    def __init__(self, template, coupling_ref, power=4):
+        self.template = np.asarray(template, dtype=np.float64)
+        self.coupling_ref = float(coupling_ref)
+        self.power = power
+
+    def expected(self, poi):
+        return ((np.asarray(poi) / self.coupling_ref)**self.power)[:, np.newaxis] * self.template[np.newaxis, :]
+
+    def derivative(self, poi):
+        poi = np.asarray(poi)
+        return (self.power * poi**(self.power - 1) / self.coupling_ref**self.power)[:, np.newaxis] * self.template[np.newaxis, :]
+
+
+class Process():
+    """One background process: its template and its effects on the nuisance parameters."""
+
+    def __init__(self, name, template, lnN=None, shapes=None):
+        self.name = name
+        self.template = np.asarray(template, dtype=np.float64)
+        self.lnN = lnN if lnN is not None else {}          # {nuisance: kappa}
+        self.shapes = shapes if shapes is not None else {}  # {nuisance: (up template, down template)}
+
+
+class BinnedLikelihood():
+    def __init__(self, data, signal, backgrounds, signal_lnN=None, signal_shapes=None):
+        self.data = np.asarray(data, dtype=np.float64)
+        self.signal = signal
+        self.backgrounds = backgrounds
+        signal_process = Process('signal', signal.template, lnN=signal_lnN, shapes=signal_shapes)
+        processes = [signal_process] + list(backgrounds)
+
+        nuisances = []
+        for p in processes:
+            for name in list(p.lnN.keys()) + list(p.shapes.keys()):
+                if name not in nuisances:
+                    nuisances.append(name)
+        self.nuisances = nuisances
+        nproc, nnuis, nbins = len(processes), len(nuisances), len(self.data)
+
+        # Dense arrays of all effects, zero where a process is not affected by a nuisance
+        self.bkg_templates = np.array([p.template for p in backgrounds]).reshape(-1, nbins)
+        self.lnk = np.zeros((nproc, nnuis))
+        self.rel_up = np.zeros((nproc, nnuis, nbins))
+        self.rel_down = np.zeros((nproc, nnuis, nbins))
+        for ip, p in enumerate(processes):
+            for name, kappa in p.lnN.items():
+                self.lnk[ip, nuisances.index(name)] = np.log(kappa)
+            for name, (up, down) in p.shapes.items():
+                nominal = np.where(p.template > 0., p.template, 1.)
+                self.rel_up[ip, nuisances.index(name)] = np.where(p.template > 0., (np.asarray(up) - p.template) / nominal, 0.)
+                self.rel_down[ip, nuisances.index(name)] = np.where(p.template > 0., (p.template - np.asarray(down)) / nominal, 0.)
+
+    @property
+    def nparams(self):
+        return 1 + len(self.nuisances)
+
+    def parameter_names(self):
+        return ['poi'] + self.nuisances
+
+    def components(self, params):
+        """Per-process templates (npoints, nproc, nbins), normalization factors and shape factors."""
+        params = np.atleast_2d(params)
+        poi, theta = params[:, 0], params[:, 1:]
+        npoints = len(poi)
+        templates = np.concatenate([self.signal.expected(poi)[:, np.newaxis, :], np.broadcast_to(self.bkg_templates, (npoints,) + self.bkg_templates.shape)], axis=1)
+        norm = np.exp(np.dot(theta, self.lnk.T))
+        shape = 1. + np.einsum('aj,pjb->apb', np.maximum(theta, 0.), self.rel_up) + np.einsum('aj,pjb->apb', np.minimum(theta, 0.), self.rel_down)
+        return templates, norm, shape
+
+    def expected(self, params):
+        templates, norm, shape = self.components(params)
+        return np.maximum(np.einsum('apb,ap->ab', templates * shape, norm), 1E-12)
+
+    def nll(self, params, data=None):
+        """Negative log-likelihood (up to a constant) for each parameter point."""
+        params = np.atleast_2d(params)
+        data = self.data if data is None else data
+        nu = self.expected(params)
+        return np.sum(nu - data * np.log(nu), axis=1) + 0.5 * np.sum(params[:, 1:]**2, axis=1)
+
+    def gradient_and_fisher(self, params, data=None):
+        """Gradient of the NLL and the expected information matrix (plus constraints), batched."""
+        params = np.atleast_2d(params)
+        data = self.data if data is None else data
+        poi, theta = params[:, 0], params[:, 1:]
+        templates, norm, shape = self.components(params)
+        nu = np.maximum(np.einsum('apb,ap->ab', templates * shape, norm), 1E-12)
+
+        # Jacobian of nu with respect to all parameters, shape (npoints, nparams, nbins)
+        jac = np.zeros((len(poi), self.nparams, len(self.data)))
+        jac[:, 0, :] = self.signal.derivative(poi) * (norm[:, 0:1] * shape[:, 0, :])
+        rel = np.where(theta[:, np.newaxis, :, np.newaxis] > 0., self.rel_up[np.newaxis], self.rel_down[np.newaxis])
+        weighted = templates * norm[:, :, np.newaxis]
+        jac[:, 1:, :] = np.einsum('apb,pj->ajb', weighted * shape, self.lnk) + np.einsum('apb,apjb->ajb', weighted, rel)
+
+        residual = 1. - data / nu
+        grad = np.einsum('akb,ab->ak', jac, residual)
+        grad[:, 1:] += theta
+        fisher = np.einsum('akb,alb,ab->akl', jac, jac, 1. / nu)
+        fisher[:, 1:, 1:] += np.eye(len(self.nuisances))
+        return grad, fisher
+
+    def minimize(self, start, fix_poi=False, data=None, maxiter=100, tolerance=1E-6):
+        """
+        Minimize the NLL for a batch of starting points simultaneously, by Fisher scoring with step halving.
+
+        With fix_poi=True, the parameter of interest stays at its starting value (profiling). data
+        optionally gives the observed counts per starting point, shape (npoints, nbins).
+        Returns the best-fit parameters and NLL values, one per starting point.
+        """
+        params = np.array(np.atleast_2d(start), dtype=np.float64)
+        data = np.broadcast_to(self.data if data is None else np.asarray(data, dtype=np.float64), (len(params), len(self.data)))
+        free = np.ones(self.nparams, dtype=bool)
+        if fix_poi:
+            free[0] = False
+        nll = self.nll(params, data=data)
+        converged = np.zeros(len(params), dtype=bool)
+        for iteration in range(maxiter):
+            active = ~converged
+            if not np.any(active):
+                break
+            grad, fisher = self.gradient_and_fisher(params[active], data=data[active])
+            grad, fisher = grad[:, free], fisher[:, free][:, :, free]
+            fisher += 1E-9 * np.eye(np.count_nonzero(free))
+            step = np.zeros((np.count_nonzero(active), self.nparams))
+            step[:, free] = -np.linalg.solve(fisher, grad[:, :, np.newaxis])[:, :, 0]
+
+            # Halve the step for points where the NLL does not decrease
+            scale = np.ones(len(step))
+            nll_active = nll[active]
+            for ihalf in range(20):
+                trial = params[active] + scale[:, np.newaxis] * step
+                trial[:, 0] = np.abs(trial[:, 0])
+                nll_trial = self.nll(trial, data=data[active])
+                worse = nll_trial > nll_active + 1E-12
+                if not np.any(worse):
+                    break
+                scale[worse] *= 0.5
+            accept = ~worse
+            idx = np.where(active)[0]
+            params[idx[accept]] = trial[accept]
+            done = (np.max(np.abs(scale[:, np.newaxis] * step), axis=1) < tolerance) | (np.abs(nll_active - nll_trial) < 1E-9 * np.maximum(1., np.abs(nll_active)))
+            nll[idx[accept]] = nll_trial[accept]
+            converged[idx] = done | ~accept
+        return params, nll
+
+    def fit(self, poi_starts=(0.5, 1., 2.)):
+        """Global fit, starting from several values of the parameter of interest; returns the best one."""
+        params, nll = self.fit_datasets(self.data[np.newaxis, :], poi_starts=poi_starts)
+        return params[0], nll[0]
+
+    def fit_datasets(self, datasets, poi_starts=(0.5, 1., 2.)):
+        """Global fits of many datasets (ndatasets, nbins) at once; returns the best parameters and NLL per dataset."""
+        datasets = np.asarray(datasets, dtype=np.float64)
+        nstarts = len(poi_starts)
+        start = np.zeros((len(datasets) * nstarts, self.nparams))
+        start[:, 0] = np.tile(poi_starts, len(datasets))
+        params, nll = self.minimize(start, data=np.repeat(datasets, nstarts, axis=0))
+        params, nll = params.reshape(len(datasets), nstarts, -1), nll.reshape(len(datasets), nstarts)
+        ibest = np.argmin(nll, axis=1)
+        rows = np.arange(len(datasets))
+        return params[rows, ibest], nll[rows, ibest]
+
+    def uncertainties(self, params):
+        """Parameter uncertainties from the inverse of the information matrix at the given points."""
+        grad, fisher = self.gradient_and_fisher(params)
+        fisher += 1E-12 * np.eye(self.nparams)
+        return np.sqrt(np.abs(np.diagonal(np.linalg.inv(fisher), axis1=1, axis2=2)))
+
+    def profile(self, poi_values, data=None):
+        """Profiled NLL at the given values of the parameter of interest, all in one batch (optionally with one dataset per value)."""
+        start = np.zeros((len(poi_values), self.nparams))
+        start[:, 0] = poi_values
+        params, nll = self.minimize(start, fix_poi=True, data=data)
+        return nll, params
+
+
+def profile_chunk(arguments):
+    likelihood, poi_values = arguments
+    return likelihood.profile(poi_values)
+
+
+def profile_scan(likelihood, poi_values, ncores=1):
+    """Profile-likelihood scan over the parameter of interest, split in one batch per core."""
+    poi_values = np.asarray(poi_values, dtype=np.float64)
+    if ncores <= 1:
+        return likelihood.profile(poi_values)
+    chunks = [c for c in np.array_split(poi_values, ncores) if len(c) > 0]
+    pool = Pool(processes=ncores)
+    results = pool.map(profile_chunk, [(likelihood, c) for c in chunks])
+    pool.close()
+    pool.join()
+    return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+
+def load_template(filename, histnames, variation=0):
+    """Bin contents (without flow bins) of one or more histograms in a HistHolder file, concatenated into one channel vector."""
+    holder = HistHolder.load(filename)
+    return np.concatenate([holder.histdict[name].variation(variation).values().ravel() for name in histnames])
@@ -0,0 +1,79 @@
+import os
+
+from ntuple_index import load_file_index
+from ntuple_io import read_columns, file_signature
+
+
+# Columns added to converted ntuples after the conversion live in friend trees. The friend with
+# name 'xyz' of 'folder/ntuple_1.root' is 'folder/friends/ntuple_1_xyz.root', with one tree
+# 'Friends' holding the new columns in the same entry order as 'Events'. Its sidecar index
+# records the size and modification time of the ntuple it was computed from, so friends of an
+# ntuple that was reconverted in the meantime are ignored.
+
+friend_treename = 'Friends'
+
+
+def friend_folder(filename):
+    return os.path.join(os.path.dirname(filename), 'friends')
+
+
+def friend_filename(filename, name):
+    base = os.path.splitext(os.path.basename(filename))[0]
+    return os.path.join(friend_folder(filename), '%s_%s.root' % (base, name))
+
+
+def is_valid_friend(filename, name):
+    index = load_file_index(friend_filename(filename, name))
+    if index is None or not os.path.isfile(filename):
+        return False
+    return index.get('augmentation') == name and index.get('source_signature') == file_signature(filename)
+
+
+def valid_friends(filename):
+    """{name: list of columns} of all valid friends of one ntuple."""
+    folder = friend_folder(filename)
+    if not os.path.isdir(folder):
+        return {}
+    base = os.path.splitext(os.path.basename(filename))[0] + '_'
+    friends = {}
+    for f in sorted(os.listdir(folder)):
+        if not (f.startswith(base) and f.endswith('.root')):
+            continue
+        name = f[len(base):-len('.root')]
+        if is_valid_friend(filename, name):
+            friends[name] = sorted(load_file_index(friend_filename(filename, name))['branches'].keys())
+    return friends
+
+
+def common_friends(filenames):
+    """{name: list of columns} of the friends that are valid for all of the given ntuples."""
+    if len(filenames) == 0:
+        return {}
+    friends = valid_friends(filenames[0])
+    for filename in filenames[1:]:
+        others = valid_friends(filename)
+        friends = dict((name, columns) for name, columns in friends.items() if name in others)
+    return friends
+
+
+def signature_with_friends(filename):
+    """Size and modification time of an ntuple and of all its valid friends."""
+    signature = file_signature(filename)
+    friends = valid_friends(filename)
+    if len(friends) > 0:
+        signature['friends'] = dict((name, file_signature(friend_filename(filename, name))) for name in friends)
+    return signature
+
+
+def read_columns_with_friends(filename, columns, treename='Events'):
+    """Like ntuple_io.read_columns, but columns that are not in the ntuple itself are taken from its friends."""
+    friends = valid_friends(filename)
+    from_friend = {}
+    for name, friend_columns in friends.items():
+        for c in friend_columns:
+            if c in columns:
+                from_friend[c] = name
+    result = read_columns(filename, [c for c in columns if c not in from_friend], treename=treename) if len(from_friend) < len(columns) else {}
+    for name in set(from_friend.values()):
+        result.update(read_columns(friend_filename(filename, name), [c for c in columns if from_friend.get(c) == name], treename=friend_treename))
+    return result
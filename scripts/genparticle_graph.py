@@ -0,0 +1,241 @@
+import numpy as np
+
+
+# The gen-particle record of one event as flat arrays, built with a single pass over the
+# reco::GenParticle collection. Mothers and daughters are stored as indices into the collection
+# in CSR layout: the daughters of particle i are daughters[daughter_offsets[i]:daughter_offsets[i+1]],
+# likewise for the mothers. All queries afterwards are numpy operations on these arrays, and
+# graph walks (last copies, descendants, ancestors) advance one generation for all particles at
+# once, so their cost grows with the depth of the decay chain, not with the number of particles.
+# Graphs of several events can be concatenated into one, to run these queries for a whole block
+# of events at once.
+
+# C++ helper filling the flat arrays from the collection, declared on first use
+genparticle_graph_code = """
+#include "DataFormats/HepMCCandidate/interface/GenParticle.h"
+namespace genparticle_graph {
+    struct Arrays {
+        std::vector<int> pdgid, status, charge, is_hard, mother_offsets, mothers, daughter_offsets, daughters;
+        std::vector<double> px, py, pz, energy;
+    };
+    void fill(const std::vector<reco::GenParticle>& gps, Arrays& a) {
+        std::vector<int>* ints[] = {&a.pdgid, &a.status, &a.charge, &a.is_hard, &a.mother_offsets, &a.mothers, &a.daughter_offsets, &a.daughters};
+        for (auto v : ints) v->clear();
+        std::vector<double>* doubles[] = {&a.px, &a.py, &a.pz, &a.energy};
+        for (auto v : doubles) v->clear();
+        a.mother_offsets.push_back(0);
+        a.daughter_offsets.push_back(0);
+        for (const reco::GenParticle& p : gps) {
+            a.pdgid.push_back(p.pdgId());
+            a.status.push_back(p.status());
+            a.charge.push_back(p.charge());
+            a.is_hard.push_back(p.isHardProcess());
+            a.px.push_back(p.px());
+            a.py.push_back(p.py());
+            a.pz.push_back(p.pz());
+            a.energy.push_back(p.energy());
+            for (size_t i = 0; i < p.numberOfMothers(); i++) a.mothers.push_back(p.motherRef(i).key());
+            for (size_t i = 0; i < p.numberOfDaughters(); i++) a.daughters.push_back(p.daughterRef(i).key());
+            a.mother_offsets.push_back(a.mothers.size());
+            a.daughter_offsets.push_back(a.daughters.size());
+        }
+    }
+}
+"""
+
+array_fields = [
+    ('pdgid', np.int32), ('status', np.int32), ('charge', np.int32), ('is_hard', np.int32),
+    ('px', np.float64), ('py', np.float64), ('pz', np.float64), ('energy', np.float64),
+    ('mother_offsets', np.int64), ('mothers', np.int64), ('daughter_offsets', np.int64), ('daughters', np.int64),
+]
+
+genparticle_arrays_instance = []
+
+def genparticle_arrays():
+    """The C++ array holder, reused for every event."""
+    if len(genparticle_arrays_instance) == 0:
+        import ROOT as rt
+        rt.gInterpreter.Declare(genparticle_graph_code)
+        genparticle_arrays_instance.append(rt.genparticle_graph.Arrays())
+    return genparticle_arrays_instance[0]
+
+
+def vector_to_array(vector, dtype):
+    # copy through the buffer of the std::vector, like the TTree::Draw buffers in ntuple_io.draw_column
+    n = vector.size()
+    if n == 0:
+        return np.zeros(0, dtype=dtype)
+    buf = vector.data()
+    buf.SetSize(n)
+    return np.array(buf, dtype=dtype)
+
+
+
+class GenParticleGraph():
+    def __init__(self, pdgid, status, is_hard, px, py, pz, energy, mother_offsets, mothers, daughter_offsets, daughters, charge=None):
+        self.pdgid = np.asarray(pdgid, dtype=np.int32)
+        self.status = np.asarray(status, dtype=np.int32)
+        self.charge = np.zeros(len(self.pdgid), dtype=np.int32) if charge is None else np.asarray(charge, dtype=np.int32)
+        self.is_hard = np.asarray(is_hard, dtype=bool)
+        self.px = np.asarray(px, dtype=np.float64)
+        self.py = np.asarray(py, dtype=np.float64)
+        self.pz = np.asarray(pz, dtype=np.float64)
+        self.energy = np.asarray(energy, dtype=np.float64)
+        self.mother_offsets = np.asarray(mother_offsets, dtype=np.int64)
+        self.mothers = np.asarray(mothers, dtype=np.int64)
+        self.daughter_offsets = np.asarray(daughter_offsets, dtype=np.int64)
+        self.daughters = np.asarray(daughters, dtype=np.int64)
+
+        # the particle each entry of mothers (daughters) belongs to
+        self.mother_owner = np.repeat(np.arange(len(self)), np.diff(self.mother_offsets))
+        self.daughter_owner = np.repeat(np.arange(len(self)), np.diff(self.daughter_offsets))
+        self._next_copy = None
+
+    @classmethod
+    def from_genparticles(cls, gps):
+        """Build from a std::vector<reco::GenParticle>, using the reference keys for mothers and daughters."""
+        # the flat arrays are filled in C++, one call per event instead of a dozen PyROOT calls per particle
+        import ROOT as rt
+        arrays = genparticle_arrays()
+        rt.genparticle_graph.fill(gps, arrays)
+        fields = dict((name, vector_to_array(getattr(arrays, name), dtype)) for name, dtype in array_fields)
+        fields['is_hard'] = fields['is_hard'].astype(bool)
+        return cls(**fields)
+
+    @classmethod
+    def concatenate(cls, graphs):
+        """One graph holding the particles of several events; returns it and the index of the first particle of each event."""
+        nparticles = np.array([len(g) for g in graphs], dtype=np.int64)
+        event_offsets = np.concatenate([[0], np.cumsum(nparticles)])
+        fields = {}
+        for name in ['pdgid', 'status', 'charge', 'is_hard', 'px', 'py', 'pz', 'energy']:
+            fields[name] = np.concatenate([getattr(g, name) for g in graphs]) if len(graphs) > 0 else []
+        for links, offsets in [('mothers', 'mother_offsets'), ('daughters', 'daughter_offsets')]:
+            nlinks = np.array([len(getattr(g, links)) for g in graphs], dtype=np.int64)
+            link_starts = np.concatenate([[0], np.cumsum(nlinks)])
+            fields[links] = np.concatenate([[]] + [getattr(g, links) + event_offsets[i] for i, g in enumerate(graphs)]).astype(np.int64)
+            fields[offsets] = np.concatenate([[0]] + [getattr(g, offsets)[1:] + link_starts[i] for i, g in enumerate(graphs)]).astype(np.int64)
+        return cls(**fields), event_offsets[:-1]
+
+    def __len__(self):
+        return len(self.pdgid)
+
+    @property
+    def pt(self):
+        return np.hypot(self.px, self.py)
+
+    @property
+    def phi(self):
+        return np.arctan2(self.py, self.px)
+
+    @property
+    def eta(self):
+        return np.arcsinh(self.pz / np.where(self.pt > 0., self.pt, 1E-12))
+
+    @property
+    def mass(self):
+        return np.sqrt(np.maximum(self.energy**2 - self.px**2 - self.py**2 - self.pz**2, 0.))
+
+    def n_daughters(self):
+        return np.diff(self.daughter_offsets)
+
+    def n_mothers(self):
+        return np.diff(self.mother_offsets)
+
+    def select(self, pdgids=None, status=None, hard=None):
+        """Indices of the particles with |pdgId| in pdgids, the given status and hard-process flag (None: any)."""
+        mask = np.ones(len(self), dtype=bool)
+        if pdgids is not None:
+            mask &= np.isin(np.abs(self.pdgid), np.abs(np.atleast_1d(pdgids)))
+        if status is not None:
+            mask &= self.status == status
+        if hard is not None:
+            mask &= self.is_hard == hard
+        return np.nonzero(mask)[0]
+
+    def next_copy(self):
+        """For each particle its only daughter if that has the same pdgId (its next copy in the record), -1 otherwise."""
+        if self._next_copy is None:
+            # same rule as isFinal() of the old converter: exactly one daughter, with the same pdgId
+            self._next_copy = np.full(len(self), -1, dtype=np.int64)
+            single = np.nonzero(self.n_daughters() == 1)[0]
+            daughter = self.daughters[self.daughter_offsets[single]]
+            same = self.pdgid[daughter] == self.pdgid[single]
+            self._next_copy[single[same]] = daughter[same]
+        return self._next_copy
+
+    def is_last_copy(self):
+        return self.next_copy() < 0
+
+    def last_copy(self, indices):
+        """Index of the last copy of each given particle, following daughters with the same pdgId."""
+        indices = np.array(indices, dtype=np.int64)
+        next_copy = self.next_copy()
+        for istep in range(len(self)):
+            following = next_copy[indices]
+            moving = following >= 0
+            if not np.any(moving):
+                break
+            indices[moving] = following[moving]
+        return indices
+
+    def descendants_mask(self, seeds):
+        """Mask of all particles descending from any of the seed particles (given as indices or mask), the seeds excluded."""
+        return self._propagate(seeds, self.daughter_owner, self.daughters)
+
+    def ancestors_mask(self, seeds):
+        """Mask of all ancestors of any of the seed particles (given as indices or mask), the seeds excluded."""
+        return self._propagate(seeds, self.mother_owner, self.mothers)
+
+    def descendants(self, index):
+        return np.nonzero(self.descendants_mask([index]))[0]
+
+    def ancestors(self, index):
+        return np.nonzero(self.ancestors_mask([index]))[0]
+
+    def has_ancestor(self, ancestor_pdgids, indices=None):
+        """For each particle (or each of the given ones), whether one of its ancestors has |pdgId| in ancestor_pdgids."""
+        # walk down from all particles of the ancestor type at once instead of up from every particle
+        mask = self.descendants_mask(self.select(pdgids=ancestor_pdgids))
+        return mask if indices is None else mask[indices]
+
+    def stable_descendants(self, index):
+        """Indices of the final-state (status 1) descendants of one particle."""
+        return np.nonzero(self.descendants_mask([index]) & (self.status == 1))[0]
+
+    def _propagate(self, seeds, owner, links):
+        seeds = np.asarray(seeds)
+        frontier = np.zeros(len(self), dtype=bool)
+        if seeds.dtype == bool:
+            frontier |= seeds
+        else:
+            frontier[seeds.astype(np.int64)] = True
+        reached = np.zeros(len(self), dtype=bool)
+        while np.any(frontier):
+            step = np.zeros(len(self), dtype=bool)
+            step[links[frontier[owner]]] = True
+            frontier = step & ~reached
+            reached |= step
+        return reached
+
+    def format_particle(self, i):
+        string = 'Particle %4i with pdgId %9d: status=%2d, pt=%7.2f, eta=%5.2f, phi=%5.2f, last copy=%5s' % (i, self.pdgid[i], self.status[i], self.pt[i], self.eta[i], self.phi[i], self.is_last_copy()[i])
+        mothers = self.mothers[self.mother_offsets[i]:self.mother_offsets[i+1]]
+        daughters = self.daughters[self.daughter_offsets[i]:self.daughter_offsets[i+1]]
+        if len(mothers) > 0:
+            string += ', mothers %s' % (', '.join(['%i' % (self.pdgid[m]) for m in mothers]))
+        if len(daughters) > 0:
+            string += ', daughters %s' % (', '.join(['%i' % (self.pdgid[d]) for d in daughters]))
+        return string
+
+    def format_decay_chain(self, index, maxdepth=4):
+        """Indented decay tree below one particle, for debugging."""
+        lines = []
+        stack = [(index, 0)]
+        while len(stack) > 0:
+            i, depth = stack.pop()
+            lines.append('  ' * depth + self.format_particle(i))
+            if depth < maxdepth:
+                daughters = self.daughters[self.daughter_offsets[i]:self.daughter_offsets[i+1]]
+                stack.extend([(d, depth + 1) for d in daughters[::-1]])
+        return '\n'.join(lines)
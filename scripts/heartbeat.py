@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import socket
+
+from ntuple_index import write_json_atomic
+
+
+# Progress of running jobs, as small json files that are rewritten every few seconds: events
+# done, rate, estimated time left, memory. The files of one sample live in one folder, so a
+# monitor can aggregate all jobs by reading them, without looking into the batch-system logs.
+#
+# A job whose file was not updated for 'stale_after' seconds is reported as stale (crashed,
+# killed or stuck on I/O); a running job much slower than the others of its sample is a straggler.
+
+stale_after = 300.
+
+
+def memory_mb():
+    """Resident memory of this process in MB (peak memory where /proc is not available)."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return float(line.split()[1]) / 1024.
+    except IOError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+class Heartbeat():
+    def __init__(self, filename, jobname, ntotal=None, interval=10., nresumed=0):
+        """nresumed: events already done before this start, e.g. when resuming from a checkpoint; they do not count for the rate."""
+        self.filename = filename
+        self.interval = interval
+        self.started = time.time()
+        self.nresumed = nresumed
+        self.last_write = 0.
+        self.last_events = nresumed
+        self.last_time = self.started
+        folder = os.path.dirname(filename)
+        if folder != '' and not os.path.exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass
+        self.content = {
+            'job':      jobname,
+            'host':     socket.gethostname(),
+            'pid':      os.getpid(),
+            'batchjob': '%s_%s' % (os.environ.get('SLURM_ARRAY_JOB_ID', os.environ.get('SLURM_JOB_ID', '')), os.environ.get('SLURM_ARRAY_TASK_ID', '')),
+            'status':   'running',
+            'started':  self.started,
+            'ntotal':   ntotal,
+            'resumed':  nresumed,
+            'events':   nresumed,
+        }
+        self.write()
+
+    def update(self, nevents, force=False):
+        """Record the number of events done; the file is only rewritten every 'interval' seconds."""
+        now = time.time()
+        if not force and now - self.last_write < self.interval:
+            return
+        elapsed = max(now - self.started, 1E-6)
+        recent = max(now - self.last_time, 1E-6)
+        self.content['events'] = nevents
+        self.content['rate'] = (nevents - self.nresumed) / elapsed
+        self.content['recent_rate'] = (nevents - self.last_events) / recent
+        if self.content['ntotal'] is not None and self.content['rate'] > 0.:
+            self.content['eta'] = max(self.content['ntotal'] - nevents, 0) / self.content['rate']
+        self.last_events, self.last_time = nevents, now
+        self.write()
+
+    def finish(self, nevents, status='done', message=None):
+        self.update(nevents, force=True)
+        self.content['status'] = status
+        self.content['eta'] = 0. if status == 'done' else None
+        if message is not None:
+            self.content['message'] = message
+        self.write()
+
+    def write(self):
+        now = time.time()
+        self.content['updated'] = now
+        self.content['memory_mb'] = memory_mb()
+        write_json_atomic(self.filename, self.content)
+        self.last_write = now
+
+
+
+def load_heartbeats(folder):
+    """{sample: [heartbeat, ...]} for all heartbeat files in the subfolders (one per sample) of folder."""
+    heartbeats = {}
+    if not os.path.isdir(folder):
+        return heartbeats
+    for sample in sorted(os.listdir(folder)):
+        samplefolder = os.path.join(folder, sample)
+        if not os.path.isdir(samplefolder):
+            continue
+        heartbeats[sample] = []
+        for f in sorted(os.listdir(samplefolder)):
+            if not f.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(samplefolder, f)) as fp:
+                    content = json.load(fp)
+            except ValueError:
+                continue
+            content['file'] = f
+            heartbeats[sample].append(content)
+    return heartbeats
+
+
+def summarize_heartbeats(heartbeats, now=None, straggler_fraction=0.5):
+    """Per-sample totals and the list of stale and straggling jobs."""
+    now = time.time() if now is None else now
+    summary = {}
+    for sample, beats in heartbeats.items():
+        running = [b for b in beats if b['status'] == 'running' and now - b['updated'] < stale_after]
+        stale = [b for b in beats if b['status'] == 'running' and now - b['updated'] >= stale_after]
+        # jobs in their first seconds have no rate yet, they are neither counted in the median nor stragglers
+        measured = [b for b in running if b.get('recent_rate') is not None]
+        rates = sorted([b['recent_rate'] for b in measured])
+        median_rate = rates[len(rates) // 2] if len(rates) > 0 else 0.
+        stragglers = [b for b in measured if len(measured) > 2 and b['recent_rate'] < straggler_fraction * median_rate]
+        etas = [b['eta'] for b in running if b.get('eta') is not None]
+        summary[sample] = {
+            'njobs':       len(beats),
+            'running':     len(running),
+            'done':        len([b for b in beats if b['status'] == 'done']),
+            'failed':      len([b for b in beats if b['status'] == 'failed']),
+            'stale':       stale,
+            'stragglers':  stragglers,
+            'events':      sum(b['events'] for b in beats),
+            'rate':        sum(rates),
+            'median_rate': median_rate,
+            'eta':         max(etas) if len(etas) > 0 else None,
+            'memory_mb':   max([b.get('memory_mb', 0.) for b in running] + [0.]),
+        }
+    return summary
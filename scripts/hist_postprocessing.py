@@ -0,0 +1,97 @@
+import numpy as np
+
+from histograms import Hist, Axis
+
+
+# Post-processing of histograms.Hist objects. All functions work on the full arrays of bin
+# contents at once (for all variations, if any) and return a new histogram, the input is never modified.
+
+def scale(hist, factor):
+    """Multiply contents by factor, errors scale accordingly."""
+    h = hist.clone()
+    h.sumw *= factor
+    h.sumw2 *= factor * factor
+    return h
+
+
+def scale_to_lumi(hist, cross_section, lumi, ntotal):
+    """Scale a histogram filled with unit weights from ntotal generated events to cross_section (pb) * lumi (1/pb)."""
+    return scale(hist, cross_section * lumi / float(ntotal))
+
+
+def normalize_to_bin_width(hist):
+    """Divide contents and errors by the bin width (bin area for 2D), flow bins stay as they are."""
+    h = hist.clone()
+    widths = np.ones(h.sumw.shape[-h.ndim:])
+    inner = (slice(1, -1),) * h.ndim
+    if h.ndim == 1:
+        widths[inner] = h.xaxis.widths
+    else:
+        widths[inner] = np.outer(h.xaxis.widths, h.yaxis.widths)
+    h.sumw /= widths
+    h.sumw2 /= widths * widths
+    return h
+
+
+def fold_overflow(hist):
+    """Add underflow to the first and overflow to the last bin along every axis and empty the flow bins."""
+    h = hist.clone()
+    for axis in range(h.ndim):
+        for arr in [h.sumw, h.sumw2]:
+            arr_moved = np.moveaxis(arr, arr.ndim - h.ndim + axis, 0)
+            arr_moved[1] += arr_moved[0]
+            arr_moved[-2] += arr_moved[-1]
+            arr_moved[0] = 0.
+            arr_moved[-1] = 0.
+    return h
+
+
+def rebin(hist, xedges=None, yedges=None):
+    """
+    Merge bins into the new bin edges, which must be a subset of the existing ones.
+
+    Contents outside of the new range go to the flow bins.
+    """
+    h = hist.clone()
+    for axis, newedges in enumerate([xedges, yedges]):
+        if newedges is None:
+            continue
+        if axis >= h.ndim:
+            raise ValueError('Cannot rebin the y axis of a 1D histogram.')
+        h = rebin_axis(h, axis, np.asarray(newedges, dtype=np.float64))
+    return h
+
+
+def rebin_axis(hist, axis, newedges):
+    oldaxis = hist.axes[axis]
+    positions = np.searchsorted(oldaxis.edges, newedges)
+    if np.any(positions >= len(oldaxis.edges)) or not np.allclose(oldaxis.edges[positions], newedges, rtol=0., atol=1E-9 * (oldaxis.up - oldaxis.low)):
+        raise ValueError('New bin edges of histogram %s must be a subset of the old ones.' % (hist.name))
+
+    # Index of the first old bin (flow bins included) going into each new bin, including new flow bins
+    starts = np.concatenate([[0], positions + 1])
+
+    h = hist.clone()
+    arraxis = hist.sumw.ndim - hist.ndim + axis
+    h.sumw = np.add.reduceat(hist.sumw, starts, axis=arraxis)
+    h.sumw2 = np.add.reduceat(hist.sumw2, starts, axis=arraxis)
+    h.axes = list(hist.axes)
+    if oldaxis.regular and np.allclose(np.diff(newedges), newedges[1] - newedges[0]):
+        h.axes[axis] = Axis(len(newedges) - 1, low=newedges[0], up=newedges[-1])
+    else:
+        h.axes[axis] = Axis(len(newedges) - 1, edges=newedges)
+    return h
+
+
+def postprocess(hist, cross_section=None, lumi=None, ntotal=None, xedges=None, yedges=None, fold=False, normalize_to_binwidth=False):
+    """Apply the usual chain: lumi scaling, rebinning, overflow folding and bin-width normalization, in this order."""
+    h = hist
+    if cross_section is not None:
+        h = scale_to_lumi(h, cross_section=cross_section, lumi=lumi, ntotal=ntotal)
+    if xedges is not None or yedges is not None:
+        h = rebin(h, xedges=xedges, yedges=yedges)
+    if fold:
+        h = fold_overflow(h)
+    if normalize_to_binwidth:
+        h = normalize_to_bin_width(h)
+    return h if h is not hist else hist.clone()
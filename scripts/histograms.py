@@ -0,0 +1,333 @@
+import json
+import numpy as np
+from array import array
+
+
+# NumPy-backed weighted histograms. Bin numbering and flow bins follow ROOT: bin 0 is the
+# underflow, bins 1..nbins are the regular bins and bin nbins+1 is the overflow. ROOT is only
+# imported when converting from or to TH1/TH2, so filling and merging also works in processes
+# that never load ROOT.
+
+class Axis():
+    def __init__(self, nbins, low=None, up=None, edges=None):
+        if edges is not None:
+            self.edges = np.asarray(edges, dtype=np.float64)
+            if len(self.edges) != nbins + 1 or np.any(np.diff(self.edges) <= 0):
+                raise ValueError('Need %i strictly increasing bin edges for %i bins.' % (nbins + 1, nbins))
+            self.regular = False
+        else:
+            if not up > low:
+                raise ValueError('Upper axis limit must be larger than lower limit.')
+            self.edges = np.linspace(low, up, nbins + 1)
+            self.regular = True
+        self.nbins = nbins
+        self.low = float(self.edges[0])
+        self.up = float(self.edges[-1])
+
+    def __eq__(self, other):
+        return self.nbins == other.nbins and np.array_equal(self.edges, other.edges)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    @property
+    def widths(self):
+        return np.diff(self.edges)
+
+    @property
+    def centers(self):
+        return 0.5 * (self.edges[1:] + self.edges[:-1])
+
+    def find_bins(self, values):
+        """ROOT bin numbers (including flow bins) for an array of values."""
+        values = np.asarray(values, dtype=np.float64)
+        if self.regular:
+            # same arithmetic as TAxis::FindBin for fixed bins
+            with np.errstate(invalid='ignore'):
+                bins = 1 + np.floor(self.nbins * (values - self.low) / (self.up - self.low))
+                bins = np.where(values < self.low, 0, bins)
+                bins = np.where(values < self.up, bins, self.nbins + 1)
+            return bins.astype(np.int64)
+        bins = np.searchsorted(self.edges, values, side='right')
+        # NaN values end up in the overflow, like in ROOT
+        bins[np.isnan(values)] = self.nbins + 1
+        return bins.astype(np.int64)
+
+    def find_bin(self, value):
+        if not value < self.up:
+            return self.nbins + 1
+        if value < self.low:
+            return 0
+        if self.regular:
+            return 1 + int(self.nbins * (value - self.low) / (self.up - self.low))
+        return int(np.searchsorted(self.edges, value, side='right'))
+
+    def to_root_args(self):
+        if self.regular:
+            return [self.nbins, self.low, self.up]
+        return [self.nbins, array('d', self.edges)]
+
+
+class Hist():
+    """
+    1D or 2D histogram storing the sum of weights and the sum of squared weights per bin.
+
+    The constructor takes the same arguments as TH1F/TH2F:
+        Hist(name, title, nbinsx, xlow, xup)
+        Hist(name, title, nbinsx, xedges)
+        Hist(name, title, nbinsx, xlow, xup, nbinsy, ylow, yup)
+        Hist(name, title, nbinsx, xedges, nbinsy, yedges)
+
+    With variations=[names], the histogram gets an additional leading axis with one entry per
+    weight variation (e.g. scale or PDF weights), all of which are filled in the same pass.
+    By convention, the first variation is the nominal one.
+    """
+
+    def __init__(self, name, title, *args, **kwargs):
+        self.name = name
+        self.title = title
+        self.axes = parse_axes(args)
+        self.variations = list(kwargs['variations']) if kwargs.get('variations') is not None else None
+        shape = tuple(ax.nbins + 2 for ax in self.axes)
+        if self.variations is not None:
+            shape = (len(self.variations),) + shape
+        self.sumw = np.zeros(shape, dtype=np.float64)
+        self.sumw2 = np.zeros(shape, dtype=np.float64)
+        self.entries = 0.
+
+    @property
+    def ndim(self):
+        return len(self.axes)
+
+    @property
+    def nvariations(self):
+        return len(self.variations) if self.variations is not None else 0
+
+    @property
+    def xaxis(self):
+        return self.axes[0]
+
+    @property
+    def yaxis(self):
+        return self.axes[1]
+
+    def fill(self, *args):
+        """Fill one value (or one x, y pair) with an optional weight, like TH1::Fill. With variations, the weight may be a vector."""
+        coords = args[:self.ndim]
+        weight = args[self.ndim] if len(args) > self.ndim else 1.
+        idx = (Ellipsis,) + tuple(ax.find_bin(c) for ax, c in zip(self.axes, coords))
+        weight = np.asarray(weight, dtype=np.float64)
+        self.sumw[idx] += weight
+        self.sumw2[idx] += weight * weight
+        self.entries += 1
+
+    def fill_array(self, *args):
+        """
+        Fill arrays of values (x or x, y) with an optional array of weights in one go.
+
+        With variations, weights can have shape (n, nvariations), one column per variation. A 1D
+        array of weights is then used for all variations.
+        """
+        coords = args[:self.ndim]
+        weights = args[self.ndim] if len(args) > self.ndim else None
+        n = len(coords[0])
+        if n == 0:
+            return
+        if weights is None:
+            weights = np.ones(n, dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)
+        if len(weights) != n:
+            raise ValueError('Got %i values but %i weights.' % (n, len(weights)))
+
+        cellshape = self.sumw.shape[-self.ndim:]
+        flatidx = np.ravel_multi_index(tuple(ax.find_bins(c) for ax, c in zip(self.axes, coords)), cellshape)
+        size = self.sumw.size
+        if self.variations is not None:
+            # one bincount over (variation, cell) pairs fills all variations at once
+            if weights.ndim == 1:
+                weights = np.repeat(weights[:, np.newaxis], self.nvariations, axis=1)
+            if weights.shape != (n, self.nvariations):
+                raise ValueError('Expected weights of shape (%i, %i), got %s.' % (n, self.nvariations, str(weights.shape)))
+            ncells = int(np.prod(cellshape))
+            flatidx = (np.arange(self.nvariations)[np.newaxis, :] * ncells + flatidx[:, np.newaxis]).ravel()
+            weights = weights.ravel()
+        self.sumw += np.bincount(flatidx, weights=weights, minlength=size).reshape(self.sumw.shape)
+        self.sumw2 += np.bincount(flatidx, weights=weights * weights, minlength=size).reshape(self.sumw.shape)
+        self.entries += n
+
+    def is_compatible(self, other):
+        return self.ndim == other.ndim and all(a == b for a, b in zip(self.axes, other.axes)) and self.variations == other.variations
+
+    def add(self, other, scale=1.):
+        """Add another histogram with identical binning, like TH1::Add."""
+        if not self.is_compatible(other):
+            raise ValueError('Cannot add histograms %s and %s with different binning.' % (self.name, other.name))
+        self.sumw += scale * other.sumw
+        self.sumw2 += scale * scale * other.sumw2
+        self.entries += other.entries
+        return self
+
+    def __iadd__(self, other):
+        return self.add(other)
+
+    def clone(self, name=None):
+        h = Hist.__new__(Hist)
+        h.name = name if name is not None else self.name
+        h.title = self.title
+        h.axes = list(self.axes)
+        h.variations = list(self.variations) if self.variations is not None else None
+        h.sumw = self.sumw.copy()
+        h.sumw2 = self.sumw2.copy()
+        h.entries = self.entries
+        return h
+
+    def values(self, flow=False):
+        return self.sumw if flow else self.sumw[(Ellipsis,) + (slice(1, -1),) * self.ndim]
+
+    def errors(self, flow=False):
+        return np.sqrt(self.sumw2 if flow else self.sumw2[(Ellipsis,) + (slice(1, -1),) * self.ndim])
+
+    def integral(self, flow=False):
+        """Sum of weights, one per variation if the histogram has variations."""
+        values = self.values(flow=flow)
+        if self.variations is not None:
+            return values.reshape(self.nvariations, -1).sum(axis=1)
+        return float(np.sum(values))
+
+    def variation(self, which=0, name=None):
+        """Histogram without variation axis for one variation, given by index or name."""
+        if self.variations is None:
+            return self.clone(name=name)
+        idx = which if isinstance(which, (int, np.integer)) else self.variations.index(which)
+        h = self.clone(name=name if name is not None else '%s_%s' % (self.name, self.variations[idx]))
+        h.variations = None
+        h.sumw = self.sumw[idx].copy()
+        h.sumw2 = self.sumw2[idx].copy()
+        return h
+
+    def to_root(self, name=None, precision='F', variation=0):
+        """Convert to a TH1F/TH2F (or TH1D/TH2D for precision='D'), detached from any directory. Histograms with variations convert the given one (default: nominal)."""
+        if self.variations is not None:
+            return self.variation(variation).to_root(name=name if name is not None else self.name, precision=precision)
+        import ROOT as rt
+        classname = 'TH%i%s' % (self.ndim, precision)
+        args = []
+        for ax in self.axes:
+            args += ax.to_root_args()
+        h = getattr(rt, classname)(name if name is not None else self.name, self.title, *args)
+        h.SetDirectory(0)
+        h.Sumw2()
+
+        # ROOT stores the global bin ix + (nx+2)*iy, i.e. with the x index running fastest
+        ncells = self.sumw.size
+        h.SetContent(array('d', self.sumw.T.ravel()))
+        h.GetSumw2().Set(ncells, array('d', self.sumw2.T.ravel()))
+        h.ResetStats()
+        h.SetEntries(self.entries)
+        return h
+
+    @classmethod
+    def from_root(cls, th, name=None):
+        """Create from a TH1/TH2, copying contents and squared weights including the flow bins."""
+        axes = [th.GetXaxis()] if th.GetDimension() == 1 else [th.GetXaxis(), th.GetYaxis()]
+        args = []
+        for ax in axes:
+            xbins = ax.GetXbins()
+            if xbins.GetSize() > 0:
+                args += [ax.GetNbins(), [xbins.At(i) for i in range(xbins.GetSize())]]
+            else:
+                args += [ax.GetNbins(), ax.GetXmin(), ax.GetXmax()]
+        h = cls(name if name is not None else th.GetName(), th.GetTitle(), *args)
+
+        shape_root = tuple(reversed(h.sumw.shape))
+        ncells = h.sumw.size
+        h.sumw = np.array([th.GetBinContent(i) for i in range(ncells)], dtype=np.float64).reshape(shape_root).T.copy()
+        if th.GetSumw2N() > 0:
+            sumw2 = th.GetSumw2()
+            h.sumw2 = np.array([sumw2.At(i) for i in range(ncells)], dtype=np.float64).reshape(shape_root).T.copy()
+        else:
+            h.sumw2 = np.abs(h.sumw)
+        h.entries = th.GetEntries()
+        return h
+
+
+def parse_axes(args):
+    args = list(args)
+    axes = []
+    while len(args) > 0:
+        nbins = int(args.pop(0))
+        if len(args) >= 2 and np.isscalar(args[0]) and np.isscalar(args[1]):
+            axes.append(Axis(nbins, low=float(args.pop(0)), up=float(args.pop(0))))
+        elif len(args) >= 1 and not np.isscalar(args[0]):
+            axes.append(Axis(nbins, edges=args.pop(0)))
+        else:
+            raise ValueError('Cannot interpret histogram binning arguments.')
+    if len(axes) not in [1, 2]:
+        raise ValueError('Only 1D and 2D histograms are supported, got %i axes.' % (len(axes)))
+    return axes
+
+
+class HistHolder():
+    def __init__(self):
+        self.histdict = {}
+
+    def book_hist(self, name, *args, **kwargs):
+        self.histdict[name] = Hist(name, *args, **kwargs)
+
+    def fill(self, name, *args):
+        self.histdict[name].fill(*args)
+
+    def fill_array(self, name, *args):
+        self.histdict[name].fill_array(*args)
+
+    def merge(self, other):
+        """Add the histograms of another HistHolder, e.g. one filled in a worker process."""
+        for name, hist in other.histdict.items():
+            if name in self.histdict:
+                self.histdict[name].add(hist)
+            else:
+                self.histdict[name] = hist.clone()
+
+    def get_root_hist(self, name):
+        return self.histdict[name].to_root()
+
+    def save(self, filename):
+        """Store all histograms (including variations and flow bins) in one .npz file."""
+        arrays = {}
+        meta = {}
+        for name, hist in self.histdict.items():
+            arrays['%s__sumw' % (name)] = hist.sumw
+            arrays['%s__sumw2' % (name)] = hist.sumw2
+            axes = []
+            for iax, ax in enumerate(hist.axes):
+                arrays['%s__edges%i' % (name, iax)] = ax.edges
+                axes.append({'nbins': ax.nbins, 'regular': ax.regular, 'low': ax.low, 'up': ax.up})
+            meta[name] = {'title': hist.title, 'axes': axes, 'variations': hist.variations, 'entries': hist.entries}
+        arrays['__meta__'] = np.array(json.dumps(meta))
+        np.savez(filename, **arrays)
+
+    @classmethod
+    def load(cls, filename):
+        holder = cls()
+        with np.load(filename) as content:
+            meta = json.loads(str(content['__meta__']))
+            for name, m in meta.items():
+                args = []
+                for iax, ax in enumerate(m['axes']):
+                    if ax['regular']:
+                        args += [ax['nbins'], ax['low'], ax['up']]
+                    else:
+                        args += [ax['nbins'], content['%s__edges%i' % (name, iax)]]
+                hist = Hist(str(name), str(m['title']), *args, variations=m['variations'])
+                hist.sumw = content['%s__sumw' % (name)].copy()
+                hist.sumw2 = content['%s__sumw2' % (name)].copy()
+                hist.entries = m['entries']
+                holder.histdict[str(name)] = hist
+        return holder
+
+    def book_default_hists(self, variations=None):
+        self.book_hist('tau1pt', ';p_{T}^{gen. #tau 1} [GeV];Events / bin', 20, 0, 100, variations=variations)
+        self.book_hist('tau1charge', ';charge (gen. #tau 1);Events / bin', 3, -1.5, 1.5, variations=variations)
+        self.book_hist('n_tau', ';N_{#tau};Events / bin', 11, -0.5, 10.5, variations=variations)
+        self.book_hist('m_tautau_vis', ';m_{vis}(#tau#tau) [GeV];Events / bin', 40, 0, 2000, variations=variations)
+        self.book_hist('dphi_tautau_vis', ';|#Delta#phi(#tau_{vis}^{1}, #tau_{vis}^{2})|;Events / bin', 16, 0, 3.2, variations=variations)
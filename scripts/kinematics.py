@@ -0,0 +1,119 @@
+import numpy as np
+
+
+# Four-vector arithmetic and pairwise kinematics on numpy arrays, replacing TLorentzVector.
+#
+# Collections with a varying number of objects per event are jagged arrays: flat arrays with the
+# objects of all events one after another, plus offsets such that the objects of event i are
+# [offsets[i]:offsets[i+1]] (the same layout as the mothers and daughters in GenParticleGraph).
+# Pairs of objects are built for all events at once as flat index arrays, so matching and pair
+# selections need no loop over events.
+
+def to_cartesian(pt, eta, phi, mass):
+    """(E, px, py, pz) from (pt, eta, phi, m)."""
+    pt, eta, phi, mass = [np.asarray(a, dtype=np.float64) for a in (pt, eta, phi, mass)]
+    px, py, pz = pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta)
+    return np.sqrt(px**2 + py**2 + pz**2 + mass**2), px, py, pz
+
+
+def to_ptetaphim(energy, px, py, pz):
+    """(pt, eta, phi, m) from (E, px, py, pz); the mass is 0 for slightly negative m^2 from rounding."""
+    energy, px, py, pz = [np.asarray(a, dtype=np.float64) for a in (energy, px, py, pz)]
+    pt = np.hypot(px, py)
+    eta = np.arcsinh(pz / np.where(pt > 0., pt, 1E-12))
+    return pt, eta, np.arctan2(py, px), np.sqrt(np.maximum(energy**2 - px**2 - py**2 - pz**2, 0.))
+
+
+def mass2(energy, px, py, pz):
+    return energy**2 - px**2 - py**2 - pz**2
+
+
+def invariant_mass(p4a, p4b):
+    """Invariant mass of pairs, each given as (E, px, py, pz) arrays."""
+    return np.sqrt(np.maximum(mass2(*[a + b for a, b in zip(p4a, p4b)]), 0.))
+
+
+def invariant_mass_ptetaphim(pt1, eta1, phi1, m1, pt2, eta2, phi2, m2):
+    return invariant_mass(to_cartesian(pt1, eta1, phi1, m1), to_cartesian(pt2, eta2, phi2, m2))
+
+
+def delta_phi(phi1, phi2):
+    """phi1 - phi2 in [-pi, pi)."""
+    return np.mod(np.asarray(phi1) - np.asarray(phi2) + np.pi, 2. * np.pi) - np.pi
+
+
+def delta_r(eta1, phi1, eta2, phi2):
+    return np.hypot(np.asarray(eta1) - np.asarray(eta2), delta_phi(phi1, phi2))
+
+
+def counts_to_offsets(counts):
+    return np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+
+def event_index(offsets):
+    """For every object of a jagged collection the index of its event."""
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def cross_pairs(offsets_a, offsets_b):
+    """All pairs (ia, ib) of objects of two collections in the same event, as flat indices; ordered by event and ia."""
+    counts_a, counts_b = np.diff(offsets_a), np.diff(offsets_b)
+    event_a = event_index(offsets_a)
+    # every object of a is repeated once per object of b in its event
+    ia = np.repeat(np.arange(len(event_a)), counts_b[event_a])
+    first = np.repeat(offsets_b[event_a], counts_b[event_a])
+    position = np.arange(len(ia)) - np.repeat(counts_to_offsets(counts_b[event_a])[:-1], counts_b[event_a])
+    return ia, first + position
+
+
+def unique_pairs(offsets):
+    """All pairs (i, j) with i < j of objects of one collection in the same event, as flat indices."""
+    i, j = cross_pairs(offsets, offsets)
+    keep = i < j
+    return i[keep], j[keep]
+
+
+def match_delta_r(eta_a, phi_a, offsets_a, eta_b, phi_b, offsets_b, maxdr=0.4):
+    """
+    For every object of collection a, the closest object of collection b in the same event.
+
+    Returns the flat index of the matched b object (-1 if none is within maxdr) and the
+    corresponding delta R (inf if there is no match). One b object can match several a objects.
+    """
+    ia, ib = cross_pairs(offsets_a, offsets_b)
+    dr = delta_r(eta_a[ia], phi_a[ia], eta_b[ib], phi_b[ib])
+    match = np.full(len(eta_a), -1, dtype=np.int64)
+    best_dr = np.full(len(eta_a), np.inf)
+    within = dr < maxdr
+    ia, ib, dr = ia[within], ib[within], dr[within]
+    # sorted by a and then by delta R, the first entry per a is the closest b
+    order = np.lexsort((dr, ia))
+    ia, ib, dr = ia[order], ib[order], dr[order]
+    first = np.concatenate([[True], ia[1:] != ia[:-1]]) if len(ia) > 0 else np.zeros(0, dtype=bool)
+    match[ia[first]] = ib[first]
+    best_dr[ia[first]] = dr[first]
+    return match, best_dr
+
+
+def leading(values, offsets, n=2):
+    """Flat indices of the n objects with the largest values in each event, shape (nevents, n), -1 where an event has fewer."""
+    values = np.asarray(values)
+    events = event_index(offsets)
+    order = np.lexsort((-values, events))
+    rank = np.arange(len(order)) - offsets[events[order]]
+    result = np.full((len(offsets) - 1, n), -1, dtype=np.int64)
+    keep = rank < n
+    result[events[order][keep], rank[keep]] = order[keep]
+    return result
+
+
+def leading_pair_mass(pt, eta, phi, mass, offsets):
+    """Invariant mass and delta R of the two leading objects (in pt) per event, -1 for events with fewer than two."""
+    pair = leading(pt, offsets, n=2)
+    valid = np.all(pair >= 0, axis=1)
+    i, j = pair[valid, 0], pair[valid, 1]
+    m = np.full(len(pair), -1.)
+    dr = np.full(len(pair), -1.)
+    m[valid] = invariant_mass_ptetaphim(pt[i], eta[i], phi[i], mass[i], pt[j], eta[j], phi[j], mass[j])
+    dr[valid] = delta_r(eta[i], phi[i], eta[j], phi[j])
+    return m, dr
@@ -0,0 +1,85 @@
+import numpy as np
+
+
+# Finding where curves cross, for many curves at once and without ROOT. Curves are given as
+# arrays of points and are treated as piecewise linear, like TGraph::Eval does, so crossings
+# are found exactly by linear interpolation within the segment where the difference changes sign.
+
+def find_crossings(x, y1, y2):
+    """
+    All crossings of y1 and y2 for a batch of curves.
+
+    x can have shape (npoints,) (shared by all curves) or (ncurves, npoints), y1 and y2 have shape
+    (ncurves, npoints) or (npoints,) for a single curve. Points with NaN are ignored, which allows
+    to pad curves with different numbers of points. Returns two flat arrays: the index of the
+    curve and the x position of each crossing, ordered by curve and then by x.
+    """
+    y1 = np.atleast_2d(np.asarray(y1, dtype=np.float64))
+    y2 = np.atleast_2d(np.asarray(y2, dtype=np.float64))
+    x = np.broadcast_to(np.asarray(x, dtype=np.float64), y1.shape)
+    d = y1 - y2
+
+    d0, d1 = d[:, :-1], d[:, 1:]
+    x0, x1 = x[:, :-1], x[:, 1:]
+    with np.errstate(invalid='ignore'):
+        # strict sign changes within a segment are interpolated linearly
+        crossing = np.isfinite(x0) & np.isfinite(x1) & (d0 * d1 < 0.)
+        # points lying exactly on a crossing are taken as they are
+        touching = np.isfinite(x) & (d == 0.)
+
+    icurve, iseg = np.nonzero(crossing)
+    fraction = -d0[icurve, iseg] / (d1[icurve, iseg] - d0[icurve, iseg])
+    xcross = x0[icurve, iseg] + fraction * (x1[icurve, iseg] - x0[icurve, iseg])
+
+    icurve_touch, ipoint = np.nonzero(touching)
+    icurve = np.concatenate([icurve, icurve_touch])
+    xcross = np.concatenate([xcross, x[icurve_touch, ipoint]])
+    order = np.lexsort((xcross, icurve))
+    return icurve[order], xcross[order]
+
+
+def split_by_curve(icurve, xcross, ncurves):
+    """List with the array of crossings for each curve, from the output of find_crossings."""
+    bounds = np.searchsorted(icurve, np.arange(ncurves + 1))
+    return [xcross[bounds[i]:bounds[i + 1]] for i in range(ncurves)]
+
+
+def pad_curves(curves):
+    """Stack curves [(x, y), ...] with different numbers of points into (ncurves, npoints) arrays padded with NaN."""
+    npoints = max(len(c[0]) for c in curves)
+    xs = np.full((len(curves), npoints), np.nan)
+    ys = np.full((len(curves), npoints), np.nan)
+    for i, (x, y) in enumerate(curves):
+        xs[i, :len(x)] = x
+        ys[i, :len(y)] = y
+    return xs, ys
+
+
+def on_common_grid(x1, y1, x2, y2):
+    """Evaluate two piecewise-linear curves on the union of their x values within the overlap of both."""
+    x1, y1, x2, y2 = [np.asarray(a, dtype=np.float64) for a in (x1, y1, x2, y2)]
+    order1, order2 = np.argsort(x1), np.argsort(x2)
+    x1, y1, x2, y2 = x1[order1], y1[order1], x2[order2], y2[order2]
+    xmin = max(x1[0], x2[0])
+    xmax = min(x1[-1], x2[-1])
+    x = np.union1d(x1, x2)
+    x = x[(x >= xmin) & (x <= xmax)]
+    return x, np.interp(x, x1, y1), np.interp(x, x2, y2)
+
+
+def graph_to_arrays(g):
+    """x and y values of a TGraph as numpy arrays (works on any object with GetN, GetX and GetY)."""
+    n = g.GetN()
+    return np.array([g.GetX()[i] for i in range(n)], dtype=np.float64), np.array([g.GetY()[i] for i in range(n)], dtype=np.float64)
+
+
+def find_graph_crossings(g1, g2):
+    """All x values where two TGraphs cross, within the x range covered by both."""
+    x, y1, y2 = on_common_grid(*(graph_to_arrays(g1) + graph_to_arrays(g2)))
+    return find_crossings(x, y1, y2)[1]
+
+
+def find_threshold_crossings(x, y, threshold):
+    """Crossings of a batch of curves with a constant, e.g. 2*delta NLL scans with 3.84 for 95% CL intervals."""
+    y = np.atleast_2d(np.asarray(y, dtype=np.float64))
+    return find_crossings(x, y, np.full(y.shape, threshold))
@@ -0,0 +1,110 @@
+import numpy as np
+
+from flavor_fit import CouplingScaledSignal, load_template
+from reweighting import parse_samplename
+
+
+# Signal templates at arbitrary LQ masses and couplings, interpolated between converted samples.
+#
+# The coupling dependence is exact for pure t-channel exchange: yields scale as lambda^power.
+# Along the mass, each bin is interpolated between the two neighbouring generated masses, by
+# default linearly in the logarithm of the content (yields fall roughly exponentially with the
+# mass), or linearly in the content. Bins that are empty at one of the two masses are always
+# interpolated linearly.
+#
+# For a set of hypotheses, the interpolation is a matrix (nhypotheses, nsamples) with at most
+# two non-zero entries per row, plus the coupling scale factors. These coefficients are cached
+# per set of hypotheses, so evaluating thousands of hypotheses again only costs one matrix product.
+
+class TemplateMorpher():
+    def __init__(self, grid, templates, power=4, mode='log'):
+        if mode not in ['log', 'linear']:
+            raise ValueError('Unknown morphing mode %s, must be \'log\' or \'linear\'.' % (mode))
+        self.grid = np.asarray(grid, dtype=np.float64).reshape(-1, 2)
+        self.templates = np.asarray(templates, dtype=np.float64)
+        if len(self.grid) != len(self.templates):
+            raise ValueError('Got %i grid points but %i templates.' % (len(self.grid), len(self.templates)))
+        self.power = power
+        self.mode = mode
+        self.masses = np.unique(self.grid[:, 0])
+        with np.errstate(divide='ignore'):
+            self.logtemplates = np.log(self.templates)
+        self.cache = {}
+
+    @classmethod
+    def from_files(cls, filenames, samplenames, histnames, power=4, mode='log'):
+        """Build from HistHolder files of several samples, with mass and coupling taken from the sample names."""
+        grid = [parse_samplename(sn) for sn in samplenames]
+        templates = [load_template(f, histnames=histnames) for f in filenames]
+        return cls(grid=grid, templates=templates, power=power, mode=mode)
+
+    def sample_for_mass(self, mass, coupling):
+        """Index of the sample at this generated mass whose coupling is closest to the requested one."""
+        candidates = np.where(self.grid[:, 0] == mass)[0]
+        return candidates[np.argmin(np.abs(np.log(self.grid[candidates, 1] / coupling)))]
+
+    def coefficients(self, hypotheses):
+        """Interpolation matrix and coupling scale factors for a list of (MLQ, lambda), cached."""
+        hypotheses = np.asarray(hypotheses, dtype=np.float64).reshape(-1, 2)
+        key = hypotheses.tobytes()
+        if key in self.cache:
+            return self.cache[key]
+
+        mlqs, couplings = hypotheses[:, 0], hypotheses[:, 1]
+        if np.any(mlqs < self.masses[0]) or np.any(mlqs > self.masses[-1]):
+            raise ValueError('Requested LQ masses must be within the generated range [%g, %g].' % (self.masses[0], self.masses[-1]))
+
+        # neighbouring generated masses and the interpolation fraction between them
+        ihi = np.clip(np.searchsorted(self.masses, mlqs, side='left'), 1, max(1, len(self.masses) - 1))
+        ilo = ihi - 1
+        if len(self.masses) == 1:
+            ilo, ihi = np.zeros(len(mlqs), dtype=int), np.zeros(len(mlqs), dtype=int)
+        mlo, mhi = self.masses[ilo], self.masses[ihi]
+        frac = np.where(mhi > mlo, (mlqs - mlo) / np.where(mhi > mlo, mhi - mlo, 1.), 0.)
+
+        # A holds the interpolation fractions, W additionally the coupling scaling of each sample
+        A = np.zeros((len(hypotheses), len(self.grid)))
+        W = np.zeros((len(hypotheses), len(self.grid)))
+        logscale = np.zeros(len(hypotheses))
+        for ih in range(len(hypotheses)):
+            for isample, weight in [(self.sample_for_mass(mlo[ih], couplings[ih]), 1. - frac[ih]), (self.sample_for_mass(mhi[ih], couplings[ih]), frac[ih])]:
+                coupling_scale = (couplings[ih] / self.grid[isample, 1])**self.power
+                A[ih, isample] += weight
+                W[ih, isample] += weight * coupling_scale
+                logscale[ih] += weight * np.log(coupling_scale)
+        self.cache[key] = (A, W, np.exp(logscale))
+        return self.cache[key]
+
+    def morph(self, hypotheses):
+        """Signal templates for all hypotheses at once, shape (nhypotheses, nbins)."""
+        A, W, scale = self.coefficients(hypotheses)
+        linear = np.dot(W, self.templates)
+        if self.mode == 'linear':
+            return linear
+
+        # log interpolation where all contributing templates are non-empty, linear otherwise
+        contributing_empty = np.dot(A > 0., self.templates <= 0.) > 0
+        logmorph = scale[:, np.newaxis] * np.exp(np.dot(A, np.where(self.templates > 0., self.logtemplates, 0.)))
+        return np.where(contributing_empty, linear, logmorph)
+
+    def signal_at_mass(self, mlq, coupling_ref=1.):
+        """Signal model for the fit at a fixed mass, with the coupling as parameter of interest."""
+        return CouplingScaledSignal(template=self.morph([(mlq, coupling_ref)])[0], coupling_ref=coupling_ref, power=self.power)
+
+    def save_coefficients(self, filename):
+        """Store the cached coefficients, to reuse them in other processes."""
+        arrays = {}
+        for i, (key, (A, W, scale)) in enumerate(self.cache.items()):
+            arrays['key%i' % (i)] = np.frombuffer(key, dtype=np.float64)
+            arrays['A%i' % (i)] = A
+            arrays['W%i' % (i)] = W
+            arrays['scale%i' % (i)] = scale
+        np.savez(filename, **arrays)
+
+    def load_coefficients(self, filename):
+        with np.load(filename) as content:
+            i = 0
+            while 'key%i' % (i) in content:
+                key = content['key%i' % (i)].tobytes()
+                self.cache[key] = (content['A%i' % (i)], content['W%i' % (i)], content['scale%i' % (i)])
+                i += 1
@@ -0,0 +1,187 @@
+import os
+import json
+
+from printing_utils import *
+
+
+# Every converted ntuple 'xyz.root' gets a sidecar 'xyz.index.json' with the number of entries,
+# the file size and per-branch summaries. The sidecars of a sample are collected into
+# 'index.json' in the sample folder, so that entry counts etc. are known without opening ROOT files.
+
+def sidecar_filename(filename):
+    base, ext = os.path.splitext(filename)
+    return base + '.index.json'
+
+
+def summarize_tree(tree):
+    """Entries, branch list and per-branch compressed size, min and max of a flat tree."""
+    import ROOT as rt
+
+    names = [branch.GetName() for branch in tree.GetListOfBranches()]
+    nentries = int(tree.GetEntries())
+    extrema = {}
+    if nentries > 0:
+        # TTree::GetMinimum/GetMaximum loop over the tree once per call; with all actions booked on one
+        # RDataFrame, min and max of all branches come out of a single pass
+        df = rt.RDataFrame(tree)
+        booked = dict((name, (df.Min(name), df.Max(name))) for name in names)
+        extrema = dict((name, (float(minimum.GetValue()), float(maximum.GetValue()))) for name, (minimum, maximum) in booked.items())
+
+    branches = {}
+    for branch in tree.GetListOfBranches():
+        name = branch.GetName()
+        summary = {'zipbytes': int(branch.GetZipBytes()), 'totbytes': int(branch.GetTotBytes())}
+        if name in extrema:
+            summary['min'], summary['max'] = extrema[name]
+        branches[name] = summary
+    return {'entries': nentries, 'branches': branches}
+
+
+def write_file_index(filename, summary, extra=None):
+    """Write the sidecar for a closed output file, given the summary of its tree."""
+    index = {
+        'filename': os.path.basename(filename),
+        'filesize': os.path.getsize(filename),
+        'entries':  summary['entries'],
+        'branches': summary['branches'],
+    }
+    if extra is not None:
+        index.update(extra)
+    write_json_atomic(sidecar_filename(filename), index)
+    return index
+
+
+def load_file_index(filename):
+    """Sidecar of a file, or None if it does not exist or no longer matches the file on disk."""
+    sidecar = sidecar_filename(filename)
+    if not os.path.isfile(sidecar) or not os.path.isfile(filename):
+        return None
+    with open(sidecar, 'r') as f:
+        index = json.load(f)
+    if index['filesize'] != os.path.getsize(filename):
+        return None
+    return index
+
+
+def build_sample_index(folder, inputs=None):
+    """
+    Collect the sidecars of all ntuples in a sample folder into 'index.json' and return it.
+
+    With inputs, {input file: number of events or None} as in the dataset catalog, the coverage check
+    also reports input files without any output (see check_event_coverage).
+    """
+    files = {}
+    for f in sorted(os.listdir(folder)):
+        if not f.endswith('.root'):
+            continue
+        index = load_file_index(os.path.join(folder, f))
+        if index is None:
+            print(yellow('  --> No valid index for %s, skipping it in the sample index.' % (os.path.join(folder, f))))
+            continue
+        files[f] = index
+
+    sample_index = {
+        'entries':  sum(index['entries'] for index in files.values()),
+        'filesize': sum(index['filesize'] for index in files.values()),
+        'files':    files,
+        'coverage_problems': check_event_coverage(files, inputs=inputs),
+    }
+    write_json_atomic(os.path.join(folder, 'index.json'), sample_index)
+    return sample_index
+
+
+def load_sample_index(folder):
+    indexfilename = os.path.join(folder, 'index.json')
+    if not os.path.isfile(indexfilename):
+        return None
+    with open(indexfilename, 'r') as f:
+        return json.load(f)
+
+
+def get_entries_from_index(filenames):
+    """List with the number of entries of each file, or None if one of them has no valid sidecar."""
+    entries = []
+    for filename in filenames:
+        index = load_file_index(filename)
+        if index is None:
+            return None
+        entries.append(index['entries'])
+    return entries
+
+
+def get_original_entries(filenames):
+    """Number of events before any skim (see skim_ntuples.py) summed over the files, or None if one of them has no valid sidecar."""
+    ntotal = 0
+    for filename in filenames:
+        index = load_file_index(filename)
+        if index is None:
+            return None
+        ntotal += index.get('ntotal', index['entries'])
+    return ntotal
+
+
+def get_branch_bytes(filenames, columns):
+    """Compressed bytes of the given branches and of all branches summed over the files, from their sidecars; None if one of them has no valid sidecar."""
+    needed, total = 0, 0
+    for filename in filenames:
+        index = load_file_index(filename)
+        if index is None:
+            return None
+        for name, branch in index['branches'].items():
+            total += branch['zipbytes']
+            if name in columns:
+                needed += branch['zipbytes']
+    return needed, total
+
+
+def check_event_coverage(indices, inputs=None):
+    """
+    Gaps and overlaps in the event ranges converted from each set of input files, as list of messages.
+
+    'indices' maps file names to sidecars. Outputs converted from a range of events carry 'event_range'
+    [first, last) and the number of events of their inputs, 'input_events'; those without cover all events.
+    The outputs alone cannot tell about inputs that were never converted: with 'inputs', {input file:
+    number of events or None} from the dataset catalog, those are reported as well, and so are inputs
+    whose number of events differs from the one in the catalog.
+    """
+    ranges = {}
+    for f, index in indices.items():
+        key = tuple(index.get('infilenames', [f]))
+        if 'event_range' in index:
+            ranges.setdefault(key, []).append((index['event_range'][0], index['event_range'][1], index['input_events'], f))
+        else:
+            ranges.setdefault(key, []).append((0, None, None, f))
+
+    problems = []
+    if inputs is not None:
+        converted = set(infilename for key in ranges.keys() for infilename in key)
+        for infilename in sorted(inputs.keys()):
+            if infilename not in converted:
+                problems.append('%s: no output%s' % (infilename, ' for its %i events' % (inputs[infilename]) if inputs[infilename] is not None else ''))
+
+    for key, rs in sorted(ranges.items()):
+        rs.sort(key=lambda r: r[0])
+        if len(rs) > 1 and any(r[1] is None for r in rs):
+            problems.append('%s converted both completely and in ranges: %s' % (', '.join(key), ', '.join(r[3] for r in rs)))
+            continue
+        if rs[0][1] is None:
+            continue
+        if inputs is not None and len(key) == 1 and inputs.get(key[0]) is not None and inputs[key[0]] != rs[0][2]:
+            problems.append('%s: %i events in the catalog, but %i when it was converted' % (key[0], inputs[key[0]], rs[0][2]))
+        end = 0
+        for first, last, ntotal, f in rs:
+            if first > end:
+                problems.append('%s: events %i to %i are missing before %s' % (', '.join(key), end, first, f))
+            elif first < end:
+                problems.append('%s: events %i to %i of %s are also in another output' % (', '.join(key), first, min(end, last), f))
+            end = max(end, last)
+        if end < rs[0][2]:
+            problems.append('%s: events %i to %i are missing at the end' % (', '.join(key), end, rs[0][2]))
+    return problems
+
+
+def write_json_atomic(filename, content):
+    tmpname = filename + '.tmp'
+    with open(tmpname, 'w') as f:
+        json.dump(content, f, indent=2, sort_keys=True)
+    os.rename(tmpname, filename)
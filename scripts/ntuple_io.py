@@ -0,0 +1,98 @@
+import os
+import numpy as np
+
+
+def read_columns(filename, columns, treename='Events'):
+    """
+    Read the given branches of the tree in one ROOT file into a dict of numpy arrays.
+
+    Flat branches give 1D arrays. Array branches with the same length in every entry (like the
+    per-event weight variations) give 2D arrays of shape (entries, length).
+    """
+    import ROOT as rt
+
+    f = rt.TFile.Open(filename, 'READ')
+    if not f or f.IsZombie():
+        raise IOError('Could not open file %s' % (filename))
+    tree = f.Get(treename)
+    if not tree:
+        f.Close()
+        raise IOError('No tree \'%s\' in file %s' % (treename, filename))
+
+    nentries = tree.GetEntries()
+    tree.SetEstimate(nentries + 1)
+    result = {}
+    for column in columns:
+        dtype = branch_dtype(tree, column)
+        if nentries == 0:
+            result[column] = np.zeros(0, dtype=dtype)
+            continue
+
+        leafcount = tree.GetLeaf(column).GetLeafCount()
+        if leafcount:
+            counts = draw_column(tree, leafcount.GetName(), nentries)
+            if np.any(counts != counts[0]):
+                f.Close()
+                raise ValueError('Array branch %s in file %s does not have the same length in all entries' % (column, filename))
+            tree.SetEstimate(int(counts.sum()) + 1)
+            values = draw_column(tree, column, int(counts.sum()))
+            tree.SetEstimate(nentries + 1)
+            result[column] = values.reshape(nentries, int(counts[0])).astype(dtype)
+        else:
+            result[column] = draw_column(tree, column, nentries).astype(dtype)
+    f.Close()
+    return result
+
+
+def draw_column(tree, column, nexpected):
+    # TTree::Draw only activates and decompresses the branch that is drawn
+    n = tree.Draw(column, '', 'goff')
+    if n != nexpected:
+        raise ValueError('Branch %s has %i values, expected %i' % (column, n, nexpected))
+    if n == 0:
+        return np.zeros(0, dtype=np.float64)
+    buf = tree.GetV1()
+    buf.SetSize(n)
+    return np.array(buf, dtype=np.float64)
+
+
+def branch_dtype(tree, column):
+    """Numpy dtype corresponding to the leaf type of a branch."""
+    leaf_dtypes = {
+        'Float_t':   np.float32,
+        'Double_t':  np.float64,
+        'Int_t':     np.int32,
+        'UInt_t':    np.uint32,
+        'Long64_t':  np.int64,
+        'ULong64_t': np.uint64,
+        'Short_t':   np.int16,
+        'UShort_t':  np.uint16,
+        'Char_t':    np.int8,
+        'UChar_t':   np.uint8,
+        'Bool_t':    np.bool_,
+    }
+    leaf = tree.GetLeaf(column)
+    if not leaf:
+        raise ValueError('Tree %s has no branch %s' % (tree.GetName(), column))
+    typename = leaf.GetTypeName()
+    if typename not in leaf_dtypes:
+        raise ValueError('Branch %s has unsupported type %s' % (column, typename))
+    return leaf_dtypes[typename]
+
+
+def prune_branches(tree, columns):
+    """
+    Deactivate all branches of a tree or chain, including those of its friends, except the given columns.
+
+    Only active branches are read and decompressed when looping over the entries. The count branch of an
+    array branch (like 'n_weights' for 'weights') is activated together with it by ROOT.
+    """
+    tree.SetBranchStatus('*', 0)
+    for column in columns:
+        tree.SetBranchStatus(column, 1)
+
+
+def file_signature(filename):
+    """Size and modification time of a local file, used to notice when it changes."""
+    st = os.stat(filename)
+    return {'size': st.st_size, 'mtime': st.st_mtime}
@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+from multiprocessing.pool import ThreadPool
+
+from printing_utils import *
+from ntuple_index import sidecar_filename
+from storage import get_storage, adler32
+
+
+# Outputs are written to node-local scratch and uploaded to their destination (a shared folder
+# or a storage element, see storage.py) in background threads, so the next conversion can start
+# while the previous output is still being transferred.
+#
+# An upload goes to '<destination>.upload' first, its checksum is compared to that of the local
+# file and only then it is renamed to the final name. On remote storage that rename is not atomic, but
+# a file published before is only removed once the new one is in place (see Storage.rename). The
+# sidecar index follows the same way after the ntuple, so a destination with a valid sidecar is
+# always complete and verified.
+
+def scratch_folder():
+    """Node-local scratch space: $TMPDIR as set by the batch system, else /scratch/$USER, else the system temp folder."""
+    if os.environ.get('TMPDIR', '') != '':
+        return os.environ['TMPDIR']
+    if os.path.isdir(os.path.join('/scratch', os.environ.get('USER', ''))):
+        return os.path.join('/scratch', os.environ['USER'])
+    return tempfile.gettempdir()
+
+
+class OutputStager():
+    def __init__(self, scratchfolder=None, nuploads=2):
+        basefolder = scratchfolder if scratchfolder is not None else scratch_folder()
+        self.scratchfolder = tempfile.mkdtemp(prefix='staging_', dir=basefolder)
+        self.pool = ThreadPool(nuploads)
+        self.nstaged = 0
+
+    def local_filename(self, destination):
+        """Path on scratch to write the output for destination to; one subfolder per output, so equal file names do not clash."""
+        self.nstaged += 1
+        folder = os.path.join(self.scratchfolder, str(self.nstaged))
+        os.makedirs(folder)
+        return os.path.join(folder, os.path.basename(destination))
+
+    def publish(self, localfilename, destination):
+        """Start the upload of a closed output file and its sidecar in the background; .get() on the result waits for it and raises if it failed."""
+        return self.pool.apply_async(upload, (localfilename, destination))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        shutil.rmtree(self.scratchfolder, ignore_errors=True)
+
+
+
+def upload(localfilename, destination):
+    """Copy a local file and then its sidecar to destination, verify the checksums and rename them into place."""
+    storage = get_storage(destination)
+    pairs = [(localfilename, destination)]
+    if os.path.isfile(sidecar_filename(localfilename)):
+        pairs.append((sidecar_filename(localfilename), sidecar_filename(destination)))
+
+    # an old sidecar would describe the previous file, remove it before replacing the file
+    storage.remove([sidecar_filename(destination)])
+    storage.mkdir([os.path.dirname(destination)])
+    checksums = []
+    for source, target in pairs:
+        checksum = adler32(source)
+        checksums.append(checksum)
+        tmptarget = target + '.upload'
+        storage.copy([(source, tmptarget)])
+        uploaded = storage.checksum([tmptarget])[tmptarget]
+        if uploaded != checksum:
+            storage.remove([tmptarget])
+            raise IOError('Checksum mismatch after uploading %s to %s: %s instead of %s' % (source, tmptarget, uploaded, checksum))
+        storage.rename([(tmptarget, target)])
+    print(green('--> Published %s (adler32 %s)' % (destination, checksums[0])))
+
+    shutil.rmtree(os.path.dirname(localfilename), ignore_errors=True)
+    return destination
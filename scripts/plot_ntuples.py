@@ -5,12 +5,84 @@ from printing_utils import *
 
 import ROOT as rt
 from tdrstyle_all import *
+from column_cache import load_columns
+from ntuple_index import get_entries_from_index, get_original_entries, load_file_index, get_branch_bytes
+from ntuple_io import read_columns, prune_branches
+from friend_trees import common_friends, friend_filename, friend_treename
+from histograms import HistHolder
+from hist_postprocessing import postprocess
+from kinematics import delta_phi
+import numpy as np
 import os
 
 
 rt.gROOT.SetBatch(1)
 
 
+# What to fill into each histogram: the columns it reads and a function of those columns returning
+# the values to fill and a mask of the events to fill them for (None: all). The functions get either
+# numpy arrays with all events or the scalars of one event, and only the columns they list, so the
+# branches read from the ntuples (see get_needed_columns) always match what is filled. The event
+# selection is defined the same way and returns the mask of the events to keep (None: all).
+hist_definitions = {
+    'tau1pt':          (['tau1_pt'],     lambda c: (c['tau1_pt'], None)),
+    'tau1charge':      (['tau1_charge'], lambda c: (c['tau1_charge'], None)),
+    'n_tau':           (['n_tau'],       lambda c: (c['n_tau'], None)),
+    # pair variables only for events with two visible taus
+    'm_tautau_vis':    (['m_tautau_vis'], lambda c: (c['m_tautau_vis'], c['m_tautau_vis'] >= 0.)),
+    'dphi_tautau_vis': (['m_tautau_vis', 'tau1_vis_phi', 'tau2_vis_phi'], lambda c: (np.abs(delta_phi(c['tau1_vis_phi'], c['tau2_vis_phi'])), c['m_tautau_vis'] >= 0.)),
+}
+selection_definition = ([], lambda c: None)
+
+
+def get_needed_columns(histnames):
+    """Columns needed to fill the given histograms after the event selection, in a fixed order."""
+    columns = set(selection_definition[0])
+    for histname in histnames:
+        columns.update(hist_definitions[histname][0])
+    return sorted(columns)
+
+
+def get_available_columns(infilenames):
+    """Columns present in all of the ntuples or their common friends, from the sidecars (or the files, for those without one)."""
+    available = None
+    for infilename in infilenames:
+        index = load_file_index(infilename)
+        if index is not None:
+            branches = set(index['branches'].keys())
+        else:
+            f = rt.TFile.Open(infilename, 'READ')
+            if not f or f.IsZombie():
+                raise IOError('Could not open file %s' % (infilename))
+            branches = set(b.GetName() for b in f.Get('Events').GetListOfBranches())
+            f.Close()
+        available = branches if available is None else available & branches
+    for name, columns in common_friends(infilenames).items():
+        available |= set(columns)
+    return available if available is not None else set()
+
+
+def drop_unavailable_hists(histholder, infilenames):
+    # ntuples converted before a column was added to the converter cannot fill the histograms reading it
+    available = get_available_columns(infilenames)
+    missing_selection = [c for c in selection_definition[0] if c not in available]
+    if len(missing_selection) > 0:
+        raise ValueError('The ntuples have no branches %s needed by the event selection, reconvert them with the current convert_gensim_root.py.' % (', '.join(missing_selection)))
+    for histname in sorted(histholder.histdict.keys()):
+        missing = [c for c in hist_definitions[histname][0] if c not in available]
+        if len(missing) > 0:
+            print(yellow('  --> Not filling histogram %s, the ntuples have no branches %s. Reconvert them with the current convert_gensim_root.py to get it.' % (histname, ', '.join(missing))))
+            del histholder.histdict[histname]
+    if len(histholder.histdict) == 0:
+        raise ValueError('None of the histograms can be filled from these ntuples, reconvert them with the current convert_gensim_root.py.')
+
+
+def evaluate(definition, columns):
+    # the function only sees the columns it declares, reading any other one is a KeyError
+    needed, function = definition
+    return function(dict((c, columns[c]) for c in needed))
+
+
 
 description = """Plotting variables from ntuples."""
 parser = ArgumentParser(prog="plotter", description=description, epilog="Finished successfully!")
@@ -18,7 +90,10 @@ parser.add_argument('-i', "--infilenames", dest="infilenames", nargs='+', defaul
                                            help="Name of the root file(s) to make plots from" )
 parser.add_argument('-o', "--outfolder",   dest="outfolder", action='store', required=True,
                                            help="Name of the existing folder to store plots in.")
-args = parser.parse_args()
+parser.add_argument('-c', "--cachefolder", dest="cachefolder", default=None, action='store',
+                                           help="Folder for the memory-mapped column cache. If given, columns are read from the cache (and materialized there on first use) instead of looping over the TChain." )
+parser.add_argument('-v', "--variations",  dest="variations", default=False, action='store_true',
+                                           help="Also fill all per-event weight variations stored by the converter, into histograms with a variation axis. Reads columns instead of looping over the TChain." )
 
 
 
@@ -30,22 +105,64 @@ def main():
     cross_section_signal = 1.
     lumi = 138.E3
 
-    # Load the input files and chain them together
-    chain = rt.TChain('Events')
-    nfiles_loaded = 0
-    for infilename in args.infilenames:
-        chain.Add(infilename)
-        nfiles_loaded += 1
-    ntotal = chain.GetEntries()
-    eventweight = cross_section_signal * lumi / ntotal
-    print(green('  --> Loaded %i files with %i events' % (nfiles_loaded, ntotal)))
-
-    # Create and fill the histograms
+    # Create the histograms
+    variations = None
+    if args.variations:
+        variations = get_variation_names(infilenames=args.infilenames)
+        print(green('  --> Filling %i weight variations' % (len(variations))))
     histholder = HistHolder()    
-    histholder.book_default_hists()
-    nsel = fill_histograms(histholder=histholder, chain=chain, eventweight=eventweight)
+    histholder.book_default_hists(variations=variations)
+    drop_unavailable_hists(histholder=histholder, infilenames=args.infilenames)
+    columns_needed = get_needed_columns(histholder.histdict.keys()) + (['weights'] if args.variations else [])
+    print(green('  --> Reading the columns: %s' % (', '.join(columns_needed))))
+
+    if args.cachefolder is not None or args.variations:
+        # Read the needed columns (from the cache, if given) and fill all events at once; columns of friend trees are found automatically
+        columns = load_columns(infilenames=args.infilenames, columns=columns_needed, cachefolder=args.cachefolder)
+        # only the columns of the booked histograms and the selection are read, any of them has all events
+        nread = len(next(iter(columns.values()))) if len(columns) > 0 else 0
+        ntotal = get_normalization_entries(args.infilenames, nread)
+        eventweight = cross_section_signal * lumi / ntotal
+        print(green('  --> Loaded %i files with %i events as columns' % (len(args.infilenames), nread)))
+        nsel = fill_histograms_from_columns(histholder=histholder, columns=columns, eventweight=eventweight)
+        report_bytes_read(infilenames=args.infilenames, columns=columns_needed, cachefolder=args.cachefolder)
+    else:
+        # Load the input files and chain them together. If all files have a sidecar index, the
+        # entries are taken from there and the files are only opened once the loop reaches them.
+        # Friend trees with columns added after the conversion are chained in the same way.
+        chain = rt.TChain('Events')
+        friends = common_friends(args.infilenames)
+        friendchains = dict((name, rt.TChain(friend_treename)) for name in friends)
+        entries_per_file = get_entries_from_index(args.infilenames)
+        nfiles_loaded = 0
+        for idx, infilename in enumerate(args.infilenames):
+            if entries_per_file is not None and entries_per_file[idx] > 0:
+                chain.Add(infilename, entries_per_file[idx])
+                for name, friendchain in friendchains.items():
+                    friendchain.Add(friend_filename(infilename, name), entries_per_file[idx])
+            elif entries_per_file is None:
+                chain.Add(infilename)
+                for name, friendchain in friendchains.items():
+                    friendchain.Add(friend_filename(infilename, name))
+            nfiles_loaded += 1
+        for name, friendchain in friendchains.items():
+            chain.AddFriend(friendchain)
+            print(green('  --> Added friend \'%s\' with columns: %s' % (name, ', '.join(friends[name]))))
+        nread = sum(entries_per_file) if entries_per_file is not None else chain.GetEntries()
+        ntotal = get_normalization_entries(args.infilenames, nread)
+        eventweight = cross_section_signal * lumi / ntotal
+        print(green('  --> Loaded %i files with %i events' % (nfiles_loaded, nread)))
+
+        # only the branches that are needed are read and decompressed in the loop
+        prune_branches(chain, columns_needed)
+        bytes_before = rt.TFile.GetFileBytesRead()
+        nsel = fill_histograms(histholder=histholder, chain=chain, eventweight=eventweight)
+        report_bytes_read(infilenames=args.infilenames, columns=columns_needed, bytes_read=rt.TFile.GetFileBytesRead() - bytes_before, friends=friends)
     print(green('  --> Selected %i events out of %i (%.1f%%)' % (nsel, ntotal, float(nsel)/float(ntotal)*100.)))
 
+    # keep the histograms (including all variations) as templates for the fit
+    histholder.save(os.path.join(args.outfolder, 'histograms.npz'))
+
     # make plots, one for each histogram in the histfolder
     make_plots_from_histholder(histholder=histholder, outfoldername=args.outfolder, normalize_to_binwidth=False)
 
@@ -62,8 +179,8 @@ def make_plots_from_histholder(histholder, outfoldername, normalize_to_binwidth=
     histnames = histholder.histdict.keys()
     for histname in histnames:
     
-        # get corresponding histograms
-        hist = histholder.histdict[histname]
+        # get corresponding histograms, post-processed and converted to ROOT for drawing
+        hist = postprocess(histholder.histdict[histname], normalize_to_binwidth=normalize_to_binwidth).to_root()
         xmin = hist.GetXaxis().GetXmin()
         xmax = hist.GetXaxis().GetXmax()
         nameXaxis = hist.GetXaxis().GetTitle()
@@ -73,7 +190,6 @@ def make_plots_from_histholder(histholder, outfoldername, normalize_to_binwidth=
         leg = tdrLeg(0.45,0.75,0.90,0.85, textSize=0.040)
         c = tdrCanvas(canvName='c', x_min=xmin, x_max=xmax, y_min=5E-1, y_max=hist.GetMaximum()*100, nameXaxis=nameXaxis, nameYaxis=nameYaxis, square=True, iPos=11)
 
-        if normalize_to_binwidth: normalize_content_to_bin_width(histogram=hist)
         tdrDraw(hist, 'E HIST', mcolor=rt.kBlack, lcolor=rt.kBlack, marker=1, fstyle=0, lstyle=1)
         hist.SetLineWidth(2)
         leg.AddEntry(hist, 'Signal', 'L')
@@ -87,57 +203,90 @@ def make_plots_from_histholder(histholder, outfoldername, normalize_to_binwidth=
 
 def fill_histograms(histholder, chain, eventweight):
 
+    # only the needed columns are taken from the event, the same as the active branches after pruning
+    histnames = sorted(histholder.histdict.keys())
+    columns_needed = get_needed_columns(histnames)
     ievent = 0
     nselected = 0
     for event in chain:
         if ievent%10000 == 0: print(blue('    --> Filling event no. %i' % (ievent)))
         ievent += 1
+        columns = dict((c, getattr(event, c)) for c in columns_needed)
 
-        # Define event selection here
-        keep_event = True
-        
-        if not keep_event: continue
+        keep_event = evaluate(selection_definition, columns)
+        if keep_event is not None and not keep_event: continue
 
-        histholder.fill('tau1pt', event.tau1_pt, eventweight)
-        histholder.fill('tau1charge', event.tau1_charge, eventweight)
-        histholder.fill('n_tau', event.n_tau, eventweight)
+        for histname in histnames:
+            values, mask = evaluate(hist_definitions[histname], columns)
+            if mask is None or mask:
+                histholder.fill(histname, values, eventweight)
         nselected += 1
 
     return nselected
 
 
-class HistHolder():
-    def __init__(self):
-        self.histdict = {}
-
-    def book_hist(self, name, *args):
-        hist = rt.TH1F(name, *args)
-        hist.SetDirectory(0)
-        self.histdict[name] = hist
-
-    def fill(self, name, *args):
-        self.histdict[name].Fill(*args)
-
-    def book_default_hists(self):
-        self.book_hist('tau1pt', ';p_{T}^{gen. #tau 1} [GeV];Events / bin', 20, 0, 100)
-        self.book_hist('tau1charge', ';charge (gen. #tau 1);Events / bin', 3, -1.5, 1.5)
-        self.book_hist('n_tau', ';N_{#tau};Events / bin', 11, -0.5, 10.5)
-        
-
-
-
-
-def normalize_content_to_bin_width(histogram):
+def fill_histograms_from_columns(histholder, columns, eventweight, variation_weights=None):
+
+    # event selection as a boolean mask over all events
+    nevents = len(columns[sorted(columns.keys())[0]])
+    keep_event = evaluate(selection_definition, columns)
+    if keep_event is None:
+        keep_event = np.ones(nevents, dtype=bool)
+
+    if variation_weights is None and 'weights' in columns:
+        # first variation is the nominal one, followed by all stored weight variations
+        varied = columns['weights'][keep_event].astype(np.float64)
+        weights = eventweight * np.hstack([np.ones((len(varied), 1)), varied])
+    elif variation_weights is not None:
+        # per-event weight factors given by the caller, e.g. for reweighting to other LQ hypotheses
+        weights = eventweight * np.asarray(variation_weights, dtype=np.float64)[keep_event]
+    else:
+        weights = np.full(np.count_nonzero(keep_event), eventweight, dtype=np.float64)
+
+    selected = dict((c, np.asarray(columns[c])[keep_event]) for c in get_needed_columns(histholder.histdict.keys()))
+    for histname in sorted(histholder.histdict.keys()):
+        values, mask = evaluate(hist_definitions[histname], selected)
+        if mask is None:
+            histholder.fill_array(histname, values, weights)
+        else:
+            histholder.fill_array(histname, values[mask], weights[mask])
+    return len(weights)
+
+
+def report_bytes_read(infilenames, columns, bytes_read=None, friends=None, cachefolder=None):
+    # the compressed sizes of the branches are known from the sidecars of the ntuples and their friends
+    filenames = list(infilenames) + [friend_filename(f, name) for f in infilenames for name in (friends if friends is not None else [])]
+    branch_bytes = get_branch_bytes(filenames, columns)
+    if bytes_read is not None:
+        print(green('  --> Read %.1f MB from the input files' % (bytes_read / 1.E6)))
+    if branch_bytes is None:
+        return
+    needed, total = branch_bytes
+    if cachefolder is not None:
+        print(green('  --> Columns taken from the cache in %s; in the ntuples they are %.1f MB of %.1f MB of compressed branch data' % (cachefolder, needed / 1.E6, total / 1.E6)))
+        return
+    print(green('  --> Needed %.1f MB of %.1f MB of compressed branch data, %.1f MB (%.1f%%) not read' % (needed / 1.E6, total / 1.E6, (total - needed) / 1.E6, 100. * (total - needed) / max(total, 1))))
+
+
+def get_normalization_entries(infilenames, nread):
+    # Skimmed ntuples (see skim_ntuples.py) are normalized to the number of events before the skim
+    ntotal = get_original_entries(infilenames)
+    if ntotal is None:
+        return nread
+    if ntotal != nread:
+        print(green('  --> Skimmed input: normalizing to the %i events before the skim' % (ntotal)))
+    return ntotal
+
+
+def get_variation_names(infilenames):
+    # The converter stores the LHE weight ids in the sidecar index, fall back to numbering them
+    index = load_file_index(infilenames[0])
+    if index is not None and len(index.get('weight_ids', [])) > 0:
+        return ['nominal'] + ['lhe_%s' % (wid) for wid in index['weight_ids']]
+    nweights = read_columns(infilenames[0], ['weights'])['weights'].shape[1]
+    return ['nominal'] + ['lhe_%i' % (i) for i in range(nweights)]
 
-    # Normalize the content of each bin to the bin width
-    for bin in range(1, histogram.GetNbinsX() + 1):
-        content = histogram.GetBinContent(bin)
-        error = histogram.GetBinError(bin)
-        bin_width = histogram.GetBinWidth(bin)
-        normalized_content = content / bin_width
-        normalized_error = error / bin_width
-        histogram.SetBinContent(bin, normalized_content)
-        histogram.SetBinError(bin, normalized_error)
 
 if __name__ == '__main__':
+    args = parser.parse_args()
     main()
@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+
+from argparse import ArgumentParser
+from printing_utils import *
+
+from column_cache import load_columns
+from histograms import HistHolder
+from reweighting import parse_samplename, hypothesis_name, make_hypotheses, tchannel_weights, iterate_event_blocks
+from plot_ntuples import fill_histograms_from_columns, get_needed_columns, drop_unavailable_hists, get_normalization_entries
+import numpy as np
+import os
+
+
+
+description = """Filling histograms for many LQ mass and coupling hypotheses from one converted sample, by reweighting the hard process."""
+parser = ArgumentParser(prog="reweighter", description=description, epilog="Finished successfully!")
+parser.add_argument('-i', "--infilenames", dest="infilenames", nargs='+', default=None, action='store', required=True,
+                                           help="Name of the root file(s) of one sample" )
+parser.add_argument('-o', "--outfilename", dest="outfilename", action='store', required=True,
+                                           help="Name of the .npz file to store the histograms in, one variation per hypothesis.")
+parser.add_argument('-s', "--samplename",  dest="samplename", action='store', required=True,
+                                           help="Name of the sample, e.g. LQTChannel_BBTauTau_MLQ1000_L1p0, to know the generated mass and coupling.")
+parser.add_argument('-m', "--mlqs",        dest="mlqs", nargs='+', type=float, required=True,
+                                           help="LQ masses (in GeV) to reweight to.")
+parser.add_argument('-l', "--couplings",   dest="couplings", nargs='+', type=float, required=True,
+                                           help="LQ couplings to reweight to.")
+parser.add_argument("--channel",           dest="channel", default='t', choices=['t', 'u'],
+                                           help="Follows from the fermion number F of the LQ, not its spin: 't' for F=0 (e.g. U1), which couples quarks to leptons (propagator in hard_that, with the tau-), 'u' for F=2 (e.g. S3), which couples quarks to antileptons (hard_uhat, with the tau+).")
+parser.add_argument('-c', "--cachefolder", dest="cachefolder", default=None, action='store',
+                                           help="Folder for the memory-mapped column cache.")
+
+
+
+def main():
+
+    print(green('--> Starting to reweight ntuples.'))
+
+    # Same normalization as in plot_ntuples.py, the reweighting takes care of the change in cross section
+    cross_section_signal = 1.
+    lumi = 138.E3
+
+    mlq_ref, coupling_ref = parse_samplename(args.samplename)
+    hypotheses = make_hypotheses(mlqs=args.mlqs, couplings=args.couplings)
+    print(green('  --> Reweighting from %s to %i hypotheses' % (hypothesis_name(mlq_ref, coupling_ref), len(hypotheses))))
+
+    mandelstam_column = 'hard_that' if args.channel == 't' else 'hard_uhat'
+
+    histholder = HistHolder()
+    histholder.book_default_hists(variations=[hypothesis_name(m, l) for (m, l) in hypotheses])
+    drop_unavailable_hists(histholder=histholder, infilenames=args.infilenames)
+
+    columns = load_columns(infilenames=args.infilenames, columns=get_needed_columns(histholder.histdict.keys()) + [mandelstam_column], cachefolder=args.cachefolder)
+    ntotal = len(columns[mandelstam_column])
+    eventweight = cross_section_signal * lumi / get_normalization_entries(args.infilenames, ntotal)
+    ninvalid = np.count_nonzero(columns[mandelstam_column] >= 0.)
+    if ninvalid > 0:
+        print(yellow('  --> %i of %i events have no valid hard-process kinematics, they are only scaled by the coupling.' % (ninvalid, ntotal)))
+
+    # Weights for all hypotheses are computed and filled together, in blocks of events to limit the memory
+    nsel = 0
+    for block in iterate_event_blocks(nevents=ntotal, nhypotheses=len(hypotheses)):
+        columns_block = dict((c, np.asarray(a[block])) for c, a in columns.items())
+        weights = tchannel_weights(mandelstam=columns_block[mandelstam_column], mlq_ref=mlq_ref, coupling_ref=coupling_ref, hypotheses=hypotheses)
+        nsel += fill_histograms_from_columns(histholder=histholder, columns=columns_block, eventweight=eventweight, variation_weights=weights)
+    print(green('  --> Selected %i events out of %i (%.1f%%)' % (nsel, ntotal, float(nsel)/float(ntotal)*100.)))
+
+    histholder.save(args.outfilename)
+    print(green('--> Histograms for all hypotheses written to: %s' % (args.outfilename)))
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main()
@@ -0,0 +1,60 @@
+import re
+import numpy as np
+
+
+# Reweighting of t-channel LQ exchange samples (q qbar -> tau tau, pure LQ diagram at LO) to other
+# LQ masses and couplings. The squared matrix element factorizes into a kinematic part that does
+# not depend on the hypothesis and the propagator term lambda^4 / (t - M^2)^2, with t the momentum
+# transfer between the incoming quark and the outgoing lepton attached to the same LQ vertex. The
+# per-event weight to go from the generated (M0, lambda0) to (M, lambda) is therefore
+#
+#     w = (lambda / lambda0)^4 * ((t - M0^2) / (t - M^2))^2
+#
+# which the converter makes possible by storing hard_that (quark -> tau-) and hard_uhat (quark -> tau+).
+# Samples that include interference with SM diagrams cannot be reweighted like this.
+
+def parse_samplename(samplename):
+    """Get (MLQ, lambda) from a sample name like 'LQTChannel_BBTauTau_MLQ1000_L1p0'."""
+    match = re.search(r'MLQ(\d+)_L(\d+)p(\d+)', samplename)
+    if match is None:
+        raise ValueError('Cannot read LQ mass and coupling from sample name %s' % (samplename))
+    mlq = float(match.group(1))
+    coupling = float('%s.%s' % (match.group(2), match.group(3)))
+    return mlq, coupling
+
+
+def hypothesis_name(mlq, coupling):
+    """Inverse of parse_samplename for the mass and coupling part, e.g. 'MLQ1000_L1p0'."""
+    coupling_str = ('%g' % (coupling)).replace('.', 'p')
+    if 'p' not in coupling_str:
+        coupling_str += 'p0'
+    return 'MLQ%i_L%s' % (int(round(mlq)), coupling_str)
+
+
+def make_hypotheses(mlqs, couplings):
+    """All combinations of the given masses and couplings, as a list of (MLQ, lambda) tuples."""
+    return [(m, l) for m in mlqs for l in couplings]
+
+
+def tchannel_weights(mandelstam, mlq_ref, coupling_ref, hypotheses):
+    """
+    Per-event weights for all hypotheses at once, shape (nevents, nhypotheses).
+
+    mandelstam is hard_that or hard_uhat (in GeV^2), depending on whether the LQ couples the quark
+    to the lepton or to the antilepton. Events without valid hard-process kinematics (t >= 0) only
+    get the coupling scaling.
+    """
+    t = np.asarray(mandelstam, dtype=np.float64)[:, np.newaxis]
+    hypotheses = np.asarray(hypotheses, dtype=np.float64).reshape(-1, 2)
+    mlqs = hypotheses[np.newaxis, :, 0]
+    couplings = hypotheses[np.newaxis, :, 1]
+
+    propagator_ratio = np.where(t < 0., (t - mlq_ref**2) / (t - mlqs**2), 1.)
+    return (couplings / coupling_ref)**4 * propagator_ratio**2
+
+
+def iterate_event_blocks(nevents, nhypotheses, max_elements=int(2E7)):
+    """Slices over the events such that one block of weights holds at most max_elements numbers."""
+    blocksize = max(1, max_elements // max(1, nhypotheses))
+    for start in range(0, nevents, blocksize):
+        yield slice(start, min(start + blocksize, nevents))
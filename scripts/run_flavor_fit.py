@@ -0,0 +1,130 @@
+#! /usr/bin/env python
+
+from argparse import ArgumentParser
+from printing_utils import *
+
+from flavor_fit import BinnedLikelihood, CouplingScaledSignal, Process, profile_scan, load_template
+from reweighting import parse_samplename
+from limits import find_crossings, split_by_curve
+from morphing import TemplateMorpher
+from toys import run_toys
+import numpy as np
+import json
+import os
+
+
+
+description = """Fitting the LQ coupling to histograms produced by plot_ntuples.py, with a profile-likelihood scan."""
+parser = ArgumentParser(prog="fitter", description=description, epilog="Finished successfully!")
+parser.add_argument('-s', "--signal",      dest="signal", nargs='+', action='store', required=True,
+                                           help="HistHolder file(s) (.npz) with the signal histograms, one per signal sample" )
+parser.add_argument('-n', "--samplename",  dest="samplename", nargs='+', action='store', required=True,
+                                           help="Name(s) of the signal sample(s), in the same order, to know the mass and coupling they were generated with.")
+parser.add_argument('-m', "--mlq",         dest="mlq", default=None, type=float,
+                                           help="LQ mass to fit at. The signal template is interpolated between the given signal samples. Needed if more than one signal sample is given.")
+parser.add_argument('-b', "--backgrounds", dest="backgrounds", nargs='*', default=[], action='store',
+                                           help="HistHolder files (.npz) with the background histograms, one per process")
+parser.add_argument('-d', "--data",        dest="data", default=None, action='store',
+                                           help="HistHolder file (.npz) with the observed histograms. If not given, an Asimov dataset with the coupling given by --inject is fitted.")
+parser.add_argument('-i', "--inject",      dest="inject", default=0., type=float,
+                                           help="Coupling of the signal in the Asimov dataset.")
+parser.add_argument('--hists',             dest="hists", nargs='+', default=['tau1pt'],
+                                           help="Names of the histograms to fit (bins of all of them are fitted together).")
+parser.add_argument('--lnN',               dest="lnN", nargs='*', default=[],
+                                           help="Normalization uncertainties as 'nuisance:process:kappa', process is 'signal' or the basename of a background file.")
+parser.add_argument('--scan',              dest="scan", nargs=3, type=float, default=[0., 3., 301],
+                                           help="Range of the coupling scan: first, last, number of points.")
+parser.add_argument('-j', "--ncores",      dest="ncores", default=1, type=int,
+                                           help="Number of processes for the scan and the toys.")
+parser.add_argument('-t', "--toys",        dest="toys", default=0, type=int,
+                                           help="Number of pseudo-experiments to fit, drawn from the expectation with the coupling given by --inject and all nuisances at 0.")
+parser.add_argument('--toy-batchsize',     dest="toy_batchsize", default=1000, type=int,
+                                           help="Number of toys generated and fitted together in one batch.")
+parser.add_argument('--seed',              dest="seed", default=1, type=int,
+                                           help="Random seed of the first batch of toys, the following batches use the next seeds.")
+parser.add_argument('-o', "--outfilename", dest="outfilename", action='store', required=True,
+                                           help="Name of the .json file to store the scan in.")
+
+
+
+def main():
+
+    print(green('--> Starting the flavor fit.'))
+
+    if len(args.signal) != len(args.samplename):
+        raise ValueError('Need exactly one sample name per signal file.')
+    if args.mlq is not None:
+        morpher = TemplateMorpher.from_files(filenames=args.signal, samplenames=args.samplename, histnames=args.hists)
+        mlq = args.mlq
+        signal = morpher.signal_at_mass(mlq)
+        print(green('  --> Interpolated signal template to MLQ = %g GeV from %i samples' % (mlq, len(args.signal))))
+    elif len(args.signal) == 1:
+        mlq, coupling_ref = parse_samplename(args.samplename[0])
+        signal = CouplingScaledSignal(template=load_template(args.signal[0], histnames=args.hists), coupling_ref=coupling_ref)
+    else:
+        raise ValueError('With more than one signal sample, the mass to fit at has to be given with --mlq.')
+
+    lnN = {}
+    for spec in args.lnN:
+        nuisance, process, kappa = spec.split(':')
+        lnN.setdefault(process, {})[nuisance] = float(kappa)
+
+    backgrounds = []
+    for filename in args.backgrounds:
+        name = os.path.splitext(os.path.basename(filename))[0]
+        backgrounds.append(Process(name=name, template=load_template(filename, histnames=args.hists), lnN=lnN.get(name)))
+
+    if args.data is not None:
+        data = load_template(args.data, histnames=args.hists)
+    else:
+        data = signal.expected(np.array([args.inject]))[0] + sum(b.template for b in backgrounds)
+        print(green('  --> Fitting Asimov dataset with coupling %.3f' % (args.inject)))
+
+    likelihood = BinnedLikelihood(data=data, signal=signal, backgrounds=backgrounds, signal_lnN=lnN.get('signal'))
+    bestfit, nll_min = likelihood.fit()
+    print(green('  --> Best-fit coupling: %.4f' % (bestfit[0])))
+    for name, value in zip(likelihood.parameter_names()[1:], bestfit[1:]):
+        print(blue('    --> %s: %+.3f' % (name, value)))
+
+    poi_values = np.linspace(args.scan[0], args.scan[1], int(args.scan[2]))
+    nll, params = profile_scan(likelihood, poi_values, ncores=args.ncores)
+    delta = 2. * (nll - nll_min)
+    print(green('  --> Scanned %i points' % (len(poi_values))))
+
+    # Boundaries of the 68% and 95% CL intervals, where 2*delta NLL crosses 1 and 3.84
+    icurve, crossings = find_crossings(poi_values, np.array([delta, delta]), np.array([np.full(len(delta), 1.), np.full(len(delta), 3.84)]))
+    intervals = split_by_curve(icurve, crossings, ncurves=2)
+    for cl, boundaries in zip(['68%', '95%'], intervals):
+        print(green('  --> %s CL interval boundaries: %s' % (cl, ', '.join(['%.4f' % (b) for b in boundaries]))))
+
+    result = {
+        'mlq':         mlq,
+        'bestfit':     dict(zip(likelihood.parameter_names(), bestfit.tolist())),
+        'nll_min':     float(nll_min),
+        'poi':         poi_values.tolist(),
+        'delta_2nll':  delta.tolist(),
+        'boundaries_68': intervals[0].tolist(),
+        'boundaries_95': intervals[1].tolist(),
+        'nuisances':   params[:, 1:].tolist(),
+    }
+    with open(args.outfilename, 'w') as f:
+        json.dump(result, f, indent=2)
+    print(green('--> Scan written to: %s' % (args.outfilename)))
+
+    if args.toys > 0:
+        print(green('--> Fitting %i toys with coupling %.3f' % (args.toys, args.inject)))
+        truth = np.zeros((1, likelihood.nparams))
+        truth[0, 0] = args.inject
+        toyfilename = os.path.splitext(args.outfilename)[0] + '_toys.txt'
+        summary = run_toys(likelihood, likelihood.expected(truth)[0], args.inject, args.toys, toyfilename, batchsize=args.toy_batchsize, ncores=args.ncores, seed=args.seed)
+        print(green('  --> Coupling: mean %.4f, standard deviation %.4f' % (summary['poi_mean'], summary['poi_std'])))
+        print(green('  --> Coverage of the 68%% (95%%) CL intervals: %.3f (%.3f)' % (summary['coverage68'], summary['coverage95'])))
+        for name in likelihood.parameter_names():
+            print(blue('    --> Pull %s: mean %+.3f, width %.3f' % (name, summary['pull_mean'][name], summary['pull_width'][name])))
+        print(green('--> Toy results written to: %s' % (toyfilename)))
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main()
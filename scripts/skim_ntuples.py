@@ -0,0 +1,130 @@
+#! /usr/bin/env python
+
+from argparse import ArgumentParser
+from printing_utils import *
+
+from ntuple_index import summarize_tree, write_file_index, load_file_index
+from ntuple_io import read_columns, file_signature
+from multiprocessing import Pool
+import os
+
+
+
+description = """Skimming and slimming converted ntuples: keep only events passing a preselection and only the needed branches."""
+parser = ArgumentParser(prog="skimmer", description=description, epilog="Finished successfully!")
+parser.add_argument('-i', "--infilenames", dest="infilenames", nargs='+', default=None, action='store', required=True,
+                                           help="Name of the ntuple(s) of one sample to skim" )
+parser.add_argument('-o', "--outfolder",   dest="outfolder", action='store', required=True,
+                                           help="Folder to write the skimmed ntuples to, with the same file names.")
+parser.add_argument('-s', "--skim",        dest="skim", default='preselection', action='store',
+                                           help="Name of the skim, one of those defined in 'skims' below.")
+parser.add_argument('-f', "--force",       dest="force", default=False, action='store_true',
+                                           help="Redo skims whose output is still up to date.")
+parser.add_argument('-j', "--ncores",      dest="ncores", default=1, type=int,
+                                           help="Number of files skimmed in parallel.")
+
+
+
+# A skim is a TTree::Draw-style selection on the branches of 'Events' and the list of branches to
+# keep (wildcards allowed, count branches of array branches must be listed as well). The sidecar
+# of every skimmed file keeps the number of events before the selection ('ntotal'), which
+# plot_ntuples.py uses for the normalization, and, for ntuples with a 'genweight' branch, the sum
+# of generator weights before the selection ('sumw').
+skims = {
+    'preselection': {
+        'selection': 'n_tau >= 2',
+        'branches':  ['tau1_*', 'tau2_*', 'n_tau', 'm_tautau_vis', 'dr_tautau_vis', 'genweight', 'n_weights', 'weights', 'hard_*'],
+    },
+}
+
+
+
+def main():
+    if args.skim not in skims:
+        raise ValueError('Unknown skim %s, available: %s' % (args.skim, ', '.join(sorted(skims.keys()))))
+    if not os.path.exists(args.outfolder):
+        os.makedirs(args.outfolder)
+    print(green('--> Skimming %i ntuples with skim \'%s\': %s' % (len(args.infilenames), args.skim, skims[args.skim]['selection'])))
+
+    tasks = []
+    for infilename in args.infilenames:
+        outfilename = os.path.join(args.outfolder, os.path.basename(infilename))
+        if args.force or not is_skim_up_to_date(infilename, outfilename, args.skim):
+            tasks.append((infilename, outfilename, args.skim))
+    print(green('  --> %i files to skim, %i up to date' % (len(tasks), len(args.infilenames) - len(tasks))))
+
+    if args.ncores > 1 and len(tasks) > 1:
+        pool = Pool(processes=args.ncores)
+        results = pool.map(skim_file_singlearg, tasks)
+        pool.close()
+        pool.join()
+    else:
+        results = [skim_file_singlearg(t) for t in tasks]
+
+    ntotal = sum(r[0] for r in results)
+    nselected = sum(r[1] for r in results)
+    print(green('--> Done skimming, kept %i of %i events (%.1f%%) in the %i skimmed files.' % (nselected, ntotal, 100. * nselected / max(ntotal, 1), len(tasks))))
+
+
+
+def is_skim_up_to_date(infilename, outfilename, skim):
+    index = load_file_index(outfilename)
+    if index is None or not os.path.isfile(infilename):
+        return False
+    return index.get('skim') == skim and index.get('skim_definition') == skims[skim] and index.get('source_signature') == file_signature(infilename)
+
+
+def skim_file_singlearg(task):
+    return skim_file(infilename=task[0], outfilename=task[1], skim=task[2])
+
+
+def skim_file(infilename, outfilename, skim, treename='Events'):
+    """Write the selected events and branches of one ntuple to outfilename; returns the numbers of events before and after."""
+    import ROOT as rt
+
+    definition = skims[skim]
+    signature = file_signature(infilename)
+    source_index = load_file_index(infilename)
+
+    infile = rt.TFile.Open(infilename, 'READ')
+    intree = infile.Get(treename)
+    ntotal = int(intree.GetEntries())
+    sumw = None
+    if intree.GetBranch('genweight'):
+        sumw = float(read_columns(infilename, ['genweight'], treename=treename)['genweight'].astype('float64').sum())
+    intree.SetBranchStatus('*', 0)
+    for b in definition['branches']:
+        intree.SetBranchStatus(b, 1)
+
+    # Written to a temporary file first, the sidecar written after the rename marks the skim as complete;
+    # the name does not end in .root, so a left-over of a killed job is never taken for a skimmed ntuple
+    tmpname = os.path.splitext(outfilename)[0] + '.skim.tmp'
+    outfile = rt.TFile(tmpname, 'RECREATE')
+    outtree = intree.CopyTree(definition['selection'])
+    outfile.cd()
+    outtree.Write()
+    summary = summarize_tree(outtree)
+    outfile.Close()
+    infile.Close()
+    os.rename(tmpname, outfilename)
+
+    extra = {
+        'skim':             skim,
+        'skim_definition':  definition,
+        'source':           os.path.abspath(infilename),
+        'source_signature': signature,
+        'ntotal':           ntotal,
+    }
+    if sumw is not None:
+        extra['sumw'] = sumw
+    if source_index is not None:
+        extra['weight_ids'] = source_index.get('weight_ids', [])
+    write_file_index(outfilename, summary, extra=extra)
+    print(blue('    --> Skimmed %s: kept %i of %i events' % (infilename, summary['entries'], ntotal)))
+    return ntotal, summary['entries']
+
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    main()
@@ -1,13 +1,16 @@
 #! /usr/bin/env python
 
 from argparse import ArgumentParser
-import ROOT
-from tdrstyle_all import *
 from printing_utils import *
 from utils import *
+from ntuple_index import sidecar_filename, load_file_index, build_sample_index
+from work_queue import FileQueue
+from heartbeat import load_heartbeats, summarize_heartbeats
+from dataset_catalog import build_catalogs, load_catalog, sorted_files, file_number, event_ranges
 from collections import defaultdict, OrderedDict
-import os, sys, math
+import os, sys, math, time
 import subprocess
+import shutil
 import copy
 
 
@@ -17,18 +20,41 @@ parser.add_argument('-s', "--submit",      dest="submit", default=False, action=
                                            help="Actually submit/run" )
 parser.add_argument('-r', "--resubmit",    dest="resubmit", default=False, action='store_true',
                                            help="resubmit crashed conversion jobs" )
+parser.add_argument('-d', "--catalog",     dest="catalog", default=False, action='store_true',
+                                           help="list the GENSIM folders of all samples and update the catalog of input files, sizes and event counts (see dataset_catalog.py)" )
 parser.add_argument('-c', "--convert",     dest="convert", default=False, action='store_true',
                                            help="(re)submit conversion jobs to the cluster" )
 parser.add_argument('-p', "--plot",        dest="plot", default=False, action='store_true',
                                            help="plot from converted files" )
-args = parser.parse_args()
-if args.convert and args.plot:
-    raise ValueError('Cannot do conversion AND plotting in the same step')
-if not (args.convert or args.plot):
-    raise ValueError('Must do either conversion or plotting, what else am I supposed to do?')
+parser.add_argument('-a', "--augment",     dest="augment", default=False, action='store_true',
+                                           help="add derived columns to converted files as friend trees (see augment_ntuples.py)" )
+parser.add_argument('-k', "--skim",        dest="skim", default=False, action='store_true',
+                                           help="skim and slim converted files with the skim given by '--skimname' (see skim_ntuples.py)" )
+parser.add_argument('--skimname',          dest="skimname", default=None, action='store',
+                                           help="name of the skim to produce (default: preselection) or, when plotting, to plot from instead of the full ntuples" )
+parser.add_argument('-m', "--monitor",     dest="monitor", default=False, action='store_true',
+                                           help="monitor running conversion jobs through their heartbeat files, until all of them are finished" )
+parser.add_argument('--monitor-interval',  dest="monitor_interval", default=30., type=float,
+                                           help="seconds between two updates of the monitor, 0 to show the status once" )
+parser.add_argument('-w', "--workers",     dest="workers", default=0, type=int,
+                                           help="convert with this many persistent converter workers per sample, fed from a queue, instead of one job per file" )
+parser.add_argument('-e', "--events-per-job", dest="events_per_job", default=0, type=int,
+                                           help="split input files with more events than this into event ranges of equal size, converted by separate jobs (default: whole files)" )
+parser.add_argument('-j', "--ncores",      dest="ncores", default=1, type=int,
+                                           help="cores per conversion job, each job converts its events in this many processes and merges the parts" )
+parser.add_argument('--stage',             dest="stage", default=False, action='store_true',
+                                           help="let the converter write to node-local scratch and upload the verified outputs in the background (see output_staging.py)" )
+
+# Nothing here imports ROOT: the steps that need it (conversion, plotting) run as separate
+# processes, so dry runs and job submission start without loading ROOT or FWLite.
 
 
 def main():
+    nsteps = len([step for step in [args.catalog, args.convert, args.augment, args.skim, args.plot, args.monitor] if step])
+    if nsteps > 1:
+        raise ValueError('Cannot do more than one of cataloging, conversion, augmentation, skimming, plotting and monitoring in the same step')
+    if nsteps == 0:
+        raise ValueError('Must do either cataloging, conversion, augmentation, skimming, plotting or monitoring, what else am I supposed to do?')
     print(green('--> Hello from the steer script!'))
 
     # Define the settings
@@ -38,7 +64,6 @@ def main():
     # Samples that Arne generated
     gensimfolder_base    = 'root://storage01.lcg.cscs.ch//pnfs/lcg.cscs.ch/cms/trivcat/store/user/areimers/GENSIM/UL17/LQFlavorFit'
     gensim_filename_base = 'GENSIM'
-    nfiles_gensim = 100
 
     # General settings
     scriptfolder  = os.path.abspath(os.getcwd())
@@ -46,19 +71,43 @@ def main():
     plotfolder    = scriptfolder.replace('scripts', 'plots')
     commandfolder = os.path.join(scriptfolder, 'commands')
     logfolder     = os.path.join(scriptfolder, 'logs')
-    ensureDirectory(filefolder)
-    ensureDirectory(plotfolder)
-    ensureDirectory(commandfolder)
-    ensureDirectory(logfolder)
+    queuefolder   = os.path.join(scriptfolder, 'queues')
+    skimfolder    = os.path.join(filefolder, 'skims')
+    heartbeatfolder = os.path.join(scriptfolder, 'heartbeats')
+    catalogfolder = os.path.join(scriptfolder, 'catalogs')
+    ensureDirectories([filefolder, plotfolder, commandfolder, logfolder])
+
+    # monitoring only reads the heartbeat files, it does not need '-s'
+    if args.monitor:
+        monitor(heartbeatfolder=heartbeatfolder, interval=args.monitor_interval)
+        print(green('--> All done in the steer script, bye!'))
+        return
+
+    # cataloging only lists the inputs, it does not need '-s' either
+    if args.catalog:
+        catalog(gensimfolder_base=gensimfolder_base, catalogfolder=catalogfolder, samplenames=samplenames)
+        print(green('--> All done in the steer script, bye!'))
+        return
 
     if args.submit:
         if args.convert:
-            convert(gensimfolder_base=gensimfolder_base, gensim_filename_base=gensim_filename_base, filefolder=filefolder, scriptfolder=scriptfolder, commandfolder=commandfolder, logfolder=logfolder, samplenames=samplenames, nfiles=nfiles_gensim, resubmit=resubmit)
+            convert(gensimfolder_base=gensimfolder_base, gensim_filename_base=gensim_filename_base, filefolder=filefolder, scriptfolder=scriptfolder, commandfolder=commandfolder, logfolder=logfolder, samplenames=samplenames, catalogfolder=catalogfolder, resubmit=resubmit, queuefolder=queuefolder, nworkers=args.workers, heartbeatfolder=heartbeatfolder, stage=args.stage, events_per_job=args.events_per_job, ncores=args.ncores)
+        if args.augment:
+            augment(filefolder=filefolder, samplenames=samplenames)
+        if args.skim:
+            skim(filefolder=filefolder, skimfolder=skimfolder, samplenames=samplenames, skimname=args.skimname if args.skimname is not None else 'preselection')
         if args.plot:
-            plot(filefolder=filefolder, plotfolder=plotfolder, samplenames=samplenames)
+            if args.skimname is not None:
+                plot(filefolder=os.path.join(skimfolder, args.skimname), plotfolder=os.path.join(plotfolder, args.skimname), samplenames=samplenames)
+            else:
+                plot(filefolder=filefolder, plotfolder=plotfolder, samplenames=samplenames, gensimfolder_base=gensimfolder_base, gensim_filename_base=gensim_filename_base, catalogfolder=catalogfolder)
     else:
         if args.convert:
             print(yellow('  --> Would run the conversion step now, set \'-s\' to actually run and \'-r\' to resubmit failed jobs only'))
+        if args.augment:
+            print(yellow('  --> Would run the augmentation step now, set \'-s\' to actually run'))
+        if args.skim:
+            print(yellow('  --> Would run the skimming step now, set \'-s\' to actually run'))
         if args.plot:
             print(yellow('  --> Would run the plotting step now, set \'-s\' to actually run'))
 
@@ -68,25 +117,75 @@ def main():
 
 
 
-def convert(gensimfolder_base, gensim_filename_base, filefolder, scriptfolder, commandfolder, logfolder, samplenames, nfiles, resubmit=False):
+def catalog(gensimfolder_base, catalogfolder, samplenames):
+    catalogs = build_catalogs(folders=dict((sn, os.path.join(gensimfolder_base, sn)) for sn in samplenames), catalogfolder=catalogfolder)
+    for sn in samplenames:
+        c = catalogs[sn]
+        print(blue('  --> %s: %i files, %.1f GB, %i events' % (sn, c['nfiles'], c['size'] / 1E9, c['events'])))
+        unreadable = [f for f, entry in c['files'].items() if entry.get('events') is None]
+        if len(unreadable) > 0:
+            print(yellow('    --> %i files could not be read: %s' % (len(unreadable), ', '.join(sorted(unreadable)))))
+
+
+
+def convert(gensimfolder_base, gensim_filename_base, filefolder, scriptfolder, commandfolder, logfolder, samplenames, catalogfolder, resubmit=False, queuefolder=None, nworkers=0, heartbeatfolder=None, stage=False, events_per_job=0, ncores=1):
+    ensureDirectories([os.path.join(filefolder, sn) for sn in samplenames])
     for sn in samplenames:
         gensimfolder = os.path.join(gensimfolder_base, sn)
-        ensureDirectory(os.path.join(filefolder, sn))
-        
-        commands = []
-        commands_resubmit = []
-        for ifile in range(1, nfiles+1):
-            infilename = os.path.join(gensimfolder, '%s_%i.root' % (gensim_filename_base, ifile))
-            outfilename = os.path.join(filefolder, sn, 'ntuple_%i.root' % (ifile))
-            command = '%s/convert_gensim_root.py -i %s -o %s' % (scriptfolder, infilename, outfilename)
-            commands.append(command)
 
-            if not os.path.isfile(outfilename):
-                commands_resubmit.append(command)
-        
-            if os.path.isfile(outfilename) and not resubmit:
-                os.remove(outfilename)
+        # jobs are made for the files in the catalog, which is only built here if it does not exist yet ('-d' updates it)
+        sample_catalog = load_catalog(catalogfolder, sn)
+        if sample_catalog is None:
+            sample_catalog = build_catalogs(folders={sn: gensimfolder}, catalogfolder=catalogfolder)[sn]
+        infiles = converted_files(sample_catalog, gensim_filename_base)
+        print(blue('  --> %s: converting %i files with %i events from the catalog' % (sn, len(infiles), sum(entry.get('events') or 0 for f, entry in infiles))))
 
+        # large files are split into event ranges of equal size, one output 'ntuple_<file>_<part>.root' each
+        commands = []
+        commands_resubmit = []
+        items = []
+        for f, entry in infiles:
+            ifile = file_number(f)
+            infilename = os.path.join(gensimfolder, f)
+            outbase = os.path.join(filefolder, sn, 'ntuple_%i' % (ifile) if ifile is not None else os.path.splitext(f.replace(gensim_filename_base, 'ntuple', 1))[0])
+            ranges = event_ranges(entry.get('events'), events_per_job)
+            for ipart, (first, last) in enumerate(ranges):
+                outfilename = outbase + ('_%i.root' % (ipart) if len(ranges) > 1 else '.root')
+                command = '%s/convert_gensim_root.py -i %s -o %s -j %i --heartbeatfolder %s%s' % (scriptfolder, infilename, outfilename, ncores, os.path.join(heartbeatfolder, sn), ' --stage' if stage else '')
+                item = {'infilenames': [infilename], 'outfilename': outfilename}
+                if last is not None:
+                    command += ' --first-event %i -n %i' % (first, last - first)
+                    item.update({'first_event': first, 'nevents': last - first})
+                commands.append(command)
+
+                # an output without valid sidecar index was not closed properly by the converter
+                incomplete = load_file_index(outfilename) is None
+                if incomplete:
+                    commands_resubmit.append(command)
+                if incomplete or not resubmit:
+                    items.append((os.path.splitext(os.path.basename(outfilename))[0], item))
+
+        # a fresh submission starts from an empty folder, also without outputs of a different splitting
+        if not resubmit:
+            samplefolder = os.path.join(filefolder, sn)
+            for f in os.listdir(samplefolder):
+                if f.startswith('ntuple_') and (f.endswith('.root') or f.endswith('.index.json') or f.endswith('.checkpoint.json')):
+                    os.remove(os.path.join(samplefolder, f))
+                elif f.startswith('ntuple_') and f.endswith('_parts'):
+                    shutil.rmtree(os.path.join(samplefolder, f))
+            # progress files of earlier jobs would be shown by the monitor next to the new ones
+            if heartbeatfolder is not None and os.path.isdir(os.path.join(heartbeatfolder, sn)):
+                shutil.rmtree(os.path.join(heartbeatfolder, sn))
+            # items queued by an earlier submission would be converted as well, into the same or overlapping outputs
+            if queuefolder is not None and os.path.isdir(os.path.join(queuefolder, sn)):
+                nremoved = FileQueue(os.path.join(queuefolder, sn)).clear()
+                if nremoved > 0:
+                    print(blue('  --> %s: removed %i items of an earlier submission from the queue' % (sn, nremoved)))
+
+
+        if nworkers > 0:
+            submit_workers(items=items, queuefolder=os.path.join(queuefolder, sn), heartbeatfolder=os.path.join(heartbeatfolder, sn), nworkers=nworkers, scriptfolder=scriptfolder, commandfolder=commandfolder, logfolder=logfolder, jobname=sn, stage=stage, ncores=ncores)
+            continue
 
         commandfilename = os.path.join(commandfolder, '%s_convert.txt' % (sn))
         with open(commandfilename, 'w') as f:
@@ -99,20 +198,103 @@ def convert(gensimfolder_base, gensim_filename_base, filefolder, scriptfolder, c
                 f.write(c + '\n')
 
         if resubmit:
-            submit(scriptname=commandfilename_resub, njobs=len(commands_resubmit), jobname=sn, logfolder=logfolder, runtime=(0,10,00), ncores=1)
+            submit(scriptname=commandfilename_resub, njobs=len(commands_resubmit), jobname=sn, logfolder=logfolder, runtime=(0,10,00), ncores=ncores)
         else:
-            submit(scriptname=commandfilename, njobs=len(commands), jobname=sn, logfolder=logfolder, runtime=(0,10,00), ncores=1)
+            submit(scriptname=commandfilename, njobs=len(commands), jobname=sn, logfolder=logfolder, runtime=(0,10,00), ncores=ncores)
 
     
 
-def plot(filefolder, plotfolder, samplenames):
+def converted_files(sample_catalog, gensim_filename_base):
+    """(name, entry) of the files in a catalog that are converted: the GENSIM files not known to be empty."""
+    return [(f, entry) for f, entry in sorted_files(sample_catalog) if f.startswith(gensim_filename_base) and entry.get('events') != 0]
+
+
+
+def submit_workers(items, queuefolder, heartbeatfolder, nworkers, scriptfolder, commandfolder, logfolder, jobname, stage=False, ncores=1):
+    # Items go to a queue shared by a few long-running converter workers, which load ROOT and FWLite only once
+    queue = FileQueue(queuefolder)
+    for name, item in items:
+        queue.put(name, item)
+    nworkers = min(nworkers, len(items))
+    print(blue('  --> Queued %i conversions in %s for %i workers' % (len(items), queuefolder, nworkers)))
+    if nworkers == 0:
+        return
+
+    commandfilename = os.path.join(commandfolder, '%s_convert_workers.txt' % (jobname))
+    with open(commandfilename, 'w') as f:
+        for i in range(nworkers):
+            f.write('%s/convert_gensim_root.py -q %s -j %i --heartbeatfolder %s%s\n' % (scriptfolder, queuefolder, ncores, heartbeatfolder, ' --stage' if stage else ''))
+    submit(scriptname=commandfilename, njobs=nworkers, jobname=jobname, logfolder=logfolder, runtime=(12,00,00), ncores=ncores)
+
+
+
+def monitor(heartbeatfolder, interval=30.):
+    # Aggregated progress of all jobs of all samples, refreshed until no job is running anymore
+    while True:
+        summary = summarize_heartbeats(load_heartbeats(heartbeatfolder))
+        print(green('--> Job status at %s' % (time.strftime('%H:%M:%S'))))
+        if len(summary) == 0:
+            print(yellow('  --> No heartbeat files found in %s' % (heartbeatfolder)))
+        for sn in sorted(summary.keys()):
+            status = summary[sn]
+            eta = '%.1f min' % (status['eta'] / 60.) if status['eta'] is not None else 'unknown'
+            print(blue('  --> %s: %i jobs, %i running, %i done, %i failed, %i stale; %i events, %.1f events/s, ETA %s, max. memory %.0f MB' % (sn, status['njobs'], status['running'], status['done'], status['failed'], len(status['stale']), status['events'], status['rate'], eta, status['memory_mb'])))
+            for b in status['stragglers']:
+                print(yellow('    --> Straggler %s on %s: %.1f events/s (median %.1f), %i of %s events' % (b['job'], b['host'], b.get('recent_rate', 0.), status['median_rate'], b['events'], str(b['ntotal']))))
+            for b in status['stale']:
+                print(yellow('    --> No update from %s on %s (job %s) for %.0f min' % (b['job'], b['host'], b['batchjob'], (time.time() - b['updated']) / 60.)))
+        if interval <= 0. or sum(s['running'] for s in summary.values()) == 0:
+            break
+        time.sleep(interval)
+
+
+
+def augment(filefolder, samplenames):
+    # a local pass over the converted ntuples, only friends that are missing or outdated are recomputed
+    print(blue('  --> Augmenting %i samples...' % (len(samplenames))))
+    for sn in samplenames:
+        infolder = os.path.join(filefolder, sn)
+        ntuple_files = [os.path.join(infolder, f) for f in os.listdir(infolder) if os.path.isfile(os.path.join(infolder, f)) and f.endswith('.root')]
+        ntuple_files.sort()
+        command = './augment_ntuples.py -i %s -j 8' % (' '.join(ntuple_files))
+        os.system(command)
+    print(blue('\n  --> Done augmenting!'))
+
+
+
+def skim(filefolder, skimfolder, samplenames, skimname):
+    # reduced copies of the ntuples in skims/<skimname>/<sample>, normalization kept in their sidecars
+    print(blue('  --> Skimming %i samples with skim \'%s\'...' % (len(samplenames), skimname)))
+    for sn in samplenames:
+        infolder = os.path.join(filefolder, sn)
+        outfolder = os.path.join(skimfolder, skimname, sn)
+        ensureDirectory(outfolder)
+        ntuple_files = [os.path.join(infolder, f) for f in os.listdir(infolder) if os.path.isfile(os.path.join(infolder, f)) and f.endswith('.root')]
+        ntuple_files.sort()
+        command = './skim_ntuples.py -i %s -o %s -s %s -j 8' % (' '.join(ntuple_files), outfolder, skimname)
+        os.system(command)
+    print(blue('\n  --> Done skimming!'))
+
+
+
+def plot(filefolder, plotfolder, samplenames, gensimfolder_base=None, gensim_filename_base=None, catalogfolder=None):
     print(blue('  --> Plotting for %i samples...' % (len(samplenames))))
     commands = []
     for sn in samplenames:
         infolder  = os.path.join(filefolder, sn)
         outfolder = os.path.join(plotfolder, sn)
         ensureDirectory(outfolder)
-        ntuple_files = [os.path.join(infolder, f) for f in os.listdir(infolder) if os.path.isfile(os.path.join(infolder, f))]
+
+        # converted ntuples are checked against the inputs in the catalog, to also find files that were never converted
+        inputs = None
+        sample_catalog = load_catalog(catalogfolder, sn) if catalogfolder is not None else None
+        if sample_catalog is not None:
+            inputs = dict((os.path.join(gensimfolder_base, sn, f), entry.get('events')) for f, entry in converted_files(sample_catalog, gensim_filename_base))
+        sample_index = build_sample_index(infolder, inputs=inputs)
+        print(blue('    --> Sample %s: %i events in %i indexed files (%.1f MB)' % (sn, sample_index['entries'], len(sample_index['files']), sample_index['filesize']/1.E6)))
+        for problem in sample_index['coverage_problems']:
+            print(yellow('    --> Incomplete conversion, %s' % (problem)))
+        ntuple_files = [os.path.join(infolder, f) for f in os.listdir(infolder) if os.path.isfile(os.path.join(infolder, f)) and f.endswith('.root')]
         ntuple_files.sort()
         filestring = ' '.join(ntuple_files)
 
@@ -140,5 +322,6 @@ def submit(scriptname, njobs, jobname, logfolder, runtime=(1,00,00), ncores=1):
 
 
 if __name__ == '__main__':
+    args = parser.parse_args()
     main()
 
@@ -0,0 +1,484 @@
+import os
+import stat as statmodule
+import shutil
+import subprocess
+import zlib
+from multiprocessing.pool import ThreadPool
+
+
+# File operations on the local disk and on grid storage elements, always for many paths at once.
+#
+# Every backend takes lists of paths and runs the single operations concurrently in a small
+# thread pool, reusing one session (xrootd file system object, gfal2 context) per server, so
+# that a hundred mkdirs or stats cost a few round trips instead of a hundred process launches.
+# get_storage() picks the backend from the path and caches it:
+#     /local/path, file:///local/path      -> LocalStorage
+#     root://server//path                  -> XRootDStorage (XRootD python bindings, or xrdfs)
+#     srm://, gsiftp://, davs://, https:// -> GfalStorage (gfal2 python bindings, or gfal-* tools)
+# Off the grid, use_stand_in() maps the URLs of one server to a local folder (StandInStorage), so
+# that code written for root:// paths can be run and tested without a storage element.
+
+nthreads_default = 8
+
+
+def adler32(filename, blocksize=1024*1024):
+    """Adler-32 checksum of a local file as 8 hex digits, the checksum grid storage elements keep for every file."""
+    value = 1
+    with open(filename, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if len(block) == 0:
+                break
+            value = zlib.adler32(block, value)
+    return '%08x' % (value & 0xffffffff)
+
+
+def normalize_checksum(checksum):
+    return None if checksum is None else '%08x' % (int(checksum, 16))
+
+
+class Storage():
+    def __init__(self, nthreads=nthreads_default):
+        self.nthreads = nthreads
+        self.pool = None
+
+    def map(self, function, items):
+        """function(item) for all items, concurrently; returns the results in order."""
+        items = list(items)
+        if len(items) <= 1 or self.nthreads <= 1:
+            return [function(item) for item in items]
+        if self.pool is None:
+            self.pool = ThreadPool(self.nthreads)
+        return self.pool.map(function, items)
+
+    def mkdir(self, paths):
+        """Create directories including their parents, existing ones are fine."""
+        failed = [p for p, ok in zip(paths, self.map(self.mkdir_one, paths)) if not ok]
+        if len(failed) > 0:
+            raise IOError('Failed to create %i directories, e.g. %s' % (len(failed), failed[0]))
+
+    def stat(self, paths):
+        """{path: {'size', 'mtime', 'isdir'}} for all paths, None for those that do not exist."""
+        return dict(zip(paths, self.map(self.stat_one, paths)))
+
+    def exists(self, paths):
+        return dict((p, s is not None) for p, s in self.stat(paths).items())
+
+    def copy(self, pairs, overwrite=True):
+        """Copy (source, destination) pairs; sources can be local files for remote destinations."""
+        pairs = list(pairs)
+        failed = [p for p, ok in zip(pairs, self.map(lambda pair: self.copy_one(pair[0], pair[1], overwrite), pairs)) if not ok]
+        if len(failed) > 0:
+            raise IOError('Failed to copy %i files, e.g. %s -> %s' % (len(failed), failed[0][0], failed[0][1]))
+
+    def remove(self, paths):
+        """Remove files, missing ones are fine."""
+        failed = [p for p, ok in zip(paths, self.map(self.remove_one, paths)) if not ok]
+        if len(failed) > 0:
+            raise IOError('Failed to remove %i files, e.g. %s' % (len(failed), failed[0]))
+
+    def checksum(self, paths):
+        """{path: adler32} for all paths, None for those that do not exist."""
+        return dict((p, normalize_checksum(c)) for p, c in zip(paths, self.map(self.checksum_one, paths)))
+
+    def rename(self, pairs):
+        """
+        Move (source, destination) pairs within this storage, replacing existing destinations.
+
+        Locally, this is an atomic os.rename. Remote storage cannot replace a file in one step: the old
+        destination is moved aside and removed only after the move succeeded, or moved back if it failed.
+        In between, the destination briefly does not exist.
+        """
+        pairs = list(pairs)
+        failed = [p for p, ok in zip(pairs, self.map(lambda pair: self.rename_one(pair[0], pair[1]), pairs)) if not ok]
+        if len(failed) > 0:
+            raise IOError('Failed to rename %i files, e.g. %s -> %s' % (len(failed), failed[0][0], failed[0][1]))
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+
+
+class LocalStorage(Storage):
+    def local_path(self, path):
+        return path[len('file://'):] if path.startswith('file://') else path
+
+    def mkdir_one(self, path):
+        path = self.local_path(path)
+        try:
+            os.makedirs(path)
+        except OSError:
+            pass
+        return os.path.isdir(path)
+
+    def stat_one(self, path):
+        try:
+            st = os.stat(self.local_path(path))
+        except OSError:
+            return None
+        return {'size': st.st_size, 'mtime': st.st_mtime, 'isdir': statmodule.S_ISDIR(st.st_mode)}
+
+    def listdir(self, path):
+        return sorted(os.listdir(self.local_path(path)))
+
+    def copy_one(self, source, destination, overwrite=True):
+        source, destination = self.local_path(source), self.local_path(destination)
+        if os.path.exists(destination) and not overwrite:
+            return False
+        self.mkdir_one(os.path.dirname(os.path.abspath(destination)))
+        try:
+            shutil.copy2(source, destination)
+        except (IOError, OSError):
+            return False
+        return True
+
+    def remove_one(self, path):
+        path = self.local_path(path)
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        return not os.path.exists(path)
+
+    def checksum_one(self, path):
+        path = self.local_path(path)
+        return adler32(path) if os.path.isfile(path) else None
+
+    def rename_one(self, source, destination):
+        try:
+            os.rename(self.local_path(source), self.local_path(destination))
+        except OSError:
+            return False
+        return True
+
+
+
+def split_xrootd_url(url):
+    """('root://server:port', '/path') from 'root://server:port//path'."""
+    rest = url[len('root://'):]
+    server, path = rest.split('/', 1)
+    return 'root://' + server, '/' + path.lstrip('/')
+
+
+class XRootDStorage(Storage):
+    def __init__(self, server, nthreads=nthreads_default):
+        Storage.__init__(self, nthreads=nthreads)
+        self.server = server
+        try:
+            from XRootD import client
+            self.client = client
+            self.filesystem = client.FileSystem(server)
+        except ImportError:
+            # without the python bindings, every operation is one call to xrdfs
+            self.client = None
+            self.filesystem = None
+
+    def xrdfs(self, *arguments):
+        try:
+            p = subprocess.Popen(['xrdfs', self.server] + list(arguments), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError:
+            raise IOError('Neither the XRootD python bindings nor xrdfs are available to access %s' % (self.server))
+        out, err = p.communicate()
+        return p.returncode == 0, out.decode('utf-8', 'replace') if isinstance(out, bytes) else out
+
+    def mkdir_one(self, path):
+        path = split_xrootd_url(path)[1]
+        if self.filesystem is not None:
+            from XRootD.client.flags import MkDirFlags
+            status, response = self.filesystem.mkdir(path, MkDirFlags.MAKEPATH)
+            return status.ok or self.stat_one(self.server + '/' + path) is not None
+        return self.xrdfs('mkdir', '-p', path)[0]
+
+    def stat_one(self, path):
+        path = split_xrootd_url(path)[1]
+        if self.filesystem is not None:
+            from XRootD.client.flags import StatInfoFlags
+            status, info = self.filesystem.stat(path)
+            if not status.ok:
+                return None
+            return {'size': info.size, 'mtime': info.modtime, 'isdir': bool(info.flags & StatInfoFlags.IS_DIR)}
+        ok, out = self.xrdfs('stat', path)
+        if not ok:
+            return None
+        fields = dict([line.split(':', 1) for line in out.splitlines() if ':' in line])
+        return {'size': int(fields.get('Size', '0').strip()), 'mtime': None, 'isdir': 'IsDir' in fields.get('Flags', '')}
+
+    def listdir(self, path):
+        path = split_xrootd_url(path)[1]
+        if self.filesystem is not None:
+            status, listing = self.filesystem.dirlist(path)
+            if not status.ok:
+                raise IOError('Could not list %s%s: %s' % (self.server, path, status.message))
+            return sorted([entry.name for entry in listing])
+        ok, out = self.xrdfs('ls', path)
+        if not ok:
+            raise IOError('Could not list %s%s' % (self.server, path))
+        return sorted([os.path.basename(line.strip()) for line in out.splitlines() if line.strip() != ''])
+
+    def copy(self, pairs, overwrite=True):
+        # one copy process for all pairs, transferring up to nthreads files in parallel
+        pairs = list(pairs)
+        if self.client is None or len(pairs) == 0:
+            return Storage.copy(self, pairs, overwrite=overwrite)
+        process = self.client.CopyProcess()
+        for source, destination in pairs:
+            process.add_job(source, destination, force=overwrite, mkdir=True)
+        process.prepare()
+        status, results = process.run()
+        failed = [pair for pair, result in zip(pairs, results) if not result['status'].ok]
+        if len(failed) > 0:
+            raise IOError('Failed to copy %i files, e.g. %s -> %s' % (len(failed), failed[0][0], failed[0][1]))
+
+    def copy_one(self, source, destination, overwrite=True):
+        command = ['xrdcp', '--silent', '--path'] + (['--force'] if overwrite else []) + [source, destination]
+        return subprocess.call(command) == 0
+
+    def remove_one(self, path):
+        path = split_xrootd_url(path)[1]
+        if self.filesystem is not None:
+            status, response = self.filesystem.rm(path)
+            return status.ok or self.stat_one(self.server + '/' + path) is None
+        return self.xrdfs('rm', path)[0] or self.stat_one(self.server + '/' + path) is None
+
+    def checksum_one(self, path):
+        path = split_xrootd_url(path)[1]
+        if self.filesystem is not None:
+            from XRootD.client.flags import QueryCode
+            status, response = self.filesystem.query(QueryCode.CHECKSUM, path)
+            if not status.ok:
+                return None
+            response = response.decode('utf-8', 'replace') if isinstance(response, bytes) else response
+        else:
+            ok, response = self.xrdfs('query', 'checksum', path)
+            if not ok:
+                return None
+        # the answer is '<algorithm> <value>'
+        return response.strip('\x00').split()[-1]
+
+    def rename_one(self, source, destination):
+        # mv does not replace an existing file: the old one is moved aside first and only removed once the
+        # new one is in place, or moved back if that fails
+        source, destination = split_xrootd_url(source)[1], split_xrootd_url(destination)[1]
+        aside = destination + '.replaced'
+        if self.filesystem is not None:
+            mv = lambda a, b: self.filesystem.mv(a, b)[0].ok
+            rm = lambda a: self.filesystem.rm(a)
+        else:
+            mv = lambda a, b: self.xrdfs('mv', a, b)[0]
+            rm = lambda a: self.xrdfs('rm', a)
+        rm(aside)
+        moved_aside = mv(destination, aside)
+        if not mv(source, destination):
+            if moved_aside:
+                mv(aside, destination)
+            return False
+        if moved_aside:
+            rm(aside)
+        return True
+
+
+
+class GfalStorage(Storage):
+    # gfal-* command-line tools run with an empty environment, as the CMSSW python and libraries clash with them
+    gfal_environment = 'LD_LIBRARY_PATH=\'\' PYTHONPATH=\'\' '
+
+    def __init__(self, nthreads=nthreads_default):
+        Storage.__init__(self, nthreads=nthreads)
+        try:
+            import gfal2
+            self.gfal2 = gfal2
+            self.context = gfal2.creat_context()
+        except ImportError:
+            self.gfal2 = None
+            self.context = None
+
+    def gfal(self, command):
+        p = subprocess.Popen(self.gfal_environment + command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        return p.returncode == 0, out.decode('utf-8', 'replace') if isinstance(out, bytes) else out
+
+    def mkdir(self, paths):
+        if self.context is not None:
+            return Storage.mkdir(self, paths)
+        # the command-line tool takes all directories at once
+        if len(paths) > 0 and not self.gfal('gfal-mkdir -p %s' % (' '.join(paths)))[0]:
+            raise IOError('Failed to create directories, e.g. %s' % (paths[0]))
+
+    def mkdir_one(self, path):
+        try:
+            self.context.mkdir_rec(path, 0o755)
+        except self.gfal2.GError:
+            return self.stat_one(path) is not None
+        return True
+
+    def stat(self, paths):
+        if self.context is not None:
+            return Storage.stat(self, paths)
+        # without bindings, list each parent directory once instead of one process per file
+        parents = sorted(set(os.path.dirname(p.rstrip('/')) for p in paths))
+        listings = dict(zip(parents, self.map(self.list_with_sizes, parents)))
+        result = {}
+        for p in paths:
+            result[p] = listings[os.path.dirname(p.rstrip('/'))].get(os.path.basename(p.rstrip('/')))
+        return result
+
+    def stat_one(self, path):
+        try:
+            st = self.context.stat(path)
+        except self.gfal2.GError:
+            return None
+        return {'size': st.st_size, 'mtime': st.st_mtime, 'isdir': statmodule.S_ISDIR(st.st_mode)}
+
+    def list_with_sizes(self, path):
+        ok, out = self.gfal('gfal-ls -l %s' % (path))
+        entries = {}
+        if not ok:
+            return entries
+        for line in out.splitlines():
+            fields = line.split()
+            if len(fields) < 9:
+                continue
+            entries[fields[-1]] = {'size': int(fields[4]), 'mtime': None, 'isdir': fields[0].startswith('d')}
+        return entries
+
+    def listdir(self, path):
+        if self.context is not None:
+            try:
+                return sorted(self.context.listdir(path))
+            except self.gfal2.GError as e:
+                raise IOError('Could not list %s: %s' % (path, str(e)))
+        ok, out = self.gfal('gfal-ls %s' % (path))
+        if not ok:
+            raise IOError('Could not list %s' % (path))
+        return sorted([line.strip() for line in out.splitlines() if line.strip() != ''])
+
+    def copy_one(self, source, destination, overwrite=True):
+        if not '://' in source:
+            source = 'file://' + os.path.abspath(source)
+        if self.context is not None:
+            params = self.context.transfer_parameters()
+            params.overwrite = overwrite
+            params.create_parent = True
+            try:
+                self.context.filecopy(params, source, destination)
+            except self.gfal2.GError:
+                return False
+            return True
+        return self.gfal('gfal-copy -p %s %s %s' % ('-f' if overwrite else '', source, destination))[0]
+
+    def remove(self, paths):
+        if self.context is not None:
+            return Storage.remove(self, paths)
+        if len(paths) > 0:
+            self.gfal('gfal-rm %s' % (' '.join(paths)))
+
+    def remove_one(self, path):
+        try:
+            self.context.unlink(path)
+        except self.gfal2.GError:
+            return self.stat_one(path) is None
+        return True
+
+    def checksum_one(self, path):
+        if self.context is not None:
+            try:
+                return self.context.checksum(path, 'ADLER32')
+            except self.gfal2.GError:
+                return None
+        # the answer is '<url> <value>'
+        ok, out = self.gfal('gfal-sum %s ADLER32' % (path))
+        return out.split()[-1] if ok else None
+
+    def rename_one(self, source, destination):
+        # as for XRootD, the old file is moved aside and only removed once the new one is in place
+        aside = destination + '.replaced'
+        if self.context is not None:
+            def mv(a, b):
+                try:
+                    self.context.rename(a, b)
+                except self.gfal2.GError:
+                    return False
+                return True
+            def rm(a):
+                try:
+                    self.context.unlink(a)
+                except self.gfal2.GError:
+                    pass
+        else:
+            mv = lambda a, b: self.gfal('gfal-rename %s %s' % (a, b))[0]
+            rm = lambda a: self.gfal('gfal-rm %s' % (a))
+        rm(aside)
+        moved_aside = mv(destination, aside)
+        if not mv(source, destination):
+            if moved_aside:
+                mv(aside, destination)
+            return False
+        if moved_aside:
+            rm(aside)
+        return True
+
+
+
+class StandInStorage(LocalStorage):
+    """Local folder standing in for an xrootd server: root://server//path is localroot/path."""
+    def __init__(self, server, localroot, nthreads=nthreads_default):
+        LocalStorage.__init__(self, nthreads=nthreads)
+        self.server = server
+        self.localroot = localroot
+
+    def local_path(self, path):
+        if path.startswith('root://'):
+            return os.path.join(self.localroot, split_xrootd_url(path)[1].lstrip('/'))
+        return LocalStorage.local_path(self, path)
+
+
+
+storages = {}
+
+def use_stand_in(server, localroot):
+    """Serve all paths on this xrootd server (e.g. 'root://eosuser.cern.ch') from the local folder localroot."""
+    storages[server] = StandInStorage(server=server, localroot=localroot)
+
+def get_storage(path):
+    """The backend for a path or URL, one instance (and session) per server."""
+    if path.startswith('root://'):
+        key = split_xrootd_url(path)[0]
+        if key not in storages:
+            storages[key] = XRootDStorage(server=key)
+    elif '://' in path and not path.startswith('file://'):
+        key = 'gfal'
+        if key not in storages:
+            storages[key] = GfalStorage()
+    else:
+        key = 'local'
+        if key not in storages:
+            storages[key] = LocalStorage()
+    return storages[key]
+
+
+def group_by_storage(paths):
+    """{storage: [paths]}, to run batched operations on paths that live on different backends."""
+    groups = {}
+    for p in paths:
+        groups.setdefault(get_storage(p), []).append(p)
+    return groups
+
+
+def mkdirs(paths):
+    for storage, group in group_by_storage(paths).items():
+        storage.mkdir(group)
+
+
+def stat_files(paths):
+    result = {}
+    for storage, group in group_by_storage(paths).items():
+        result.update(storage.stat(group))
+    return result
+
+
+def existing_files(paths):
+    """The paths that exist, in the given order."""
+    stats = stat_files(paths)
+    return [p for p in paths if stats[p] is not None]
@@ -0,0 +1,69 @@
+import numpy as np
+
+from kinematics import to_ptetaphim
+
+
+# Visible kinematics and decay modes of generated taus, for many taus (of many events) at once.
+#
+# Every tau is followed to its last copy, whose descendants are all labelled with the index of
+# the tau, one generation per step for all taus together (see GenParticleGraph). The visible tau
+# is the sum of the stable descendants without neutrinos. The decay mode is leptonic if the last
+# copy decays directly to an electron or muon, otherwise it is encoded like the HPS decay modes
+# used in reconstruction: 5 * (nprongs - 1) + npi0, with npi0 at most 4.
+
+neutrino_pdgids    = [12, 14, 16]
+decaymode_unknown  = -1
+decaymode_electron = -11
+decaymode_muon     = -13
+
+
+def label_descendants(graph, roots):
+    """For every particle the index (into roots) of the root it descends from, -1 for all others; roots are labelled themselves."""
+    labels = np.full(len(graph), -1, dtype=np.int64)
+    labels[roots] = np.arange(len(roots))
+    owner, links = graph.daughter_owner, graph.daughters
+    for istep in range(len(graph)):
+        unlabelled = (labels[owner] >= 0) & (labels[links] < 0)
+        if not np.any(unlabelled):
+            break
+        labels[links[unlabelled]] = labels[owner[unlabelled]]
+    return labels
+
+
+def visible_taus(graph, taus):
+    """Visible four-momenta and decay modes of the given taus, as a dict of arrays with one entry per tau."""
+    taus = np.asarray(taus, dtype=np.int64)
+    ntaus = len(taus)
+    last = graph.last_copy(taus)
+    labels = label_descendants(graph, last)
+    labels[last] = -1
+    abspdgid = np.abs(graph.pdgid)
+
+    # Sum of the visible stable descendants
+    visible = (labels >= 0) & (graph.status == 1) & ~np.isin(abspdgid, neutrino_pdgids)
+    result = {}
+    for name in ['px', 'py', 'pz', 'energy']:
+        result[name] = np.bincount(labels[visible], weights=getattr(graph, name)[visible], minlength=ntaus)
+    result['pt'], result['eta'], result['phi'], result['mass'] = to_ptetaphim(result['energy'], result['px'], result['py'], result['pz'])
+
+    # Decay products: leptons directly from the last copy, charged hadrons and pi0s anywhere below it
+    direct = np.isin(graph.daughter_owner, last)
+    direct_labels = np.full(len(graph), -1, dtype=np.int64)
+    direct_labels[last] = np.arange(ntaus)
+    direct_owner = direct_labels[graph.daughter_owner[direct]]
+    direct_pdgid = abspdgid[graph.daughters[direct]]
+    n_electrons = np.bincount(direct_owner[direct_pdgid == 11], minlength=ntaus)
+    n_muons = np.bincount(direct_owner[direct_pdgid == 13], minlength=ntaus)
+    charged_hadron = visible & (graph.charge != 0) & ~np.isin(abspdgid, [11, 13])
+    nprongs = np.bincount(labels[charged_hadron], minlength=ntaus)
+    npi0 = np.bincount(labels[(labels >= 0) & (abspdgid == 111)], minlength=ntaus)
+
+    decaymode = np.full(ntaus, decaymode_unknown, dtype=np.int32)
+    hadronic = nprongs > 0
+    decaymode[hadronic] = 5 * (nprongs[hadronic] - 1) + np.minimum(npi0[hadronic], 4)
+    decaymode[n_muons > 0] = decaymode_muon
+    decaymode[n_electrons > 0] = decaymode_electron
+    result['decaymode'] = decaymode
+    result['nprongs'] = nprongs
+    result['npi0'] = npi0
+    return result
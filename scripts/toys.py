@@ -0,0 +1,89 @@
+import json
+import numpy as np
+from multiprocessing import Pool
+
+from printing_utils import *
+
+
+# Pseudo-experiments for validating the flavor fit. Toys are Poisson-fluctuated copies of the
+# expected histograms, generated and fitted in batches: each batch is one (ntoys, nbins) array
+# that is fitted at once by BinnedLikelihood.fit_datasets. Batches are distributed over a process
+# pool; every worker generates its own toys from a per-batch seed, so only the small per-toy
+# results travel back. These are appended to a text file batch by batch and summarized with
+# running sums, so the memory use does not grow with the number of toys.
+
+def generate_toys(expected, ntoys, seed):
+    return np.random.RandomState(seed).poisson(expected, size=(ntoys, len(expected))).astype(np.float64)
+
+
+def fit_toy_batch(arguments):
+    """Generate and fit one batch of toys; returns one row of results per toy."""
+    likelihood, expected, poi_true, ntoys, seed = arguments
+    toys = generate_toys(expected, ntoys, seed)
+    params, nll = likelihood.fit_datasets(toys)
+    errors = likelihood.uncertainties(params)
+
+    # test statistic at the true value, for the coverage of the likelihood intervals
+    nll_true, _ = likelihood.profile(np.full(ntoys, poi_true), data=toys)
+    q = 2. * (nll_true - nll)
+
+    pulls = np.empty_like(params)
+    pulls[:, 0] = (params[:, 0] - poi_true) / errors[:, 0]
+    pulls[:, 1:] = params[:, 1:] / errors[:, 1:]
+    seeds = np.full(ntoys, seed, dtype=np.float64)
+    return np.column_stack([seeds, params[:, 0], errors[:, 0], q, pulls])
+
+
+def result_columns(likelihood):
+    return ['seed', 'poi', 'poi_error', 'q_true'] + ['pull_%s' % (name) for name in likelihood.parameter_names()]
+
+
+def run_toys(likelihood, expected, poi_true, ntoys, outfilename, batchsize=1000, ncores=1, seed=1):
+    """Fit ntoys pseudo-datasets drawn from expected, stream per-toy results to outfilename and return a summary."""
+    nbatches = (ntoys + batchsize - 1) // batchsize
+    batches = ((likelihood, expected, poi_true, min(batchsize, ntoys - ibatch * batchsize), seed + ibatch) for ibatch in range(nbatches))
+
+    pool = None
+    if ncores > 1:
+        pool = Pool(processes=ncores)
+        results = pool.imap(fit_toy_batch, batches, chunksize=1)
+    else:
+        results = (fit_toy_batch(b) for b in batches)
+
+    columns = result_columns(likelihood)
+    npulls = likelihood.nparams
+    ndone = 0
+    sums = {'pull': np.zeros(npulls), 'pull2': np.zeros(npulls), 'covered68': 0, 'covered95': 0, 'poi': 0., 'poi2': 0.}
+    with open(outfilename, 'w') as f:
+        f.write('# ' + ' '.join(columns) + '\n')
+        for ibatch, rows in enumerate(results):
+            np.savetxt(f, rows, fmt='%.8g')
+            f.flush()
+            pulls = rows[:, 4:]
+            sums['pull'] += pulls.sum(axis=0)
+            sums['pull2'] += (pulls**2).sum(axis=0)
+            sums['covered68'] += int(np.count_nonzero(rows[:, 3] < 1.))
+            sums['covered95'] += int(np.count_nonzero(rows[:, 3] < 3.84))
+            sums['poi'] += rows[:, 1].sum()
+            sums['poi2'] += (rows[:, 1]**2).sum()
+            ndone += len(rows)
+            print(blue('    --> Fitted %i of %i toys' % (ndone, ntoys)))
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    pull_mean = sums['pull'] / ndone
+    pull_width = np.sqrt(np.maximum(sums['pull2'] / ndone - pull_mean**2, 0.))
+    summary = {
+        'ntoys':      ndone,
+        'poi_true':   poi_true,
+        'poi_mean':   float(sums['poi'] / ndone),
+        'poi_std':    float(np.sqrt(max(sums['poi2'] / ndone - (sums['poi'] / ndone)**2, 0.))),
+        'coverage68': float(sums['covered68']) / ndone,
+        'coverage95': float(sums['covered95']) / ndone,
+        'pull_mean':  dict(zip(likelihood.parameter_names(), pull_mean.tolist())),
+        'pull_width': dict(zip(likelihood.parameter_names(), pull_width.tolist())),
+    }
+    with open(outfilename + '.summary.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
@@ -6,21 +6,20 @@ from bisect import bisect_left
 from printing_utils import *
 import functools
 
-from multiprocessing import Pool, Queue
-import ROOT
+# ROOT, multiprocessing and numpy (through limits) are imported inside the functions that need
+# them, so that importing utils stays fast for scripts that only steer or submit jobs.
 
 
-def ensureDirectory(dirname, use_se=False):
+def ensureDirectory(dirname):
     """Make directory if it does not exist."""
-    if use_se:
-        # print dirname
-        command = 'LD_LIBRARY_PATH=\'\' PYTHONPATH=\'\' gfal-mkdir -p %s' % (dirname)
-        execute_command_silent(command)
-    else:
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        if not os.path.exists(dirname):
-            print yellow('--> failed to make directory "%s"'%(dirname))
+    ensureDirectories([dirname])
+
+
+def ensureDirectories(dirnames):
+    """Make all directories that do not exist, in one batch per storage backend (see storage.py); raises IOError if that fails."""
+    # the backend follows from the path (root://, davs://, ... or local), there is no need to choose it
+    from storage import mkdirs
+    mkdirs(dirnames)
 
 
 def is_file_empty(file_path):
@@ -227,6 +226,7 @@ def execute_function_parallel(func, argumentlist, ncores=10):
 
     Does not return any output the function might produce or return
     """
+    from multiprocessing import Pool
     pool = Pool(processes=ncores)
     result = pool.map(func, argumentlist)
     pool.terminate()
@@ -235,6 +235,7 @@ def execute_function_parallel(func, argumentlist, ncores=10):
 
 
 def hadd_large(outfilename, infilelist, force, notree, maxsize=int(5E11)): #default maxsize: 500GB (standard root: 100)
+    import ROOT
     ROOT.TTree.SetMaxTreeSize(maxsize)
     rm = ROOT.TFileMerger(False)
     rm.SetFastMethod(True)
@@ -276,44 +277,14 @@ def hadd_large_singlearg(arg): #default maxsize: 500GB (standard root: 100), goo
 
 def get_intersection(g1, g2):
 
-    # find intersetion between two TGraphs
-
-    result = None
-
-    #find highest and lowest x:
-    xmin = max(g1.GetX()[0], g2.GetX()[0] )
-    xmax = min(g1.GetX()[g1.GetN()-1], g2.GetX()[g2.GetN()-1])
-
-    # iteratively find intersection, by evaluating graphs at xmin, xmax, moving one of them, and repeating
-    # ====================================================================================================
-    y1lo = g1.Eval(xmin)
-    y2lo = g2.Eval(xmin)
-    y1hi = g1.Eval(xmax)
-    y2hi = g2.Eval(xmax)
-    if (y1lo < y2lo and y1hi < y2hi) or (y1lo > y2lo and y1hi > y2hi):
-        # raise ValueError('graphs 1 and 2 either have no or multiple intersections')
+    # find intersection between two TGraphs, by linear interpolation (like TGraph::Eval) on the
+    # common x points of both graphs. Returns None if the graphs do not cross exactly once, use
+    # limits.find_graph_crossings to get all crossings or limits.find_crossings for many curves at once.
+    from limits import find_graph_crossings
+    crossings = find_graph_crossings(g1, g2)
+    if len(crossings) != 1:
         return None
-
-    # find higher graph at xmin
-    g1_from_top = True if y1lo > y2lo else False
-
-    xmid = xmin + (xmax-xmin)/2.
-    while math.fabs(xmin-xmax) > 1:
-        y1mid = g1.Eval(xmid)
-        y2mid = g2.Eval(xmid)
-        if g1_from_top:
-            if y1mid > y2mid:
-                xmin = xmid
-            else:
-                xmax = xmid
-        elif not g1_from_top:
-            if y1mid > y2mid:
-                xmax = xmid
-            else:
-                xmin = xmid
-        xmid = xmin + (xmax-xmin)/2.
-
-    return xmid
+    return crossings[0]
 
 def timeit(method):
     @functools.wraps(method)
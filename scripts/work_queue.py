@@ -0,0 +1,160 @@
+import os
+import json
+import time
+import socket
+import threading
+
+from printing_utils import *
+from ntuple_index import write_json_atomic
+
+
+# A minimal queue of work items on a shared filesystem, for long-lived workers that process many
+# items one after another. Every item is a small json file that moves between the subfolders
+#     pending/ -> running/ -> done/ or failed/
+# Workers claim an item by renaming it from pending/ to running/. The rename is atomic, so every
+# item is claimed by exactly one worker, without locks or a server.
+#
+# While a worker holds an item, a background thread touches its file in running/ every lease_interval
+# seconds. An item whose file has not been touched for much longer than that belongs to a worker that
+# is gone, and requeue_stale hands it to another one; a worker that is merely slow keeps its items.
+
+states = ['pending', 'running', 'done', 'failed']
+
+
+class FileQueue():
+    def __init__(self, folder, lease_interval=60.):
+        self.folder = folder
+        self.lease_interval = lease_interval
+        self.held = set()
+        self.lease_thread = None
+        for state in states:
+            path = os.path.join(folder, state)
+            if not os.path.exists(path):
+                try:
+                    os.makedirs(path)
+                except OSError:
+                    # created in the meantime by another worker
+                    if not os.path.isdir(path):
+                        raise
+
+    def path(self, state, name):
+        return os.path.join(self.folder, state, name + '.json')
+
+    def names(self, state):
+        return sorted([f[:-len('.json')] for f in os.listdir(os.path.join(self.folder, state)) if f.endswith('.json')])
+
+    def counts(self):
+        return dict((state, len(self.names(state))) for state in states)
+
+    def put(self, name, item):
+        """Add an item (a json-serializable dict) to the queue, replacing a running or finished item of the same name."""
+        for state in ['running', 'done', 'failed']:
+            if os.path.isfile(self.path(state, name)):
+                os.remove(self.path(state, name))
+        write_json_atomic(self.path('pending', name), item)
+
+    def claim(self):
+        """Take the next pending item, returns (name, item) or None if nothing is pending."""
+        for name in self.names('pending'):
+            try:
+                os.rename(self.path('pending', name), self.path('running', name))
+            except OSError:
+                # claimed by another worker
+                continue
+            with open(self.path('running', name)) as f:
+                item = json.load(f)
+            item['worker'] = '%s:%i' % (socket.gethostname(), os.getpid())
+            item['started'] = time.time()
+            write_json_atomic(self.path('running', name), item)
+            self.held.add(name)
+            self.start_lease()
+            return name, item
+        return None
+
+    def start_lease(self):
+        if self.lease_thread is not None:
+            return
+        self.lease_thread = threading.Thread(target=self.renew_leases)
+        self.lease_thread.daemon = True
+        self.lease_thread.start()
+
+    def renew_leases(self):
+        # runs as long as the worker process, touching the files of all items it holds
+        while True:
+            time.sleep(self.lease_interval)
+            for name in list(self.held):
+                try:
+                    os.utime(self.path('running', name), None)
+                except OSError:
+                    # finished or taken back in the meantime
+                    pass
+
+    def finish(self, name, item, success, message=None):
+        """Move a claimed item to done/ or failed/, with the time it took and an optional message."""
+        item['finished'] = time.time()
+        if message is not None:
+            item['message'] = message
+        self.held.discard(name)
+        write_json_atomic(self.path('done' if success else 'failed', name), item)
+        # gone if the item was put again or taken back by requeue_stale in the meantime
+        if os.path.isfile(self.path('running', name)):
+            os.remove(self.path('running', name))
+
+    def requeue_failed(self):
+        """Move all failed items back to pending/, returns their number."""
+        names = self.names('failed')
+        for name in names:
+            os.rename(self.path('failed', name), self.path('pending', name))
+        return len(names)
+
+    def requeue_stale(self, max_age):
+        """Move running items whose lease has not been renewed for max_age seconds back to pending/, such as those of killed workers; returns their number."""
+        now = time.time()
+        n = 0
+        for name in self.names('running'):
+            path = self.path('running', name)
+            try:
+                renewed = os.path.getmtime(path)
+            except OSError:
+                # finished in the meantime
+                continue
+            if now - renewed < max_age:
+                continue
+            try:
+                os.rename(path, self.path('pending', name))
+            except OSError:
+                continue
+            n += 1
+        return n
+
+    def clear(self):
+        """Remove the items in all states, returns their number."""
+        n = 0
+        for state in states:
+            for name in self.names(state):
+                os.remove(self.path(state, name))
+                n += 1
+        return n
+
+    def items(self, idle_timeout=0., poll_interval=5., stale_after=None):
+        """
+        Claim items one after another; waits up to idle_timeout seconds for new ones before stopping.
+
+        With stale_after, items whose lease has not been renewed for that many seconds (much longer than
+        lease_interval) are taken back into the queue whenever nothing is pending, so that those of killed
+        workers are converted after all.
+        """
+        idle_since = time.time()
+        while True:
+            if stale_after is not None and len(self.names('pending')) == 0:
+                nstale = self.requeue_stale(stale_after)
+                if nstale > 0:
+                    print(yellow('--> Took back %i items whose workers have not renewed them for %i s' % (nstale, stale_after)))
+            claimed = self.claim()
+            if claimed is not None:
+                yield claimed
+                idle_since = time.time()
+            elif time.time() - idle_since >= idle_timeout:
+                return
+            else:
+                time.sleep(poll_interval)